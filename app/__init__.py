@@ -1,13 +1,26 @@
 ﻿from __future__ import annotations
 
-import logging
-from logging import Logger
-
 from flask import Flask, jsonify, request
 from werkzeug.exceptions import HTTPException
 
+from .admin import admin_bp
+from .admission import init_admission
+from .activity import backfill_activity_command
+from .archive import archive_messages_command
+from .compression import compress_response
 from .config import load_config
-from .database import init_engine
+from .database import init_engine, init_read_replicas
+from .events import init_broker
+from .export import export_sessions_command
+from .json_provider import init_json_provider
+from .logging_config import init_logging
+from .metrics import init_metrics
+from .outbox import dispatch_outbox_command
+from .search import backfill_search_command
+from .session_state import init_session_cache
+from .sweeper import sweep_sessions_command
+from .timing import init_timing, timed
+from .write_buffer import init_write_buffer
 from .api import api_bp
 from .routes import ui_bp
 from .webhook import webhook_bp
@@ -19,36 +32,35 @@ def create_app(config_object: type | None = None) -> Flask:
     config_cls = config_object or load_config()
     app.config.from_object(config_cls)
 
-    _configure_logging(app)
+    init_logging(app)
+    init_json_provider(app)
+    init_timing(app)
     init_engine(app)
+    init_broker(app)
+    init_read_replicas(app)
+    init_session_cache(app)
+    init_write_buffer(app)
+    init_admission(app)
+    init_metrics(app)
 
     app.register_blueprint(ui_bp)
     app.register_blueprint(api_bp, url_prefix="/api")
     app.register_blueprint(webhook_bp, url_prefix="/webhook")
+    app.register_blueprint(admin_bp, url_prefix="/api/admin")
+    app.cli.add_command(dispatch_outbox_command)
+    app.cli.add_command(archive_messages_command)
+    app.cli.add_command(sweep_sessions_command)
+    app.cli.add_command(export_sessions_command)
+    app.cli.add_command(backfill_search_command)
+    app.cli.add_command(backfill_activity_command)
 
     _register_error_handlers(app)
     _register_response_headers(app)
+    _register_compression(app)
 
     return app
 
 
-def _configure_logging(app: Flask) -> None:
-    level_name = str(app.config.get("LOG_LEVEL", "INFO")).upper()
-    level = getattr(logging, level_name, logging.INFO)
-
-    logger: Logger = app.logger
-    if not logger.handlers:
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter(
-            "[%(asctime)s] %(levelname)s in %(module)s: %(message)s"
-        )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-
-    logger.setLevel(level)
-    logger.debug("Logging configured", extra={"component": "bootstrap"})
-
-
 def _register_error_handlers(app: Flask) -> None:
     @app.errorhandler(HTTPException)
     def handle_http_exception(exc: HTTPException):
@@ -70,3 +82,15 @@ def _register_response_headers(app: Flask) -> None:
         )
         return response
 
+
+def _register_compression(app: Flask) -> None:
+    @app.after_request
+    def compress(response):
+        with timed("compress"):
+            return compress_response(
+                response,
+                request,
+                min_size=app.config["COMPRESS_MIN_SIZE"],
+                level=app.config["COMPRESS_LEVEL"],
+            )
+
@@ -0,0 +1,102 @@
+﻿from __future__ import annotations
+
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, text
+
+from .database import role_bypasses_rls, session_scope
+from .models import ChatSession
+
+# Locks the batch's sessions: an insert racing the batch updates its session
+# row in the same statement, so it either committed before the counts below
+# are read or waits until they are written.
+_LOCK_SESSIONS = text("SELECT id FROM chat_sessions WHERE id > :after_id AND id <= :last_id FOR UPDATE")
+
+_FILL_FROM_MESSAGES = text(
+    """
+    UPDATE chat_sessions AS s
+    SET message_count = agg.message_count,
+        last_message_at = agg.last_message_at,
+        last_sender = agg.last_sender
+    FROM (
+        SELECT m.session_token,
+               count(*) AS message_count,
+               max(m.created_at) AS last_message_at,
+               (array_agg(m.sender ORDER BY m.created_at DESC, m.id DESC))[1] AS last_sender
+        FROM chat_sessions AS c
+        JOIN messages AS m ON m.session_token = c.session_token
+        WHERE c.id > :after_id AND c.id <= :last_id
+        GROUP BY m.session_token
+    ) AS agg
+    WHERE agg.session_token = s.session_token
+    """
+)
+
+# Archived sessions keep their count and last timestamp; the last sender stays NULL.
+_FILL_FROM_ARCHIVE = text(
+    """
+    UPDATE chat_sessions AS s
+    SET message_count = a.message_count,
+        last_message_at = a.last_message_at
+    FROM messages_archive AS a
+    WHERE a.session_token = s.session_token AND s.id > :after_id AND s.id <= :last_id
+    """
+)
+
+
+def backfill_batch(db, after_id: int, limit: int) -> tuple[int | None, int]:
+    """Fill the activity columns of the next ``limit`` session ids after ``after_id``.
+
+    Returns the last id covered (``None`` past the end) and how many
+    rows were updated. Only those sessions are locked, for one short
+    transaction.
+    """
+    ids = select(ChatSession.id).where(ChatSession.id > after_id).order_by(ChatSession.id).limit(limit).subquery()
+    last_id = db.execute(select(func.max(ids.c.id))).scalar_one()
+    if last_id is None:
+        return None, 0
+    params = {"after_id": after_id, "last_id": last_id}
+    db.execute(_LOCK_SESSIONS, params)
+    updated = db.execute(_FILL_FROM_MESSAGES, params).rowcount
+    updated += db.execute(_FILL_FROM_ARCHIVE, params).rowcount
+    return last_id, updated
+
+
+@click.command("backfill-activity")
+@click.option(
+    "--batch-size", type=int, default=None, help="Sessoes por transacao (default: VALEZAP_ACTIVITY_BACKFILL_BATCH_SIZE)."
+)
+@click.option("--pause", type=float, default=0.0, show_default=True, help="Segundos de espera entre os lotes.")
+@with_appcontext
+def backfill_activity_command(batch_size: int | None, pause: float) -> None:
+    """Fill message_count, last_message_at and last_sender for existing sessions.
+
+    Runs after migrations/010_session_activity.sql. Each batch recounts its
+    sessions from scratch, so it is safe to interrupt and run again.
+    """
+    limit = batch_size or current_app.config["ACTIVITY_BACKFILL_BATCH_SIZE"]
+
+    with session_scope() as db:
+        # Under RLS the batches would see no rows and report success.
+        if not role_bypasses_rls(db):
+            raise click.ClickException("backfill-activity precisa de um papel superuser ou BYPASSRLS")
+
+    after_id, updated_total = 0, 0
+    while True:
+        with session_scope() as db:
+            last_id, updated = backfill_batch(db, after_id, limit)
+        if last_id is None:
+            break
+        after_id = last_id
+        updated_total += updated
+        if pause > 0:
+            time.sleep(pause)
+
+    current_app.logger.info(
+        "Atividade das sessoes preenchida",
+        extra={"event": "activity.backfill.done", "sessions_updated": updated_total},
+    )
+    click.echo(f"{updated_total} sessoes preenchidas")
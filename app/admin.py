@@ -0,0 +1,161 @@
+﻿from __future__ import annotations
+
+import hmac
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request, stream_with_context
+from sqlalchemy import func, select, tuple_
+
+from .export import ExportUnavailable, SessionExport, open_export, parse_filters
+from .models import ChatSession
+from .pagination import decode_cursor, decode_rank_cursor, encode_cursor, encode_rank_cursor, parse_limit
+from .search import parse_query, search_messages
+
+admin_bp = Blueprint("admin", __name__)
+
+
+@admin_bp.before_request
+def _require_admin_token() -> None:
+    token = current_app.config.get("ADMIN_TOKEN")
+    if not token:
+        # Without a token the admin API does not exist.
+        abort(404)
+    provided = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(provided, f"Bearer {token}"):
+        current_app.logger.warning(
+            "Acesso administrativo rejeitado",
+            extra={"event": "admin.rejected", "path": request.path},
+        )
+        abort(401, "Token administrativo invalido")
+
+
+# Matches idx_chat_sessions_active_activity (migrations/010_session_activity.sql).
+_LAST_ACTIVITY = func.coalesce(ChatSession.last_message_at, ChatSession.created_at)
+
+
+def _fetch_active_sessions(db, anchor, limit: int):
+    stmt = (
+        select(
+            ChatSession.id,
+            ChatSession.session_token,
+            ChatSession.player_id,
+            ChatSession.created_at,
+            ChatSession.expires_at,
+            ChatSession.message_count,
+            ChatSession.last_message_at,
+            ChatSession.last_sender,
+            _LAST_ACTIVITY.label("last_activity"),
+        )
+        .where(ChatSession.is_active.is_(True))
+        .order_by(_LAST_ACTIVITY.desc(), ChatSession.id.desc())
+        .limit(limit + 1)
+    )
+    if anchor is not None:
+        stmt = stmt.where(tuple_(_LAST_ACTIVITY, ChatSession.id) < tuple_(*anchor))
+    rows = db.execute(stmt).all()
+    return rows[:limit], len(rows) > limit
+
+
+@admin_bp.get("/sessions")
+def active_sessions():
+    """Page through active sessions, most recently active first (keyset on the partial index)."""
+    config = current_app.config
+    cursor = request.args.get("cursor")
+    try:
+        limit = parse_limit(request.args.get("limit"), config["ADMIN_PAGE_SIZE"], config["ADMIN_PAGE_MAX"])
+        anchor = decode_cursor(cursor) if cursor else None
+    except ValueError as exc:
+        abort(400, str(exc))
+
+    try:
+        connection = open_export(config)
+    except ExportUnavailable as exc:
+        abort(503, str(exc))
+    with connection:
+        rows, has_more = _fetch_active_sessions(connection, anchor, limit)
+
+    sessions = [
+        {
+            "session_token": row.session_token,
+            "player_id": row.player_id,
+            "created_at": row.created_at,
+            "expires_at": row.expires_at,
+            "message_count": row.message_count,
+            "last_message_at": row.last_message_at,
+            "last_sender": row.last_sender,
+        }
+        for row in rows
+    ]
+    next_cursor = encode_cursor(rows[-1].last_activity, rows[-1].id) if has_more else None
+    return jsonify({"sessions": sessions, "next_cursor": next_cursor})
+
+
+@admin_bp.get("/search")
+def search():
+    """Full-text search over message content: ranked hits with a snippet, keyset-paginated."""
+    config = current_app.config
+    cursor = request.args.get("cursor")
+    try:
+        terms = parse_query(request.args.get("q"))
+        limit = parse_limit(request.args.get("limit"), config["ADMIN_PAGE_SIZE"], config["ADMIN_PAGE_MAX"])
+        anchor = decode_rank_cursor(cursor) if cursor else None
+    except ValueError as exc:
+        abort(400, str(exc))
+
+    try:
+        connection = open_export(config)
+    except ExportUnavailable as exc:
+        abort(503, str(exc))
+    with connection:
+        rows, has_more = search_messages(connection, terms, anchor, limit)
+
+    hits = [
+        {
+            "session_token": row.session_token,
+            "player_id": row.player_id,
+            "session_active": row.is_active,
+            "message_id": row.id,
+            "sender": row.sender,
+            "created_at": row.created_at,
+            "rank": row.rank,
+            "snippet": row.snippet,
+        }
+        for row in rows
+    ]
+    next_cursor = encode_rank_cursor(rows[-1].rank, rows[-1].id) if has_more else None
+    return jsonify({"hits": hits, "next_cursor": next_cursor})
+
+
+@admin_bp.get("/export")
+def export_sessions():
+    """Stream sessions with their messages as NDJSON (gzip when the client accepts it)."""
+    args = request.args
+    try:
+        filters = parse_filters(args.get("created_from"), args.get("created_to"), args.get("is_active"))
+    except ValueError as exc:
+        abort(400, str(exc))
+
+    config = current_app.config
+    try:
+        connection = open_export(config)
+    except ExportUnavailable as exc:
+        abort(503, str(exc))
+
+    compress = request.accept_encodings["gzip"] > 0
+    export = SessionExport(
+        connection,
+        filters,
+        config["EXPORT_BATCH_SIZE"],
+        config["COMPRESS_LEVEL"] if compress else None,
+    )
+    current_app.logger.info(
+        "Exportacao iniciada",
+        extra={"event": "export.started", "filters": filters._asdict(), "gzip": compress},
+    )
+
+    response = Response(stream_with_context(iter(export)), mimetype="application/x-ndjson")
+    response.headers["Content-Disposition"] = "attachment; filename=valezap-export.ndjson"
+    response.headers["Cache-Control"] = "no-store"
+    response.vary.add("Accept-Encoding")
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+    return response
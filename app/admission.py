@@ -0,0 +1,344 @@
+﻿from __future__ import annotations
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from flask import Flask, abort, current_app, g, jsonify
+
+from .metrics import ADMISSION_REJECTED
+
+# Bucket: key hash, tokens left, last refill (CLOCK_MONOTONIC, shared by all processes on the host).
+_BUCKET = struct.Struct("<Qdd")
+# Slot: owner pid (0 = free), acquired at.
+_SLOT = struct.Struct("<qd")
+# Buckets probed per key before evicting the least recently used one.
+_PROBES = 4
+
+
+class SharedLimits:
+    """Token buckets and dispatch slots in memory shared by every worker of a host.
+
+    With ``path`` the state lives in a file-backed ``mmap`` that all gunicorn
+    workers open (``gunicorn.conf.py`` points ``VALEZAP_ADMISSION_STATE_FILE``
+    at a fresh file); without it, in anonymous memory private to the process.
+    Updates are serialised with ``flock`` plus a thread lock. Slots record the
+    owner's pid, so a worker killed mid-dispatch does not leak its slot.
+
+    The state never leaves the host: every instance (and the outbox
+    dispatcher process) applies the configured limits on its own.
+    """
+
+    def __init__(self, path: str | None, bucket_count: int, dispatch_slots: int, queue_slots: int) -> None:
+        self.path = path
+        self.bucket_count = max(bucket_count, _PROBES)
+        self.dispatch_slots = dispatch_slots
+        self.queue_slots = queue_slots
+        self._dispatch_offset = self.bucket_count * _BUCKET.size
+        self._queue_offset = self._dispatch_offset + dispatch_slots * _SLOT.size
+        self.size = self._queue_offset + queue_slots * _SLOT.size
+        self._pid: int | None = None
+        self._fd: int | None = None
+        self._map: mmap.mmap | None = None
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        if path is None:
+            self._map = mmap.mmap(-1, self.size, flags=mmap.MAP_PRIVATE)
+
+    # -- token buckets -------------------------------------------------
+
+    def take(self, limits: list[tuple[str, float, float]], now: float | None = None) -> float:
+        """Take one token from every ``(key, per_second, burst)`` bucket, or none of them.
+
+        Returns 0 when admitted, otherwise the seconds until all buckets have a token.
+        """
+        now = time.monotonic() if now is None else now
+        with self._locked() as buffer:
+            buckets = []
+            wait = 0.0
+            for key, rate, burst in limits:
+                key_hash = _hash(key)
+                index, tokens = self._find_bucket(buffer, key_hash, rate, burst, now)
+                buckets.append((index, key_hash, tokens))
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            for index, key_hash, tokens in buckets:
+                _BUCKET.pack_into(buffer, index * _BUCKET.size, key_hash, tokens - 1 if wait == 0 else tokens, now)
+            return wait
+
+    def _find_bucket(self, buffer, key_hash: int, rate: float, burst: float, now: float) -> tuple[int, float]:
+        start = key_hash % self.bucket_count
+        reusable = None
+        oldest = None
+        for probe in range(_PROBES):
+            index = (start + probe) % self.bucket_count
+            stored_hash, tokens, updated = _BUCKET.unpack_from(buffer, index * _BUCKET.size)
+            if stored_hash == key_hash:
+                return index, min(burst, tokens + (now - updated) * rate)
+            # Empty, or idle long enough to be full again: forgetting it changes nothing.
+            if reusable is None and (stored_hash == 0 or tokens + (now - updated) * rate >= burst):
+                reusable = index
+            if oldest is None or updated < oldest[1]:
+                oldest = (index, updated)
+        return (reusable if reusable is not None else oldest[0]), burst
+
+    # -- dispatch slots ------------------------------------------------
+
+    def acquire_dispatch(self, timeout: float, poll_interval: float = 0.01) -> int | None:
+        """Reserve a dispatch slot, waiting in the bounded queue for up to ``timeout`` seconds.
+
+        Returns the slot index, or ``None`` when the queue is full (immediately)
+        or no slot freed up in time.
+        """
+        with self._locked() as buffer:
+            slot = self._claim(buffer, self._dispatch_offset, self.dispatch_slots)
+            if slot is not None:
+                return slot
+            waiting = self._claim(buffer, self._queue_offset, self.queue_slots)
+            if waiting is None:
+                return None
+
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                time.sleep(poll_interval)
+                with self._locked() as buffer:
+                    slot = self._claim(buffer, self._dispatch_offset, self.dispatch_slots)
+                if slot is not None:
+                    return slot
+            return None
+        finally:
+            with self._locked() as buffer:
+                _SLOT.pack_into(buffer, self._queue_offset + waiting * _SLOT.size, 0, 0.0)
+
+    def wait_dispatch(self, poll_interval: float = 0.05) -> int:
+        """Reserve a dispatch slot, waiting as long as it takes and outside the bounded queue."""
+        while True:
+            with self._locked() as buffer:
+                slot = self._claim(buffer, self._dispatch_offset, self.dispatch_slots)
+            if slot is not None:
+                return slot
+            time.sleep(poll_interval)
+
+    def release_dispatch(self, slot: int) -> None:
+        with self._locked() as buffer:
+            _SLOT.pack_into(buffer, self._dispatch_offset + slot * _SLOT.size, 0, 0.0)
+
+    def dispatches_in_flight(self) -> int:
+        with self._locked() as buffer:
+            return sum(
+                1
+                for index in range(self.dispatch_slots)
+                if _SLOT.unpack_from(buffer, self._dispatch_offset + index * _SLOT.size)[0]
+            )
+
+    def _claim(self, buffer, offset: int, count: int) -> int | None:
+        pid = os.getpid()
+        dead = None
+        for index in range(count):
+            owner, _ = _SLOT.unpack_from(buffer, offset + index * _SLOT.size)
+            if owner == 0:
+                _SLOT.pack_into(buffer, offset + index * _SLOT.size, pid, time.monotonic())
+                return index
+            if dead is None and owner != pid and not _alive(owner):
+                dead = index
+        if dead is not None:
+            _SLOT.pack_into(buffer, offset + dead * _SLOT.size, pid, time.monotonic())
+        return dead
+
+    # -- shared memory -------------------------------------------------
+
+    @contextmanager
+    def _locked(self) -> Iterator[mmap.mmap]:
+        self._ensure_open()
+        with self._lock:
+            if self._fd is None:
+                yield self._map
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _ensure_open(self) -> None:
+        if self.path is None or self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid == os.getpid():
+                return
+            # Opened per process: flock does not exclude holders of a descriptor inherited through fork.
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < self.size:
+                os.ftruncate(fd, self.size)
+            self._fd = fd
+            self._map = mmap.mmap(fd, self.size)
+            self._pid = os.getpid()
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_limits: SharedLimits | None = None
+_open_streams = 0
+_streams_lock = threading.Lock()
+
+
+def init_admission(app: Flask) -> None:
+    """Create the shared limiter state and release dispatch slots at request teardown."""
+    global _limits
+
+    config = app.config
+    _limits = SharedLimits(
+        config.get("ADMISSION_STATE_FILE"),
+        config["RATE_LIMIT_BUCKETS"],
+        config["DISPATCH_CONCURRENCY"],
+        config["DISPATCH_QUEUE_SIZE"],
+    )
+
+    @app.teardown_request
+    def release_dispatch_slot(_exc) -> None:
+        slot = g.pop("dispatch_slot", None)
+        if slot is not None:
+            _limits.release_dispatch(slot)
+
+
+def get_limits() -> SharedLimits:
+    if _limits is None:
+        raise RuntimeError("Admission control has not been initialized")
+    return _limits
+
+
+def check_rate_limits(player: str, session_token: str) -> None:
+    """Abort with 429 when the player's or the session's bucket is empty."""
+    config = current_app.config
+    limits = []
+    if config["RATE_LIMIT_PLAYER_PER_MINUTE"] > 0:
+        limits.append(
+            (f"player:{player}", config["RATE_LIMIT_PLAYER_PER_MINUTE"] / 60, config["RATE_LIMIT_PLAYER_BURST"])
+        )
+    if config["RATE_LIMIT_SESSION_PER_MINUTE"] > 0:
+        limits.append(
+            (f"session:{session_token}", config["RATE_LIMIT_SESSION_PER_MINUTE"] / 60, config["RATE_LIMIT_SESSION_BURST"])
+        )
+    if not limits:
+        return
+
+    wait = get_limits().take(limits)
+    if wait > 0:
+        ADMISSION_REJECTED.labels(reason="rate_limit").inc()
+        current_app.logger.warning(
+            "Limite de mensagens excedido",
+            extra={"event": "admission.rate_limited", "session_token": session_token, "player": player},
+        )
+        _reject(429, "Muitas mensagens, aguarde um pouco", wait)
+
+
+def reserve_dispatch_slot() -> None:
+    """Hold one of the ``DISPATCH_CONCURRENCY`` backend slots until the request ends, or abort with 503."""
+    config = current_app.config
+    if config["DISPATCH_CONCURRENCY"] <= 0 or "dispatch_slot" in g:
+        return
+
+    timeout = config["DISPATCH_QUEUE_TIMEOUT"]
+    slot = get_limits().acquire_dispatch(timeout)
+    if slot is None:
+        ADMISSION_REJECTED.labels(reason="dispatch_saturated").inc()
+        current_app.logger.warning(
+            "Backend saturado, requisicao recusada",
+            extra={"event": "admission.shed", "in_flight": config["DISPATCH_CONCURRENCY"]},
+        )
+        _reject(503, "Servico sobrecarregado, tente novamente", max(timeout, 1))
+    g.dispatch_slot = slot
+
+
+@contextmanager
+def dispatch_slot() -> Iterator[None]:
+    """Hold one of the ``DISPATCH_CONCURRENCY`` slots around a background dispatch.
+
+    The outbox dispatcher has no client to shed with a 503: it waits for a
+    free slot instead, so it never adds to a saturated backend.
+    """
+    if current_app.config["DISPATCH_CONCURRENCY"] <= 0:
+        yield
+        return
+    limits = get_limits()
+    slot = limits.wait_dispatch()
+    try:
+        yield
+    finally:
+        limits.release_dispatch(slot)
+
+
+def stream_capacity(config) -> int:
+    """SSE streams one worker may hold open: ``STREAM_MAX_OPEN``, or half its request threads.
+
+    Each stream keeps a gthread thread for up to ``STREAM_MAX_SECONDS``; the
+    other threads stay free for sends and history reads.
+    """
+    configured = config.get("STREAM_MAX_OPEN", -1)
+    if configured >= 0:
+        return configured
+    return (config.get("WORKER_THREADS") or 4) // 2
+
+
+def reserve_stream_slot() -> Callable[[], None]:
+    """Count one more open stream in this worker, or abort with 503; returns the release function.
+
+    The client falls back to polling ``GET /api/messages`` and retries the
+    stream later.
+    """
+    global _open_streams
+
+    config = current_app.config
+    capacity = stream_capacity(config)
+    with _streams_lock:
+        admitted = _open_streams < capacity
+        if admitted:
+            _open_streams += 1
+    if not admitted:
+        ADMISSION_REJECTED.labels(reason="streams_full").inc()
+        current_app.logger.warning(
+            "Limite de streams do worker atingido",
+            extra={"event": "admission.streams_full", "open_streams": capacity},
+        )
+        _reject(503, "Muitas conexoes abertas, use GET /api/messages", config["STREAM_HEARTBEAT_SECONDS"])
+
+    released = False
+
+    def release() -> None:
+        global _open_streams
+
+        nonlocal released
+        with _streams_lock:
+            if not released:
+                released = True
+                _open_streams -= 1
+
+    return release
+
+
+def _reject(status: int, message: str, retry_after: float) -> None:
+    name = "Too Many Requests" if status == 429 else "Service Unavailable"
+    response = jsonify({"error": name, "message": message})
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    abort(response)
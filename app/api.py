@@ -1,23 +1,128 @@
 ﻿from __future__ import annotations
 
+from contextlib import contextmanager
+from dataclasses import replace
 from datetime import datetime, timezone
-from time import monotonic
+from time import monotonic, sleep
+from typing import Iterator
 from uuid import uuid4
 
-from flask import Blueprint, abort, current_app, jsonify, request
-from sqlalchemy import select
-
-from .database import session_scope
+from flask import Blueprint, Response, abort, current_app, jsonify, request, stream_with_context
+from sqlalchemy import func, select, tuple_
+from werkzeug.exceptions import HTTPException
+
+from .admission import check_rate_limits, reserve_dispatch_slot, reserve_stream_slot
+from .archive import load_archived_messages
+from .conversation import record_backend_reply, record_player_message
+from .database import is_replica_session, pin_to_primary, read_session_scope, session_scope
+from .events import get_broker
+from .idempotency import (
+    MAX_KEY_LENGTH,
+    claim_key,
+    complete_key,
+    load_key,
+    release_key,
+    request_fingerprint,
+    wait_for_key,
+)
+from .metrics import OPEN_STREAMS
+from .outbox import (
+    ClaimedEntry,
+    claim_session,
+    complete_entry,
+    enqueue_dispatch,
+    hand_over,
+    has_pending_before,
+    is_pending,
+    reschedule_entry,
+)
 from .external import WebhookError, dispatch_to_backend
-from .models import ChatSession, Message, Sender
+from .models import ChatSession, Message, MessageArchive, Sender
+from .pagination import decode_cursor, encode_cursor, parse_limit, parse_message_id, parse_timestamp
+from .session_state import SessionState, get_session_cache, load_session_state, remember_session
 from .security import generate_player_identifier, is_end_of_conversation, normalise_player, validate_message
+from .write_buffer import PendingMessage, get_write_buffer
 
 api_bp = Blueprint("api", __name__)
 
 
-def _load_session(db, session_token: str) -> ChatSession | None:
-    stmt = select(ChatSession).where(ChatSession.session_token == session_token)
-    return db.execute(stmt).scalar_one_or_none()
+def _reject_session(db, session_token: str, player: str) -> None:
+    """Abort with the reason a conditional write matched no session.
+
+    Only runs on the error path, so the happy path never pays for the SELECT.
+    """
+    state = load_session_state(db, session_token, use_cache=False)
+    _check_session_state(state, player)
+    abort(409, "Sessao encerrada")
+
+
+def _check_session_state(state: SessionState | None, player: str) -> None:
+    if state is None:
+        abort(404, "Sessao nao encontrada")
+    if state.player_id != player:
+        abort(403, "Player nao autorizado para esta sessao")
+    if not state.is_active:
+        abort(409, "Sessao encerrada")
+    if state.is_expired():
+        abort(409, "Sessao expirada")
+
+
+def _fetch_messages(
+    db,
+    session_token: str,
+    anchor: tuple[datetime, int] | None = None,
+    since: datetime | None = None,
+    limit: int = 200,
+    include_archive: bool = False,
+) -> tuple[list, bool]:
+    """Return up to ``limit`` messages after the keyset ``anchor`` and whether more remain.
+
+    With ``include_archive`` (ended sessions) messages moved to
+    ``messages_archive`` are merged in, so archival is invisible to clients.
+    Rows are plain column tuples (no ORM identity map or hydration).
+    """
+    stmt = select(Message.id, Message.sender, Message.content, Message.created_at).where(
+        Message.session_token == session_token
+    )
+    if anchor is not None:
+        stmt = stmt.where(tuple_(Message.created_at, Message.id) > tuple_(*anchor))
+    elif since is not None:
+        stmt = stmt.where(Message.created_at > since)
+    stmt = stmt.order_by(Message.created_at.asc(), Message.id.asc()).limit(limit + 1)
+
+    rows = db.execute(stmt).all()
+    if include_archive:
+        archived = load_archived_messages(db, session_token, anchor=anchor, since=since)
+        if archived:
+            rows = sorted([*archived, *rows], key=lambda message: (message.created_at, message.id))[: limit + 1]
+    return rows[:limit], len(rows) > limit
+
+
+def _history_etag(db, session_token: str, state: SessionState) -> str:
+    """Version of a session's history: newest message id, archived count and open flag.
+
+    Ids come from a sequence, so any new message (even one flushed late with
+    an older ``created_at``) raises the max. One indexed statement; no rows
+    are loaded.
+    """
+    latest_id = select(func.max(Message.id)).where(Message.session_token == session_token).scalar_subquery()
+    archived = (
+        select(MessageArchive.message_count)
+        .where(MessageArchive.session_token == session_token)
+        .scalar_subquery()
+    )
+    latest, archived_count = db.execute(select(latest_id, archived)).one()
+    return f"{latest or 0}-{archived_count or 0}-{int(state.is_open())}"
+
+
+def _serialize_message(message) -> dict:
+    # datetime and Sender are encoded by the app's JSON provider (app/json_provider.py).
+    return {
+        "id": message.id,
+        "sender": message.sender,
+        "content": message.content,
+        "created_at": message.created_at,
+    }
 
 
 @api_bp.post("/session")
@@ -33,8 +138,11 @@ def create_session():
     expires_at = now + current_app.config["SESSION_TTL"]
 
     with session_scope() as db:
-        chat_session = ChatSession(session_token=session_token, player_id=requested_player)
+        chat_session = ChatSession(session_token=session_token, player_id=requested_player, expires_at=expires_at)
         db.add(chat_session)
+    remember_session(
+        SessionState(session_token=session_token, player_id=requested_player, is_active=True, expires_at=expires_at)
+    )
 
     current_app.logger.info(
         "Sessao criada",
@@ -57,35 +165,94 @@ def create_session():
     )
 
 
+@contextmanager
+def _history_scope(session_token: str) -> Iterator[tuple]:
+    """Read scope for a history request, with the session's state.
+
+    When a replica does not know the session (possibly created a moment ago
+    and not replicated yet), its transaction is closed and the primary
+    decides instead.
+    """
+    with read_session_scope(session_identifier=session_token) as db:
+        state = load_session_state(db, session_token)
+        if state is not None or not is_replica_session(db):
+            yield db, state
+            return
+    pin_to_primary(session_token)
+    with session_scope(session_identifier=session_token) as db:
+        yield db, load_session_state(db, session_token, use_cache=False)
+
+
 @api_bp.get("/messages")
 def list_messages():
     session_token = request.args.get("session_token")
     if not session_token:
         abort(400, "session_token eh obrigatorio")
 
-    with session_scope(session_identifier=session_token) as db:
-        chat_session = _load_session(db, session_token)
-        if chat_session is None:
+    config = current_app.config
+    try:
+        limit = parse_limit(
+            request.args.get("limit"),
+            config["MESSAGES_PAGE_SIZE"],
+            config["MESSAGES_PAGE_MAX"],
+        )
+        cursor = request.args.get("cursor")
+        anchor = decode_cursor(cursor) if cursor else None
+        raw_since = request.args.get("since")
+        since = parse_timestamp(raw_since) if raw_since else None
+        after_id = parse_message_id(request.args.get("after_id"))
+    except ValueError as exc:
+        abort(400, str(exc))
+
+    with _history_scope(session_token) as (db, state):
+        if state is None:
             abort(404, "Sessao nao encontrada")
 
-        stmt = (
-            select(Message)
-            .where(Message.session_token == session_token)
-            .order_by(Message.created_at.asc())
+        etag = _history_etag(db, session_token, state)
+        if request.if_none_match.contains_weak(etag):
+            not_modified = current_app.response_class(status=304)
+            not_modified.set_etag(etag, weak=True)
+            not_modified.headers["Cache-Control"] = "private, no-cache"
+            return not_modified
+
+        if anchor is None and after_id is not None:
+            if since is not None:
+                anchor = (since, after_id)
+            else:
+                anchor_stmt = select(Message.created_at).where(
+                    Message.session_token == session_token,
+                    Message.id == after_id,
+                )
+                anchor_created_at = db.execute(anchor_stmt).scalar_one_or_none()
+                if anchor_created_at is None and not state.is_active:
+                    anchor_created_at = next(
+                        (message.created_at for message in load_archived_messages(db, session_token) if message.id == after_id),
+                        None,
+                    )
+                if anchor_created_at is None:
+                    abort(400, "after_id invalido")
+                anchor = (anchor_created_at, after_id)
+
+        rows, has_more = _fetch_messages(
+            db,
+            session_token,
+            anchor=anchor,
+            since=since,
+            limit=limit,
+            include_archive=not state.is_active,
         )
-        rows = db.execute(stmt).scalars().all()
-        messages = [
-            {
-                "id": message.id,
-                "sender": message.sender.value,
-                "content": message.content,
-                "created_at": message.created_at.isoformat() if message.created_at else None,
-            }
-            for message in rows
-        ]
+        messages = [_serialize_message(message) for message in rows]
+        if rows:
+            next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+        elif anchor is not None:
+            next_cursor = cursor or encode_cursor(*anchor)
+        else:
+            next_cursor = None
         response = {
             "messages": messages,
-            "is_active": chat_session.is_active,
+            "is_active": state.is_open(),
+            "next_cursor": next_cursor,
+            "has_more": has_more,
         }
 
     current_app.logger.debug(
@@ -94,62 +261,167 @@ def list_messages():
             "event": "messages.listed",
             "session_token": session_token,
             "count": len(messages),
+            "has_more": has_more,
             "active": response["is_active"],
         },
     )
 
-    return jsonify(response)
+    http_response = jsonify(response)
+    http_response.set_etag(etag, weak=True)
+    http_response.headers["Cache-Control"] = "private, no-cache"
+    return http_response
 
 
-@api_bp.post("/messages")
-def send_message():
-    payload = request.get_json(silent=True) or {}
-    session_token = payload.get("session_token")
-    player = normalise_player(payload.get("player"))
-
+@api_bp.get("/messages/stream")
+def stream_messages():
+    session_token = request.args.get("session_token")
     if not session_token:
         abort(400, "session_token eh obrigatorio")
-    if not player:
-        abort(400, "player invalido")
 
+    cursor = request.headers.get("Last-Event-ID") or request.args.get("cursor")
     try:
-        message_text = validate_message(payload.get("message"))
+        anchor = decode_cursor(cursor) if cursor else None
     except ValueError as exc:
         abort(400, str(exc))
 
-    sent_at = datetime.now(timezone.utc)
-    player_payload = {
-        "sender": Sender.PLAYER.value,
-        "content": message_text,
-        "created_at": sent_at.isoformat(),
-    }
-
     with session_scope(session_identifier=session_token) as db:
-        chat_session = _load_session(db, session_token)
-        if chat_session is None:
+        if load_session_state(db, session_token) is None:
             abort(404, "Sessao nao encontrada")
-        if chat_session.player_id != player:
-            abort(403, "Player nao autorizado para esta sessao")
-        if not chat_session.is_active:
-            abort(409, "Sessao encerrada")
-
-        outgoing = Message(
-            session_token=session_token,
-            sender=Sender.PLAYER,
-            content=message_text,
-            created_at=sent_at,
-        )
-        db.add(outgoing)
 
-    current_app.logger.info(
-        "Mensagem do player registrada",
+    # Held until the response closes, even when the client leaves before the first event.
+    release_stream = reserve_stream_slot()
+    config = current_app.config
+    heartbeat = config["STREAM_HEARTBEAT_SECONDS"]
+    deadline = monotonic() + config["STREAM_MAX_SECONDS"]
+    page_size = config["MESSAGES_PAGE_MAX"]
+
+    def generate():
+        nonlocal anchor
+        # Subscribe before the first read so a commit racing with it still wakes us up.
+        subscription = get_broker().subscribe(session_token)
+        OPEN_STREAMS.inc()
+        try:
+            yield f"retry: {config['STREAM_RETRY_MS']}\n\n"
+            while True:
+                with session_scope(session_identifier=session_token) as db:
+                    # Read through: the wake-up may race the cache invalidation of an ended session.
+                    state = load_session_state(db, session_token, use_cache=False)
+                    is_active = state is not None and state.is_open()
+                    rows, has_more = _fetch_messages(
+                        db, session_token, anchor=anchor, limit=page_size, include_archive=not is_active
+                    )
+
+                for message in rows:
+                    anchor = (message.created_at, message.id)
+                    data = current_app.json.dumps(_serialize_message(message))
+                    yield f"id: {encode_cursor(*anchor)}\nevent: message\ndata: {data}\n\n"
+
+                if has_more:
+                    continue
+                if not is_active:
+                    yield "event: ended\ndata: {}\n\n"
+                    return
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return
+                if not subscription.wait(min(heartbeat, remaining)):
+                    yield ": keep-alive\n\n"
+        finally:
+            OPEN_STREAMS.dec()
+            subscription.close()
+
+    current_app.logger.debug(
+        "Stream de mensagens aberto",
         extra={
-            "event": "message.player.stored",
+            "event": "messages.stream.opened",
             "session_token": session_token,
-            "player": player,
         },
     )
 
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.call_on_close(release_stream)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@api_bp.post("/messages")
+def send_message():
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key is None:
+        return _send_message()
+    return _send_message_once(idempotency_key.strip())
+
+
+def _send_message_once(key: str):
+    """Run ``_send_message`` at most once per ``Idempotency-Key`` and session.
+
+    A duplicate of a finished request gets the stored response back; one
+    arriving while the first is still running waits for it (in any worker,
+    for at most ``IDEMPOTENCY_WAIT_SECONDS``, then 409 with ``Retry-After``)
+    instead of dispatching again. Only 2xx outcomes are kept: a failed
+    request releases the key so the client's retry runs for real.
+    """
+    if not key or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+        abort(400, "Idempotency-Key invalida")
+    payload = request.get_json(silent=True) or {}
+    session_token = payload.get("session_token")
+    if not session_token or not isinstance(session_token, str):
+        abort(400, "session_token eh obrigatorio")
+
+    config = current_app.config
+    fingerprint = request_fingerprint(payload)
+    claimed = False
+    for _ in range(3):
+        with session_scope(session_identifier=session_token) as db:
+            claimed = claim_key(
+                db, session_token, key, fingerprint, config["IDEMPOTENCY_LEASE_SECONDS"], config["IDEMPOTENCY_TTL_SECONDS"]
+            )
+            stored = None if claimed else load_key(db, session_token, key)
+        if claimed:
+            break
+        if stored is not None and not stored.completed and stored.request_hash == fingerprint:
+            current_app.logger.info(
+                "Aguardando requisicao idempotente em andamento",
+                extra={"event": "idempotency.wait", "session_token": session_token},
+            )
+            # Short, so duplicates cannot pin worker threads for the owner's whole lease.
+            stored = wait_for_key(
+                session_token, key, config["IDEMPOTENCY_WAIT_SECONDS"], config["IDEMPOTENCY_POLL_SECONDS"]
+            )
+        if stored is None:
+            continue  # the owner failed and released the key: try to run it ourselves
+        if stored.request_hash != fingerprint:
+            abort(422, "Idempotency-Key ja usada com outro conteudo")
+        if not stored.completed:
+            break
+        response = current_app.response_class(stored.body, status=stored.status_code, mimetype="application/json")
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+    if not claimed:
+        response = jsonify({"error": "Conflict", "message": "Requisicao com esta Idempotency-Key ainda em andamento"})
+        response.headers["Retry-After"] = "1"
+        return response, 409
+
+    try:
+        response = current_app.make_response(_send_message())
+    except BaseException:
+        with session_scope(session_identifier=session_token) as db:
+            release_key(db, session_token, key)
+        raise
+
+    with session_scope(session_identifier=session_token) as db:
+        if 200 <= response.status_code < 300:
+            complete_key(db, session_token, key, response.status_code, response.get_data(as_text=True))
+        else:
+            release_key(db, session_token, key)
+    return response
+
+
+def _backend_reply(session_token: str, player: str, message_text: str) -> str:
+    """Dispatch to the backend and return its reply, aborting with 502 on failure or an unusable answer."""
     start = monotonic()
     try:
         backend_response = dispatch_to_backend(session_token, player, message_text)
@@ -201,28 +473,206 @@ def send_message():
             "duration_ms": round(duration * 1000, 2),
         },
     )
+    return backend_message
 
-    received_at = datetime.now(timezone.utc)
 
-    with session_scope(session_identifier=session_token) as db:
-        chat_session = _load_session(db, session_token)
-        if chat_session is None:
-            abort(404, "Sessao nao encontrada")
-        if chat_session.player_id != player:
-            abort(403, "Player nao autorizado para esta sessao")
-
-        incoming = Message(
-            session_token=session_token,
-            sender=Sender.VALEZAP,
-            content=backend_message,
-            created_at=received_at,
+def _coalesced(session_token: str, player: str, player_payload: dict):
+    current_app.logger.info(
+        "Mensagem agrupada a um envio pendente",
+        extra={"event": "message.coalesced", "session_token": session_token, "player": player},
+    )
+    return jsonify({"player_message": player_payload, "status": "coalesced", "ended": False}), 202
+
+
+def _dispatch_coalesced(session_token: str, player: str, outbox_id: int, player_payload: dict, window: float):
+    """Send this message upstream together with the session's others from the next ``window`` seconds.
+
+    The request that opened the batch waits out the window, claims every
+    pending outbox row of the session (written by any worker) and makes one
+    backend call with their contents; the reply is stored once and returned
+    here. Requests whose row another one claimed answer ``202`` right away
+    and the reply reaches the player through the stream.
+    """
+    config = current_app.config
+    started = monotonic()
+    sleep(window)
+    deadline = started + window + config["REMOTE_WEBHOOK_TIMEOUT"]
+    subscription = get_broker().subscribe(session_token)
+    try:
+        while True:
+            with session_scope() as db:
+                entry = claim_session(db, session_token, config["OUTBOX_LEASE_SECONDS"], config["COALESCE_MAX_MESSAGES"])
+                waiting = entry is None and is_pending(db, outbox_id)
+            if entry is not None:
+                reply_payload, ended = _dispatch_claimed(entry, outbox_id)
+                if outbox_id in entry.entry_ids:
+                    break
+                continue
+            if not waiting:
+                return _coalesced(session_token, player, player_payload)
+            # An earlier batch of the session is still in flight: its reply wakes us up.
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return jsonify({"player_message": player_payload, "status": "queued", "ended": False}), 202
+            subscription.wait(min(config["OUTBOX_POLL_SECONDS"], remaining))
+    finally:
+        subscription.close()
+
+    response_payload = {
+        "player_message": player_payload,
+        "valezap_message": reply_payload,
+        "ended": ended,
+        "coalesced": len(entry.entry_ids),
+    }
+    return jsonify(response_payload), 201
+
+
+def _dispatch_claimed(entry: ClaimedEntry, own_id: int) -> tuple[dict, bool]:
+    """One backend call for a claimed (possibly coalesced) outbox entry; stores the reply once.
+
+    On failure only this request's client hears about it (and may send
+    again), so only its own row ``own_id`` fails for good; the rows of the
+    requests that joined the batch, already answered ``202``, go back to the
+    dispatcher for a retry.
+    """
+    try:
+        backend_message = _backend_reply(entry.session_token, entry.player_id, entry.content)
+    except HTTPException as exc:
+        error = str(exc.description)
+        if own_id in entry.entry_ids:
+            reschedule_entry(replace(entry, id=own_id, ids=(own_id,)), error, retry=False)
+        joined = tuple(entry_id for entry_id in entry.entry_ids if entry_id != own_id)
+        if joined:
+            reschedule_entry(replace(entry, id=joined[0], ids=joined), error)
+        raise
+
+    received_at = datetime.now(timezone.utc)
+    with session_scope(session_identifier=entry.session_token) as db:
+        reply_id, ended = record_backend_reply(
+            db, entry.session_token, backend_message, received_at, player_id=entry.player_id
         )
-        db.add(incoming)
+        if reply_id is None:
+            _reject_session(db, entry.session_token, entry.player_id)
+        complete_entry(db, entry, received_at)
+    current_app.logger.info(
+        "Mensagens agrupadas enviadas ao backend",
+        extra={
+            "event": "message.coalesced.dispatched",
+            "session_token": entry.session_token,
+            "player": entry.player_id,
+            "coalesced": len(entry.entry_ids),
+            "ended": ended,
+        },
+    )
+    reply_payload = {
+        "id": reply_id,
+        "sender": Sender.VALEZAP.value,
+        "content": backend_message,
+        "created_at": received_at.isoformat(),
+    }
+    return reply_payload, ended
+
+
+def _send_message():
+    payload = request.get_json(silent=True) or {}
+    session_token = payload.get("session_token")
+    player = normalise_player(payload.get("player"))
+
+    if not session_token:
+        abort(400, "session_token eh obrigatorio")
+    if not player:
+        abort(400, "player invalido")
+
+    try:
+        message_text = validate_message(payload.get("message"))
+    except ValueError as exc:
+        abort(400, str(exc))
+
+    cached_state = get_session_cache().get(session_token)
+    if cached_state is not None:
+        # Ownership never changes and an ended session never reopens: reject without touching the DB.
+        _check_session_state(cached_state, player)
+
+    check_rate_limits(player, session_token)
+    config = current_app.config
+    async_dispatch = config["ASYNC_DISPATCH"]
+    coalesce_window = config["COALESCE_WINDOW_SECONDS"]
+    if not async_dispatch:
+        # Before storing anything: a shed request leaves no unanswered message behind.
+        reserve_dispatch_slot()
+    # The outbox row must commit with the player message, so async and coalescing modes never buffer.
+    write_buffer = None if async_dispatch or coalesce_window > 0 else get_write_buffer()
+    sent_at = datetime.now(timezone.utc)
+    player_payload = {
+        "sender": Sender.PLAYER.value,
+        "content": message_text,
+        "created_at": sent_at.isoformat(),
+    }
+
+    if write_buffer is not None:
+        state = cached_state
+        if state is None:
+            with session_scope(session_identifier=session_token) as db:
+                state = load_session_state(db, session_token)
+        _check_session_state(state, player)
+        stored = write_buffer.write(PendingMessage(session_token, player, Sender.PLAYER, message_text))
+        if stored is None:
+            with session_scope(session_identifier=session_token) as db:
+                _reject_session(db, session_token, player)
+        player_payload["id"], sent_at = stored
+        player_payload["created_at"] = sent_at.isoformat()
+    else:
+        with session_scope(session_identifier=session_token) as db:
+            message_id = record_player_message(db, session_token, player, message_text, sent_at)
+            if message_id is None:
+                _reject_session(db, session_token, player)
+            player_payload["id"] = message_id
+            if async_dispatch:
+                enqueue_dispatch(db, session_token, player, message_text, delay_seconds=coalesce_window)
+            elif coalesce_window > 0:
+                # Kept from the dispatcher unless this request dies before dispatching it.
+                outbox_id = enqueue_dispatch(
+                    db, session_token, player, message_text, delay_seconds=coalesce_window + config["OUTBOX_LEASE_SECONDS"]
+                )
+                joins_batch = has_pending_before(db, session_token, outbox_id)
+                if joins_batch:
+                    # Answered 202 now: should the batch be claimed before this commits, the dispatcher
+                    # sends the row once the window is over instead of after the opener's lease.
+                    hand_over(db, outbox_id, coalesce_window)
+
+    current_app.logger.info(
+        "Mensagem do player registrada",
+        extra={
+            "event": "message.player.stored",
+            "session_token": session_token,
+            "player": player,
+            "queued": async_dispatch,
+        },
+    )
+
+    if async_dispatch:
+        return jsonify({"player_message": player_payload, "status": "queued", "ended": False}), 202
+    if coalesce_window > 0:
+        if joins_batch:
+            return _coalesced(session_token, player, player_payload)
+        return _dispatch_coalesced(session_token, player, outbox_id, player_payload, coalesce_window)
+
+    backend_message = _backend_reply(session_token, player, message_text)
+
+    received_at = datetime.now(timezone.utc)
 
+    if write_buffer is not None:
+        stored = write_buffer.write(PendingMessage(session_token, player, Sender.VALEZAP, backend_message))
+        if stored is None:
+            with session_scope(session_identifier=session_token) as db:
+                _reject_session(db, session_token, player)
+        reply_id, received_at = stored
         ended = is_end_of_conversation(backend_message)
-        if ended:
-            chat_session.is_active = False
-            chat_session.ended_at = received_at
+    else:
+        with session_scope(session_identifier=session_token) as db:
+            reply_id, ended = record_backend_reply(db, session_token, backend_message, received_at, player_id=player)
+            if reply_id is None:
+                _reject_session(db, session_token, player)
     if ended:
         current_app.logger.info(
             "Sessao encerrada pelo backend",
@@ -234,6 +684,7 @@ def send_message():
         )
 
     valezap_payload = {
+        "id": reply_id,
         "sender": Sender.VALEZAP.value,
         "content": backend_message,
         "created_at": received_at.isoformat(),
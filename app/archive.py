@@ -0,0 +1,221 @@
+﻿from __future__ import annotations
+
+import gzip
+import json
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from typing import NamedTuple
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from .database import role_bypasses_rls, session_scope
+from .models import ChatSession, Message, MessageArchive, Sender
+
+_PARTITIONS = text(
+    r"""
+    SELECT c.relname,
+           (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''(.*)''\)'))[1]::timestamptz AS upper_bound
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'messages'::regclass
+    ORDER BY upper_bound NULLS LAST
+    """
+)
+
+
+class ArchivedMessage(NamedTuple):
+    """Same shape as the column rows ``api._fetch_messages`` reads from ``messages``."""
+
+    id: int
+    sender: Sender
+    content: str
+    created_at: datetime
+
+
+def pack_messages(messages: list[tuple[int, Sender, str, datetime]]) -> bytes:
+    """Serialise ``(id, sender, content, created_at)`` tuples as gzip-compressed JSON."""
+    data = [[message_id, sender.name, content, created_at.isoformat()] for message_id, sender, content, created_at in messages]
+    return gzip.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def unpack_messages(payload: bytes) -> list[ArchivedMessage]:
+    data = json.loads(gzip.decompress(payload))
+    return [
+        ArchivedMessage(message_id, Sender[sender], content, datetime.fromisoformat(created_at))
+        for message_id, sender, content, created_at in data
+    ]
+
+
+def select_after(
+    messages: list[tuple[int, Sender, str, datetime]],
+    anchor: tuple[datetime, int] | None = None,
+    since: datetime | None = None,
+) -> list[tuple[int, Sender, str, datetime]]:
+    """Apply the same keyset/``since`` filter as the live query to archived messages."""
+    if anchor is not None:
+        return [message for message in messages if (message[3], message[0]) > anchor]
+    if since is not None:
+        return [message for message in messages if message[3] > since]
+    return messages
+
+
+def load_archived_messages(
+    db,
+    session_token: str,
+    anchor: tuple[datetime, int] | None = None,
+    since: datetime | None = None,
+) -> list[ArchivedMessage]:
+    """Return archived messages of a session, oldest first."""
+    payload = db.execute(
+        select(MessageArchive.payload).where(MessageArchive.session_token == session_token)
+    ).scalar_one_or_none()
+    if payload is None:
+        return []
+    return select_after(unpack_messages(payload), anchor, since)
+
+
+def ensure_partitions(db, months_ahead: int) -> list[str]:
+    """Create the monthly partitions from the current month up to ``months_ahead``."""
+    created = []
+    now = datetime.now(timezone.utc)
+    for offset in range(months_ahead + 1):
+        name = db.execute(
+            text("SELECT ensure_messages_partition(:at + make_interval(months => :offset))"),
+            {"at": now, "offset": offset},
+        ).scalar_one()
+        if name:
+            created.append(name)
+    return created
+
+
+def archive_ended_sessions(db, cutoff: datetime, limit: int) -> tuple[int, int]:
+    """Move the messages of up to ``limit`` sessions ended before ``cutoff`` into ``messages_archive``.
+
+    Sessions are locked with ``SKIP LOCKED`` so concurrent runs split the work.
+    Messages that arrive after a session was archived are merged into its
+    archive row on a later run. Returns ``(sessions, messages)`` archived.
+    """
+    has_messages = select(Message.id).where(Message.session_token == ChatSession.session_token).exists()
+    candidates = (
+        select(ChatSession.session_token)
+        .where(ChatSession.is_active.is_(False), ChatSession.ended_at < cutoff, has_messages)
+        .order_by(ChatSession.ended_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    tokens = db.execute(candidates).scalars().all()
+    if not tokens:
+        return 0, 0
+
+    rows = db.execute(
+        select(Message.session_token, Message.id, Message.sender, Message.content, Message.created_at)
+        .where(Message.session_token.in_(tokens))
+        .order_by(Message.session_token, Message.created_at, Message.id)
+    ).all()
+    previous = dict(
+        db.execute(
+            select(MessageArchive.session_token, MessageArchive.payload).where(MessageArchive.session_token.in_(tokens))
+        ).all()
+    )
+
+    archived_ids = []
+    for session_token, group in groupby(rows, key=lambda row: row.session_token):
+        live = [(row.id, row.sender, row.content, row.created_at) for row in group]
+        archived_ids.extend(message[0] for message in live)
+        messages = sorted(
+            [*(unpack_messages(previous[session_token]) if session_token in previous else []), *live],
+            key=lambda message: (message[3], message[0]),
+        )
+        values = {
+            "message_count": len(messages),
+            "first_message_at": messages[0][3],
+            "last_message_at": messages[-1][3],
+            "payload": pack_messages(messages),
+            "archived_at": datetime.now(timezone.utc),
+        }
+        stmt = insert(MessageArchive).values(session_token=session_token, **values)
+        db.execute(stmt.on_conflict_do_update(index_elements=[MessageArchive.session_token], set_=values))
+
+    # Only what was read is deleted: a message stored meanwhile waits for the next run.
+    db.execute(
+        delete(Message)
+        .where(Message.session_token.in_(tokens), Message.id.in_(archived_ids))
+        .execution_options(synchronize_session=False)
+    )
+    return len(tokens), len(archived_ids)
+
+
+def old_partitions(db, cutoff: datetime) -> list[str]:
+    """Partitions whose whole range is older than ``cutoff`` (never ``messages_default``)."""
+    return [name for name, upper_bound in db.execute(_PARTITIONS) if upper_bound is not None and upper_bound <= cutoff]
+
+
+def detach_partition_if_empty(db, name: str) -> bool:
+    """Detach and drop ``name`` when no rows are left in it; returns whether it was dropped."""
+    quoted = db.get_bind().dialect.identifier_preparer.quote(name)
+    if db.execute(text(f"SELECT EXISTS (SELECT 1 FROM {quoted})")).scalar_one():
+        return False
+    db.execute(text(f"ALTER TABLE messages DETACH PARTITION {quoted}"))
+    db.execute(text(f"DROP TABLE {quoted}"))
+    return True
+
+
+@click.command("archive-messages")
+@click.option(
+    "--older-than-days",
+    type=int,
+    default=None,
+    help="Arquiva sessoes encerradas ha mais dias que isso (default: VALEZAP_ARCHIVE_AFTER_DAYS).",
+)
+@click.option("--batch-size", type=int, default=None, help="Sessoes por transacao (default: VALEZAP_ARCHIVE_BATCH_SIZE).")
+@click.option("--months-ahead", type=int, default=2, show_default=True, help="Particoes futuras a criar.")
+@with_appcontext
+def archive_messages_command(older_than_days: int | None, batch_size: int | None, months_ahead: int) -> None:
+    """Create upcoming partitions, archive ended sessions and drop emptied old partitions."""
+    config = current_app.config
+    logger = current_app.logger
+    days = config["ARCHIVE_AFTER_DAYS"] if older_than_days is None else older_than_days
+    limit = batch_size or config["ARCHIVE_BATCH_SIZE"]
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+
+    with session_scope() as db:
+        # Under RLS every table looks empty and partitions would be dropped with data in them.
+        if not role_bypasses_rls(db):
+            raise click.ClickException("archive-messages precisa de um papel superuser ou BYPASSRLS")
+        ensured = ensure_partitions(db, months_ahead)
+
+    sessions_total = messages_total = 0
+    while True:
+        with session_scope() as db:
+            sessions, messages = archive_ended_sessions(db, cutoff, limit)
+        sessions_total += sessions
+        messages_total += messages
+        if sessions < limit:
+            break
+
+    with session_scope() as db:
+        candidates = old_partitions(db, cutoff)
+    dropped, kept = [], []
+    for name in candidates:
+        with session_scope() as db:
+            (dropped if detach_partition_if_empty(db, name) else kept).append(name)
+
+    logger.info(
+        "Manutencao de mensagens concluida",
+        extra={
+            "event": "messages.archive.done",
+            "partitions_ensured": ensured,
+            "sessions_archived": sessions_total,
+            "messages_archived": messages_total,
+            "partitions_dropped": dropped,
+            "partitions_kept": kept,
+        },
+    )
+    click.echo(
+        f"{sessions_total} sessoes ({messages_total} mensagens) arquivadas; "
+        f"particoes removidas: {', '.join(dropped) or '-'}; mantidas com dados: {', '.join(kept) or '-'}"
+    )
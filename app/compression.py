@@ -0,0 +1,67 @@
+﻿from __future__ import annotations
+
+import gzip
+
+from flask import Request, Response
+
+try:  # pragma: no cover - optional dependency
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = frozenset(
+    {
+        "application/json",
+        "application/javascript",
+        "text/css",
+        "text/html",
+        "text/javascript",
+        "text/plain",
+    }
+)
+
+
+def choose_encoding(request: Request) -> str | None:
+    """Pick ``br`` (when available) or ``gzip`` from ``Accept-Encoding``, honouring ``q=0``."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"] > 0:
+        return "br"
+    if accepted["gzip"] > 0:
+        return "gzip"
+    return None
+
+
+def compress_response(response: Response, request: Request, min_size: int, level: int) -> Response:
+    """Compress a buffered response body in place when it is worth it.
+
+    Streams (SSE), files served with ``direct_passthrough``, already encoded
+    bodies and anything smaller than ``min_size`` bytes are left alone.
+    """
+    if min_size <= 0 or response.status_code != 200:
+        return response
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or "Content-Encoding" in response.headers:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+
+    if encoding == "br":
+        compressed = brotli.compress(body, quality=min(max(level, 0), 11))
+    else:
+        compressed = gzip.compress(body, compresslevel=min(max(level, 1), 9))
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    # A strong validator would now describe the wrong bytes.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
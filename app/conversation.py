@@ -0,0 +1,166 @@
+﻿from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, column, func, insert, literal, or_, select, true, update, values
+
+from .events import publish_message, publish_session_ended
+from .models import ChatSession, Message, Sender
+from .security import is_end_of_conversation
+
+_MESSAGE_COLUMNS = ("session_token", "sender", "content", "created_at")
+
+
+def _incoming_rows(entries: list[tuple[str, datetime]]):
+    return values(
+        column("content", Message.content.type),
+        column("created_at", Message.created_at.type),
+        name="incoming",
+    ).data(entries)
+
+
+def _insert_messages(db, sender: Sender, entries: list[tuple[str, datetime]], conditions, ended_at=None) -> dict:
+    """Insert ``entries`` for the session matching ``conditions`` in one statement.
+
+    The session row is updated by the same statement (``WITH touched AS
+    (UPDATE ...) INSERT ...``): its activity columns (``message_count``,
+    ``last_message_at``, ``last_sender``) always, and when ``ended_at`` is
+    given the session is closed too. Returns ``{created_at: id}`` for the
+    inserted rows, empty when no session matched.
+    """
+    sessions = ChatSession.__table__
+    rows = _incoming_rows(entries)
+    newest = max(created_at for _, created_at in entries)
+    changes = {
+        "message_count": sessions.c.message_count + len(entries),
+        # Buffered writes may land out of order: only a newer message moves the marker.
+        "last_message_at": func.greatest(sessions.c.last_message_at, newest),
+        "last_sender": case(
+            (
+                or_(sessions.c.last_message_at.is_(None), sessions.c.last_message_at <= newest),
+                literal(sender, sessions.c.last_sender.type),
+            ),
+            else_=sessions.c.last_sender,
+        ),
+    }
+    if ended_at is not None:
+        changes.update(is_active=False, ended_at=ended_at)
+    touched = (
+        update(sessions)
+        .where(*conditions)
+        .values(**changes)
+        .returning(sessions.c.session_token)
+        .cte("touched")
+    )
+
+    select_rows = (
+        select(
+            touched.c.session_token,
+            literal(sender, Message.sender.type),
+            rows.c.content,
+            rows.c.created_at,
+        )
+        .select_from(touched)
+        .join(rows, true())
+        .order_by(rows.c.created_at)
+    )
+
+    messages = Message.__table__
+    stmt = (
+        insert(messages)
+        .from_select(_MESSAGE_COLUMNS, select_rows)
+        .add_cte(touched)
+        .returning(messages.c.id, messages.c.created_at)
+    )
+    return {created_at: message_id for message_id, created_at in db.execute(stmt)}
+
+
+def record_player_message(db, session_token: str, player_id: str, content: str, sent_at: datetime) -> int | None:
+    """Insert a player message only if the session is open and owned by ``player_id``.
+
+    Ownership, activity and the insert happen in one ``INSERT ... SELECT``
+    statement. Returns the new message id, or ``None`` when the session is
+    missing, belongs to someone else, has ended or has expired.
+    """
+    message_ids = record_player_messages(db, session_token, player_id, [(content, sent_at)])
+    return message_ids[0] if message_ids is not None else None
+
+
+def record_player_messages(
+    db,
+    session_token: str,
+    player_id: str,
+    entries: list[tuple[str, datetime]],
+) -> list[int] | None:
+    """Insert several ``(content, sent_at)`` player messages with one statement.
+
+    ``sent_at`` values must be distinct. Returns the ids in input order, or
+    ``None`` when the session is missing, foreign, ended or expired.
+    """
+    sessions = ChatSession.__table__
+    conditions = [
+        sessions.c.session_token == session_token,
+        sessions.c.player_id == player_id,
+        sessions.c.is_active.is_(True),
+        or_(sessions.c.expires_at.is_(None), sessions.c.expires_at > func.now()),
+    ]
+    inserted = _insert_messages(db, Sender.PLAYER, entries, conditions)
+    if not inserted:
+        return None
+    publish_message(db, session_token)
+    return [inserted[sent_at] for _, sent_at in entries]
+
+
+def record_backend_reply(
+    db,
+    session_token: str,
+    content: str,
+    received_at: datetime,
+    player_id: str | None = None,
+) -> tuple[int | None, bool]:
+    """Store a ValeZap message and close the session when it ends the conversation.
+
+    Returns ``(message_id, ended)``; ``message_id`` is ``None`` when no session
+    matches ``session_token`` (and ``player_id``, if given).
+    """
+    message_ids, ended = record_backend_replies(db, session_token, [(content, received_at)], player_id=player_id)
+    if message_ids is None:
+        return None, False
+    return message_ids[0], ended
+
+
+def spread_timestamps(contents: list[str], received_at: datetime) -> list[tuple[str, datetime]]:
+    """Pair ``contents`` with strictly increasing timestamps, one microsecond apart."""
+    return [(content, received_at + timedelta(microseconds=index)) for index, content in enumerate(contents)]
+
+
+def record_backend_replies(
+    db,
+    session_token: str,
+    entries: list[tuple[str, datetime]],
+    player_id: str | None = None,
+) -> tuple[list[int] | None, bool]:
+    """Store several ``(content, created_at)`` ValeZap messages with one statement.
+
+    ``created_at`` values must be distinct (see ``spread_timestamps``) so the
+    messages keep their order in the history. When one of them ends the
+    conversation, the session update runs in the same statement.
+    Returns ``(message_ids, ended)`` in input order; ``message_ids`` is ``None``
+    when no session matches ``session_token`` (and ``player_id``, if given).
+    """
+    sessions = ChatSession.__table__
+    conditions = [sessions.c.session_token == session_token]
+    if player_id is not None:
+        conditions.append(sessions.c.player_id == player_id)
+
+    ended_at = next(
+        (created_at for content, created_at in entries if is_end_of_conversation(content)),
+        None,
+    )
+    inserted = _insert_messages(db, Sender.VALEZAP, entries, conditions, ended_at=ended_at)
+    if not inserted:
+        return None, False
+    publish_message(db, session_token)
+    if ended_at is not None:
+        publish_session_ended(db, session_token)
+    return [inserted[created_at] for _, created_at in entries], ended_at is not None
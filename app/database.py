@@ -1,16 +1,51 @@
 ﻿from __future__ import annotations
 
+import itertools
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
+from time import perf_counter
 from typing import Iterator
 
 from flask import Flask
+
+try:
+    import psycopg
+    from psycopg import pq, sql
+except ImportError:  # pragma: no cover - other drivers fall back to a plain set_config
+    psycopg = None
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from .metrics import DB_READS, observe_pool_checkout
+from .timing import record, timed
+
+logger = logging.getLogger(__name__)
 
 _engine: Engine | None = None
 _SessionFactory: scoped_session | None = None
 
+RLS_SETTING = "app.current_session_id"
+
+
+class TimedQueuePool(QueuePool):
+    """``QueuePool`` that reports how long each checkout took to get a connection."""
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = perf_counter() - started
+            observe_pool_checkout(waited)
+            record("pool", waited)
+
 
 def init_engine(app: Flask) -> None:
     """Initialise the SQLAlchemy engine and scoped session."""
@@ -20,7 +55,9 @@ def init_engine(app: Flask) -> None:
         return
 
     database_url = app.config["DATABASE_URL"]
-    _engine = create_engine(database_url, future=True, pool_pre_ping=True)
+    _engine = create_engine(
+        database_url, future=True, pool_pre_ping=True, poolclass=TimedQueuePool, **pool_options(app.config)
+    )
     _SessionFactory = scoped_session(
         sessionmaker(bind=_engine, autoflush=False, autocommit=False, expire_on_commit=False)
     )
@@ -31,12 +68,75 @@ def init_engine(app: Flask) -> None:
             _SessionFactory.remove()
 
 
+def pool_options(config) -> dict:
+    """Pool sizing for one worker process.
+
+    Each request thread holds at most one connection, so ``DB_POOL_SIZE``
+    defaults to the worker's ``WORKER_THREADS`` plus one for the background
+    threads (write buffer, metrics collector). A worker then keeps at most
+    ``pool_size + DB_MAX_OVERFLOW`` connections, and the whole instance
+    ``workers`` times that.
+    """
+    pool_size = config.get("DB_POOL_SIZE") or (config.get("WORKER_THREADS") or 4) + 1
+    return {
+        "pool_size": pool_size,
+        "max_overflow": config.get("DB_MAX_OVERFLOW", 2),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT", 10),
+    }
+
+
 def get_engine() -> Engine:
     if _engine is None:
         raise RuntimeError("Database engine has not been initialized")
     return _engine
 
 
+def all_engines() -> list[Engine]:
+    """The primary engine followed by the replica engines."""
+    return [engine for engine in (_engine, *(replica.engine for replica in _replicas)) if engine is not None]
+
+
+def reset_pools_after_fork() -> None:
+    """Give a freshly forked worker its own, empty connection pools.
+
+    ``dispose(close=False)`` drops the pools inherited from the preloaded
+    master without closing their connections, which still belong to the
+    parent: closing a shared socket from the child would break it for both.
+    """
+    for engine in all_engines():
+        engine.dispose(close=False)
+    if _SessionFactory is not None:
+        _SessionFactory.remove()
+
+
+def warm_up_pools(connections: int) -> dict[str, int]:
+    """Open up to ``connections`` connections on every engine and return them to the pool.
+
+    The connections are held together so the pool really grows to that
+    size, then stay idle in it for the first requests. Failures are logged
+    and left to ``pool_pre_ping`` and the replica fallback at request time.
+    """
+    opened: dict[str, int] = {}
+    for engine in all_engines():
+        name = engine.url.render_as_string(hide_password=True)
+        held = []
+        try:
+            for _ in range(min(connections, engine.pool.size())):
+                connection = engine.connect()
+                held.append(connection)
+                connection.exec_driver_sql("SELECT 1")
+        except DBAPIError as exc:
+            logger.warning(
+                "Falha ao aquecer o pool de conexoes",
+                extra={"event": "db.warmup.error", "database": name, "error": str(exc.orig)},
+            )
+        finally:
+            for connection in held:
+                connection.close()
+        opened[name] = len(held)
+    return opened
+
+
 @contextmanager
 def session_scope(session_identifier: str | None = None) -> Iterator:
     """Provide a transactional scope around a series of operations."""
@@ -45,14 +145,275 @@ def session_scope(session_identifier: str | None = None) -> Iterator:
 
     session = _SessionFactory()
     try:
-        if session_identifier:
-            session.execute(text("SELECT set_config('app.current_session_id', :session_id, true)"), {"session_id": session_identifier})
-        else:
-            session.execute(text("SELECT set_config('app.current_session_id', NULL, true)"))
+        _set_rls_context(session, session_identifier or None)
         yield session
-        session.commit()
+        with timed("commit"):
+            session.commit()
     except Exception:
         session.rollback()
         raise
     finally:
         session.close()
+
+
+class PrimaryPins:
+    """Sessions whose reads must go to the primary for a while after a write.
+
+    Fed by the broker: every worker hears about each new message or ended
+    session (LISTEN/NOTIFY), and the writing worker itself at commit. Bounded
+    to ``max_entries`` tokens, oldest pins dropped first.
+    """
+
+    def __init__(self, window: float, max_entries: int = 50000) -> None:
+        self.window = window
+        self.max_entries = max_entries
+        self._until: OrderedDict[str, float] = OrderedDict()
+        self._all_until = 0.0
+        self._lock = threading.Lock()
+
+    def pin(self, session_token: str | None) -> None:
+        """Pin ``session_token``; ``None`` (events may have been lost) pins every session."""
+        until = time.monotonic() + self.window
+        with self._lock:
+            if session_token is None:
+                self._all_until = until
+                return
+            self._until.pop(session_token, None)
+            self._until[session_token] = until
+            while len(self._until) > self.max_entries:
+                self._until.popitem(last=False)
+
+    def is_pinned(self, session_token: str | None) -> bool:
+        now = time.monotonic()
+        if now < self._all_until:
+            return True
+        if session_token is None:
+            return False
+        with self._lock:
+            until = self._until.get(session_token)
+            if until is None:
+                return False
+            if until <= now:
+                del self._until[session_token]
+                return False
+            return True
+
+
+# Seconds the replica is behind; 0 when it has replayed everything the primary had written at
+# ``:primary_lsn`` (or is not a standby). What it merely received does not count: with the WAL
+# receiver disconnected, receive and replay positions match while the primary moves on.
+# NULL when behind with no replayed transaction to date the lag.
+_REPLICA_LAG = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_replay_lsn() >= CAST(:primary_lsn AS pg_lsn) THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+)
+_PRIMARY_LSN = text("SELECT CAST(pg_current_wal_lsn() AS text)")
+
+
+class Replica:
+    """One read replica: its engine, and whether it is reachable and current enough."""
+
+    def __init__(
+        self, url: str, max_lag: float, lag_check_interval: float, retry_after: float, pool: dict | None = None
+    ) -> None:
+        self.engine = create_engine(url, future=True, pool_pre_ping=True, poolclass=TimedQueuePool, **(pool or {}))
+        self.name = self.engine.url.render_as_string(hide_password=True)
+        self._factory = sessionmaker(bind=self.engine, autoflush=False, autocommit=False, expire_on_commit=False)
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.retry_after = retry_after
+        self.lag = 0.0
+        self._lag_checked_at = float("-inf")
+        self._down_until = 0.0
+
+    def open(self, session_identifier: str | None):
+        """Start a transaction on the replica, or return ``None`` when it should not serve reads."""
+        now = time.monotonic()
+        if now < self._down_until:
+            return None
+        lag_is_stale = now - self._lag_checked_at >= self.lag_check_interval
+        if not lag_is_stale and self.lag > self.max_lag:
+            return None
+
+        # Read before the replica, so every commit acknowledged so far has to be replayed.
+        primary_lsn = _primary_wal_lsn() if lag_is_stale else None
+        session = self._factory()
+        session.info["replica"] = self.name
+        try:
+            _set_rls_context(session, session_identifier)
+            if lag_is_stale:
+                lag = session.execute(_REPLICA_LAG, {"primary_lsn": primary_lsn}).scalar_one()
+                self._record_lag(float("inf") if lag is None else float(lag), now)
+        except DBAPIError as exc:
+            session.close()
+            self._down_until = now + self.retry_after
+            logger.warning(
+                "Replica indisponivel, lendo do primario",
+                extra={"event": "db.replica.down", "replica": self.name, "error": str(exc.orig)},
+            )
+            return None
+        if self.lag > self.max_lag:
+            session.close()
+            return None
+        return session
+
+    def _record_lag(self, lag: float, now: float) -> None:
+        if (lag > self.max_lag) != (self.lag > self.max_lag):
+            logger.warning(
+                "Replica atrasada, lendo do primario" if lag > self.max_lag else "Replica em dia novamente",
+                extra={"event": "db.replica.lag", "replica": self.name, "lag_seconds": round(lag, 3) if math.isfinite(lag) else None},
+            )
+        self.lag = lag
+        self._lag_checked_at = now
+
+
+def _primary_wal_lsn() -> str:
+    with get_engine().connect() as connection:
+        return connection.execute(_PRIMARY_LSN).scalar_one()
+
+
+_replicas: list[Replica] = []
+_replica_turn = itertools.count()
+_pins: PrimaryPins | None = None
+
+
+def init_read_replicas(app: Flask) -> None:
+    """Create engines for ``DATABASE_REPLICA_URLS`` and pin sessions on the broker's write events.
+
+    Must run after ``init_broker``. Without replica URLs, reads stay on the primary.
+    """
+    global _pins
+
+    urls = app.config.get("DATABASE_REPLICA_URLS") or ()
+    if _replicas or not urls:
+        return
+
+    from .events import get_broker
+
+    _replicas.extend(
+        Replica(
+            url,
+            max_lag=app.config["REPLICA_MAX_LAG_SECONDS"],
+            lag_check_interval=app.config["REPLICA_LAG_CHECK_SECONDS"],
+            retry_after=app.config["REPLICA_RETRY_SECONDS"],
+            pool=pool_options(app.config),
+        )
+        for url in urls
+    )
+    _pins = PrimaryPins(app.config["REPLICA_PIN_SECONDS"])
+    broker = get_broker()
+    broker.on_message(_pins.pin)
+    broker.on_session_ended(_pins.pin)
+
+
+def pin_to_primary(session_token: str) -> None:
+    """Send this worker's reads of ``session_token`` to the primary for ``REPLICA_PIN_SECONDS``."""
+    if _pins is not None:
+        _pins.pin(session_token)
+
+
+def is_replica_session(session) -> bool:
+    return "replica" in session.info
+
+
+@contextmanager
+def read_session_scope(session_identifier: str | None = None) -> Iterator:
+    """Read-only transactional scope: a healthy replica when possible, the primary otherwise.
+
+    The primary serves the read when no replica is configured, when the chat
+    session was written in the last ``REPLICA_PIN_SECONDS`` (read-your-writes),
+    or when every replica is unreachable or lags more than
+    ``REPLICA_MAX_LAG_SECONDS``.
+    """
+    session = None
+    if _replicas and not _pins.is_pinned(session_identifier):
+        from .events import get_broker
+
+        # Keep this worker hearing about writes made by the others; while it
+        # cannot, pins could be missing and only the primary is safe.
+        broker = get_broker()
+        broker.ensure_listening()
+        if broker.is_listening():
+            start = next(_replica_turn)
+            for offset in range(len(_replicas)):
+                session = _replicas[(start + offset) % len(_replicas)].open(session_identifier)
+                if session is not None:
+                    break
+
+    if session is None:
+        DB_READS.labels(target="primary").inc()
+        with session_scope(session_identifier=session_identifier) as primary:
+            yield primary
+        return
+
+    DB_READS.labels(target="replica").inc()
+    try:
+        yield session
+        with timed("commit"):
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def role_bypasses_rls(session) -> bool:
+    """Whether the connected role ignores the session policies (superuser or BYPASSRLS).
+
+    Maintenance jobs that work across sessions need it: under RLS every table
+    looks empty to them.
+    """
+    stmt = text("SELECT rolsuper OR rolbypassrls FROM pg_roles WHERE rolname = current_user")
+    return session.execute(stmt).scalar_one()
+
+
+def switch_session_identifier(session, session_identifier: str) -> None:
+    """Point the RLS context of an open transaction at another chat session.
+
+    ``set_config(..., true)`` can be called again mid-transaction; later
+    statements are checked against the new value.
+    """
+    _set_rls_context(session, session_identifier)
+
+
+def _set_rls_context(session, session_identifier: str | None) -> None:
+    """Set ``app.current_session_id`` for the transaction the session is starting.
+
+    On psycopg the ``set_config`` call is sent together with the transaction's
+    ``BEGIN`` as one simple-query message, so it costs no round trip of its own.
+    It is still the first thing the transaction runs and still transaction-local,
+    exactly like the standalone ``SELECT set_config(...)`` used as a fallback for
+    other drivers or when the transaction already started.
+    """
+    driver_connection = session.connection().connection.driver_connection
+    if _can_piggyback(driver_connection):
+        value = "NULL" if session_identifier is None else sql.Literal(session_identifier).as_string(driver_connection)
+        command = f"BEGIN; SELECT set_config('{RLS_SETTING}', {value}, true)"
+        pgconn = driver_connection.pgconn
+        # Sent below SQLAlchemy, so the cursor events that time statements never see it.
+        with timed("rls"):
+            result = pgconn.exec_(command.encode(driver_connection.info.encoding))
+        if result.status != pq.ExecStatus.TUPLES_OK:
+            raise psycopg.OperationalError(pgconn.error_message.decode(errors="replace"))
+        return
+
+    if session_identifier:
+        session.execute(text(f"SELECT set_config('{RLS_SETTING}', :session_id, true)"), {"session_id": session_identifier})
+    else:
+        session.execute(text(f"SELECT set_config('{RLS_SETTING}', NULL, true)"))
+
+
+def _can_piggyback(driver_connection) -> bool:
+    if psycopg is None or not isinstance(driver_connection, psycopg.Connection):
+        return False
+    # A plain BEGIN is only equivalent when psycopg would not add transaction characteristics.
+    if driver_connection.autocommit or driver_connection.isolation_level is not None:
+        return False
+    if driver_connection.read_only is not None or driver_connection.deferrable is not None:
+        return False
+    return driver_connection.pgconn.transaction_status == pq.TransactionStatus.IDLE
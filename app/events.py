@@ -0,0 +1,228 @@
+﻿from __future__ import annotations
+
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Callable
+
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_CHANNEL = "valezap_messages"
+SESSION_CHANNEL = "valezap_sessions"
+
+
+class Subscription:
+    """Wake-up handle for a single stream waiting on one chat session."""
+
+    def __init__(self, broker: "MessageBroker", session_token: str) -> None:
+        self.broker = broker
+        self.session_token = session_token
+        self._event = threading.Event()
+
+    def notify(self) -> None:
+        self._event.set()
+
+    def wait(self, timeout: float) -> bool:
+        """Block until a new message is announced or ``timeout`` elapses."""
+        woke = self._event.wait(timeout)
+        self._event.clear()
+        return woke
+
+    def close(self) -> None:
+        self.broker.unsubscribe(self)
+
+
+class MessageBroker(ABC):
+    """Fan-out of "new message in session X" events to the streams of this worker.
+
+    Subclasses decide how events published by one worker reach the others.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self._subscribers: dict[str, set[Subscription]] = defaultdict(set)
+        self._session_ended_handlers: list[Callable[[str | None], None]] = []
+        self._message_handlers: list[Callable[[str], None]] = []
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def publish(self, db, session_token: str) -> None:
+        """Announce a new message in ``session_token`` once ``db`` commits."""
+
+    def publish_session_ended(self, db, session_token: str) -> None:
+        # Local handlers run right after commit; subclasses add cross-worker delivery.
+        event.listen(db, "after_commit", lambda _session: self.deliver_session_ended(session_token), once=True)
+
+    def ensure_listening(self) -> None:
+        """Make sure events from other workers reach this one."""
+
+    def is_listening(self) -> bool:
+        """Whether events from other workers are reaching this one right now."""
+        return True
+
+    def on_message(self, handler: Callable[[str], None]) -> None:
+        """Register ``handler(session_token)``, called for every new message announced."""
+        self._message_handlers.append(handler)
+
+    def deliver_message_handlers(self, session_token: str) -> None:
+        for handler in tuple(self._message_handlers):
+            handler(session_token)
+
+    def on_session_ended(self, handler: Callable[[str | None], None]) -> None:
+        """Register ``handler(session_token)``; ``None`` means "anything may have ended"."""
+        self._session_ended_handlers.append(handler)
+
+    def deliver_session_ended(self, session_token: str | None) -> None:
+        for handler in tuple(self._session_ended_handlers):
+            handler(session_token)
+
+    def subscribe(self, session_token: str) -> Subscription:
+        subscription = Subscription(self, session_token)
+        with self._lock:
+            self._subscribers[session_token].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.session_token)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.session_token]
+
+    def deliver(self, session_token: str) -> None:
+        self.deliver_message_handlers(session_token)
+        with self._lock:
+            subscribers = tuple(self._subscribers.get(session_token, ()))
+        for subscription in subscribers:
+            subscription.notify()
+
+
+class LocalBroker(MessageBroker):
+    """In-process broker, only suitable for a single worker (development, tests)."""
+
+    def publish(self, db, session_token: str) -> None:
+        event.listen(db, "after_commit", lambda _session: self.deliver(session_token), once=True)
+
+
+class PostgresBroker(MessageBroker):
+    """Cross-worker broker built on Postgres ``LISTEN``/``NOTIFY``.
+
+    The ``messages_notify`` trigger (``004_messages_notify_trigger.sql``)
+    issues the ``NOTIFY`` for every inserted message, and ``sessions_notify``
+    (``005_sessions_notify_trigger.sql``) for every session that ends, so
+    publishing costs no extra round trip and Postgres only delivers the event
+    once the row is committed.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        super().__init__(app)
+        url = make_url(app.config["DATABASE_URL"]).set(drivername="postgresql")
+        self._conninfo = url.render_as_string(hide_password=False)
+        self._reconnect_delay = app.config["EVENT_BROKER_RECONNECT_SECONDS"]
+        self._listener: threading.Thread | None = None
+        self._listening = threading.Event()
+
+    def publish(self, db, session_token: str) -> None:
+        # Published to the streams by the messages_notify trigger in the writer's transaction;
+        # handlers in this worker run at commit already, ahead of the notification.
+        if self._message_handlers:
+            event.listen(
+                db, "after_commit", lambda _session: self.deliver_message_handlers(session_token), once=True
+            )
+
+    def subscribe(self, session_token: str) -> Subscription:
+        self.ensure_listening()
+        return super().subscribe(session_token)
+
+    def ensure_listening(self) -> None:
+        # Started lazily so the thread belongs to the gunicorn worker, not the preloaded master.
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(target=self._listen_forever, name="valezap-listener", daemon=True)
+            self._listener.start()
+
+    def is_listening(self) -> bool:
+        return self._listening.is_set()
+
+    def _listen_forever(self) -> None:
+        import psycopg
+
+        while True:
+            try:
+                with psycopg.connect(self._conninfo, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {MESSAGE_CHANNEL}")
+                    conn.execute(f"LISTEN {SESSION_CHANNEL}")
+                    logger.info("Escutando notificacoes de mensagens", extra={"event": "events.listening"})
+                    self._listening.set()
+                    # Anything published before LISTEN took effect is lost.
+                    self.deliver_session_ended(None)
+                    for notification in conn.notifies():
+                        self._handle(notification.channel, notification.payload)
+            except Exception as exc:  # pragma: no cover - depends on a live database
+                logger.warning(
+                    "Conexao LISTEN perdida",
+                    extra={"event": "events.listener.error", "error": str(exc)},
+                )
+            # Ended sessions go unannounced until LISTEN is back: forget them all now.
+            self._listening.clear()
+            self.deliver_session_ended(None)
+            time.sleep(self._reconnect_delay)
+
+    def _handle(self, channel: str, payload: str) -> None:
+        try:
+            session_token = json.loads(payload)["session_token"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Notificacao invalida", extra={"event": "events.invalid", "payload": payload})
+            return
+        if channel == SESSION_CHANNEL:
+            self.deliver_session_ended(session_token)
+        else:
+            self.deliver(session_token)
+
+
+BROKERS: dict[str, type[MessageBroker]] = {
+    "local": LocalBroker,
+    "postgres": PostgresBroker,
+}
+
+_broker: MessageBroker | None = None
+
+
+def init_broker(app: Flask) -> None:
+    """Instantiate the broker selected by ``EVENT_BROKER``."""
+    global _broker
+
+    if _broker is not None:
+        return
+
+    name = app.config["EVENT_BROKER"]
+    try:
+        broker_cls = BROKERS[name]
+    except KeyError as exc:
+        raise RuntimeError(f"EVENT_BROKER desconhecido: {name}") from exc
+    _broker = broker_cls(app)
+
+
+def get_broker() -> MessageBroker:
+    if _broker is None:
+        raise RuntimeError("Message broker has not been initialized")
+    return _broker
+
+
+def publish_message(db, session_token: str) -> None:
+    """Announce a new message for ``session_token`` once ``db`` commits."""
+    get_broker().publish(db, session_token)
+
+
+def publish_session_ended(db, session_token: str) -> None:
+    """Announce that ``session_token`` ended once ``db`` commits."""
+    get_broker().publish_session_ended(db, session_token)
@@ -0,0 +1,269 @@
+﻿from __future__ import annotations
+
+import zlib
+from datetime import datetime, timezone
+from itertools import groupby
+from time import monotonic
+from typing import Iterable, Iterator, NamedTuple
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, null, select, type_coerce, union_all
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.pool import NullPool
+
+from .archive import unpack_messages
+from .config import str_to_bool
+from .database import role_bypasses_rls
+from .models import ChatSession, Message, MessageArchive
+
+# Lines are written in chunks of about this size rather than one at a time.
+CHUNK_BYTES = 64 * 1024
+
+
+class ExportUnavailable(RuntimeError):
+    """No role that bypasses RLS is configured for exports."""
+
+
+class ExportFilters(NamedTuple):
+    created_from: datetime | None = None
+    created_to: datetime | None = None
+    is_active: bool | None = None
+
+
+def parse_filters(created_from: str | None, created_to: str | None, is_active: str | None) -> ExportFilters:
+    """Build filters from ISO-8601 bounds (naive means UTC) and ``true``/``false``; raises ``ValueError``."""
+    if is_active is not None and is_active.strip().lower() not in {"1", "0", "true", "false", "yes", "no", "on", "off"}:
+        raise ValueError("is_active invalido")
+    return ExportFilters(
+        _parse_datetime(created_from, "created_from"),
+        _parse_datetime(created_to, "created_to"),
+        None if is_active is None else str_to_bool(is_active),
+    )
+
+
+def _parse_datetime(value: str | None, name: str) -> datetime | None:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError as exc:
+        raise ValueError(f"{name} invalido") from exc
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+
+_engine: Engine | None = None
+
+
+def open_export(config) -> Connection:
+    """Connect as the ``EXPORT_DATABASE_URL`` role, which must bypass RLS.
+
+    The engine has no pool: exports are rare and long, and an idle
+    connection of a role that sees every session is not worth keeping.
+    """
+    global _engine
+
+    url = config.get("EXPORT_DATABASE_URL")
+    if not url:
+        raise ExportUnavailable("Exportacao desabilitada: defina VALEZAP_EXPORT_DATABASE_URL")
+    if _engine is None:
+        _engine = create_engine(url, future=True, poolclass=NullPool)
+
+    connection = _engine.connect().execution_options(postgresql_readonly=True)
+    try:
+        # Under RLS every table looks empty: an export would silently come out blank.
+        bypasses = role_bypasses_rls(connection)
+        connection.rollback()
+    except Exception:
+        connection.close()
+        raise
+    if not bypasses:
+        connection.close()
+        raise ExportUnavailable("Exportacao precisa de um papel superuser ou BYPASSRLS")
+    return connection
+
+
+def _export_query(filters: ExportFilters):
+    """One row per session (its columns and archive), then one per live message, in export order.
+
+    The session row has no message columns, so it sorts first (``NULLS
+    FIRST``); message rows carry only what a message needs.
+    """
+
+    def _filtered(stmt):
+        if filters.created_from is not None:
+            stmt = stmt.where(ChatSession.created_at >= filters.created_from)
+        if filters.created_to is not None:
+            stmt = stmt.where(ChatSession.created_at < filters.created_to)
+        if filters.is_active is not None:
+            stmt = stmt.where(ChatSession.is_active.is_(filters.is_active))
+        return stmt
+
+    def _absent(column):
+        return type_coerce(null(), column.type)
+
+    sessions = _filtered(
+        select(
+            ChatSession.id.label("session_id"),
+            ChatSession.session_token,
+            ChatSession.player_id,
+            ChatSession.is_active,
+            ChatSession.created_at,
+            ChatSession.ended_at,
+            ChatSession.expires_at,
+            MessageArchive.payload.label("archive"),
+            _absent(Message.id).label("message_id"),
+            _absent(Message.sender).label("sender"),
+            _absent(Message.content).label("content"),
+            _absent(Message.created_at).label("message_created_at"),
+        ).outerjoin(MessageArchive, MessageArchive.session_token == ChatSession.session_token)
+    )
+    messages = _filtered(
+        select(
+            ChatSession.id,
+            ChatSession.session_token,
+            _absent(ChatSession.player_id),
+            _absent(ChatSession.is_active),
+            ChatSession.created_at,
+            _absent(ChatSession.ended_at),
+            _absent(ChatSession.expires_at),
+            _absent(MessageArchive.payload),
+            Message.id,
+            Message.sender,
+            Message.content,
+            Message.created_at,
+        ).join(Message, Message.session_token == ChatSession.session_token)
+    )
+    rows = union_all(sessions, messages).subquery()
+    return select(rows).order_by(
+        rows.c.created_at,
+        rows.c.session_id,
+        rows.c.message_created_at.asc().nulls_first(),
+        rows.c.message_id.asc().nulls_first(),
+    )
+
+
+class SessionExport:
+    """NDJSON stream of sessions, one line each with its messages, live or archived.
+
+    Everything comes from one query read through a server-side cursor
+    ``batch_size`` rows at a time, so memory holds one batch and one session
+    however much is exported. With ``compress_level`` the bytes are gzip.
+    Iterating closes ``connection`` when done or abandoned.
+    """
+
+    def __init__(
+        self, connection: Connection, filters: ExportFilters, batch_size: int, compress_level: int | None = None
+    ) -> None:
+        self.connection = connection
+        self.filters = filters
+        self.batch_size = batch_size
+        self.compress_level = compress_level
+        self.sessions = 0
+        self.messages = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        started = monotonic()
+        completed = False
+        try:
+            chunks = _buffered(self._lines())
+            if self.compress_level is not None:
+                chunks = _gzip(chunks, self.compress_level)
+            yield from chunks
+            completed = True
+        finally:
+            self.connection.close()
+            current_app.logger.info(
+                "Exportacao concluida" if completed else "Exportacao interrompida",
+                extra={
+                    "event": "export.finished",
+                    "completed": completed,
+                    "sessions": self.sessions,
+                    "messages": self.messages,
+                    "duration_ms": round((monotonic() - started) * 1000, 1),
+                },
+            )
+
+    def _lines(self) -> Iterator[bytes]:
+        dumps = current_app.json.dumps
+        result = self.connection.execution_options(stream_results=True, yield_per=self.batch_size).execute(
+            _export_query(self.filters)
+        )
+        for _, rows in groupby(result, key=lambda row: row.session_id):
+            first = next(rows)
+            live = [(row.message_id, row.sender, row.content, row.message_created_at) for row in rows]
+            stored = live
+            if first.archive is not None:
+                # Messages that arrived after archiving stay live until the next `flask archive` merges them.
+                stored = sorted([*unpack_messages(first.archive), *live], key=lambda message: (message[3], message[0]))
+            messages = [_message(*message) for message in stored]
+            record = {
+                "session_token": first.session_token,
+                "player_id": first.player_id,
+                "is_active": first.is_active,
+                "created_at": first.created_at,
+                "ended_at": first.ended_at,
+                "expires_at": first.expires_at,
+                "archived": first.archive is not None,
+                "messages": messages,
+            }
+            self.sessions += 1
+            self.messages += len(messages)
+            yield (dumps(record) + "\n").encode("utf-8")
+
+
+def _message(message_id: int, sender, content: str, created_at: datetime) -> dict:
+    # Same shape as the history API; the app's JSON provider encodes datetime and Sender.
+    return {"id": message_id, "sender": sender, "content": content, "created_at": created_at}
+
+
+def _buffered(lines: Iterable[bytes], size: int = CHUNK_BYTES) -> Iterator[bytes]:
+    buffer = bytearray()
+    for line in lines:
+        buffer += line
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def _gzip(chunks: Iterable[bytes], level: int) -> Iterator[bytes]:
+    compressor = zlib.compressobj(min(max(level, 1), 9), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@click.command("export-sessions")
+@click.option("--created-from", default=None, help="Sessoes criadas a partir deste instante (ISO-8601, UTC se sem fuso).")
+@click.option("--created-to", default=None, help="Sessoes criadas antes deste instante (ISO-8601).")
+@click.option("--active/--ended", "is_active", default=None, help="Apenas sessoes ativas ou apenas encerradas.")
+@click.option("--output", "-o", default="-", show_default=True, help="Arquivo de saida ('-' para stdout).")
+@click.option("--gzip", "compress", is_flag=True, help="Comprime a saida com gzip.")
+@click.option("--batch-size", type=int, default=None, help="Linhas por leitura do cursor (default: VALEZAP_EXPORT_BATCH_SIZE).")
+@with_appcontext
+def export_sessions_command(
+    created_from: str | None, created_to: str | None, is_active: bool | None, output: str, compress: bool, batch_size: int | None
+) -> None:
+    """Write sessions and their messages as NDJSON, using VALEZAP_EXPORT_DATABASE_URL."""
+    config = current_app.config
+    try:
+        filters = parse_filters(created_from, created_to, None)._replace(is_active=is_active)
+        connection = open_export(config)
+    except (ValueError, ExportUnavailable) as exc:
+        raise click.ClickException(str(exc)) from exc
+
+    export = SessionExport(
+        connection,
+        filters,
+        batch_size or config["EXPORT_BATCH_SIZE"],
+        config["COMPRESS_LEVEL"] if compress else None,
+    )
+    with click.open_file(output, "wb") as out:
+        for chunk in export:
+            out.write(chunk)
+    click.echo(f"{export.sessions} sessoes ({export.messages} mensagens) exportadas", err=True)
@@ -1,19 +1,272 @@
 ﻿from __future__ import annotations
 
+import os
+import random
+import threading
+import time
 from typing import Any
 
 import requests
 from flask import current_app
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as ConnectionSetupError
+from urllib3.exceptions import NewConnectionError
+
+from .metrics import observe_backend_dispatch
+from .timing import timed
 
 
 class WebhookError(RuntimeError):
     """Raised when the remote ValeZap backend cannot be reached."""
 
+    def __init__(self, message: str, cause: str = "unknown") -> None:
+        super().__init__(message)
+        self.cause = cause
+
+
+class CircuitBreaker:
+    """Per-worker breaker that stops calling an upstream that keeps failing.
+
+    ``closed`` lets every call through; after ``failure_threshold`` consecutive
+    failures it goes ``open`` and rejects calls for ``reset_timeout`` seconds,
+    then lets a single probe through (``half_open``) to decide whether to close.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, clock=time.monotonic) -> None:
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """Let another probe through after one that ended without an outcome (e.g. a bug raised)."""
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probe_in_flight = False
+
+    def record_failure(self) -> bool:
+        """Count a failure; returns ``True`` when this failure opened the breaker."""
+        with self._lock:
+            self._probe_in_flight = False
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                opened = self._state != self.OPEN
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+                if opened:
+                    self.times_opened += 1
+                return opened
+            return False
+
+
+class BackendClient:
+    """Keep-alive HTTP client for the upstream workflow, one per worker process."""
+
+    def __init__(self, config) -> None:
+        self.pool_size = config["REMOTE_WEBHOOK_POOL_SIZE"]
+        self.connect_timeout = config["REMOTE_WEBHOOK_CONNECT_TIMEOUT"]
+        self.read_timeout = config["REMOTE_WEBHOOK_TIMEOUT"]
+        self.max_retries = config["REMOTE_WEBHOOK_RETRIES"]
+        self.retry_backoff = config["REMOTE_WEBHOOK_RETRY_BACKOFF"]
+        self.retry_statuses = frozenset(config["REMOTE_WEBHOOK_RETRY_STATUSES"])
+        self.breaker = CircuitBreaker(
+            config["REMOTE_WEBHOOK_BREAKER_THRESHOLD"],
+            config["REMOTE_WEBHOOK_BREAKER_RESET"],
+        )
+        self.retries = 0
+        self.pid = os.getpid()
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._adapter = adapter
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """POST with bounded retries and breaker protection.
+
+        Only failures where the request never reached the upstream (the
+        connection could not be opened, ``REMOTE_WEBHOOK_RETRY_STATUSES``) are
+        retried, since the workflow call itself is not idempotent. A reset or
+        closed connection may come after the body was sent, and read timeouts
+        certainly do: neither is retried.
+        """
+        if not self.breaker.allow():
+            raise WebhookError("Backend do ValeZap indisponivel no momento", cause="circuit_open")
+
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        settled = False
+        try:
+            attempt = 0
+            while True:
+                try:
+                    response = self.session.post(url, **kwargs)
+                except requests.ConnectionError as exc:
+                    if _never_sent(exc) and attempt < self.max_retries:
+                        attempt = self._backoff(attempt)
+                        continue
+                    settled = True
+                    self._record_failure()
+                    raise
+                except requests.RequestException:
+                    settled = True
+                    self._record_failure()
+                    raise
+
+                if response.status_code in self.retry_statuses and attempt < self.max_retries:
+                    response.close()
+                    attempt = self._backoff(attempt)
+                    continue
+
+                settled = True
+                if response.status_code >= 500:
+                    self._record_failure()
+                else:
+                    self.breaker.record_success()
+                return response
+        finally:
+            if not settled:
+                self.breaker.release_probe()
+
+    def warm_up(self, url: str) -> bool:
+        """Open one keep-alive connection (TCP and TLS) to ``url``'s host, sending nothing.
+
+        Any request to the webhook would run the workflow, so the connection
+        is set up directly in the pool requests uses for ``url`` and left idle
+        there for the first dispatch.
+        """
+        try:
+            request = requests.Request("POST", url).prepare()
+            pool = self._adapter.get_connection_with_tls_context(request, verify=self.session.verify)
+        except (OSError, ValueError):  # requests' URL errors are OSErrors too
+            return False
+        connection = pool._get_conn()
+        try:
+            connection.timeout = self.connect_timeout
+            connection.connect()
+        except (OSError, ConnectionSetupError):
+            connection.close()
+            pool._put_conn(None)
+            return False
+        pool._put_conn(connection)
+        return True
+
+    def stats(self) -> dict[str, Any]:
+        """Breaker state and connection reuse counters for this worker."""
+        connections = requests_sent = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+            "pid": self.pid,
+            "breaker_state": self.breaker.state,
+            "breaker_opened_total": self.breaker.times_opened,
+            "retries_total": self.retries,
+            "connections_opened_total": connections,
+            "requests_total": requests_sent,
+            "connections_reused_total": max(requests_sent - connections, 0),
+        }
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _backoff(self, attempt: int) -> int:
+        # Full jitter keeps retrying workers from hitting the upstream in lockstep.
+        self.retries += 1
+        time.sleep(random.uniform(0, self.retry_backoff * (2 ** attempt)))
+        return attempt + 1
+
+    def _record_failure(self) -> None:
+        if self.breaker.record_failure():
+            current_app.logger.warning(
+                "Circuit breaker do backend aberto",
+                extra={
+                    "event": "backend.breaker.opened",
+                    "reset_seconds": self.breaker.reset_timeout,
+                    **self.stats(),
+                },
+            )
+
+
+def _never_sent(exc: requests.ConnectionError) -> bool:
+    """Whether the connection failed before any byte of the request went out."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = exc.args[0] if exc.args else None
+    return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+
+
+_client: BackendClient | None = None
+_client_lock = threading.Lock()
+
+
+def get_backend_client() -> BackendClient:
+    """Return this process' client, rebuilding it after a fork."""
+    global _client
+
+    client = _client
+    if client is not None and client.pid == os.getpid():
+        return client
+    with _client_lock:
+        if _client is None or _client.pid != os.getpid():
+            _client = BackendClient(current_app.config)
+        return _client
+
 
 def dispatch_to_backend(session_token: str, player_id: str, message: str) -> dict[str, Any]:
     """Send the player message to the upstream workflow and return its JSON response."""
+    started = time.perf_counter()
+    try:
+        with timed("backend"):
+            data = _dispatch(session_token, player_id, message)
+    except WebhookError as exc:
+        observe_backend_dispatch(time.perf_counter() - started, cause=exc.cause)
+        raise
+    observe_backend_dispatch(time.perf_counter() - started)
+    return data
+
+
+def _dispatch(session_token: str, player_id: str, message: str) -> dict[str, Any]:
     url = current_app.config["REMOTE_WEBHOOK_URL"]
-    timeout = current_app.config["REMOTE_WEBHOOK_TIMEOUT"]
     api_key = current_app.config.get("REMOTE_WEBHOOK_API_KEY")
 
     headers = {"Content-Type": "application/json"}
@@ -38,7 +291,7 @@ def dispatch_to_backend(session_token: str, player_id: str, message: str) -> dic
     )
 
     try:
-        response = requests.post(url, json=payload, timeout=timeout, headers=headers)
+        response = get_backend_client().post(url, json=payload, headers=headers)
     except requests.RequestException as exc:  # pragma: no cover - network failure
         logger.error(
             "Nao foi possivel contatar o backend",
@@ -49,7 +302,8 @@ def dispatch_to_backend(session_token: str, player_id: str, message: str) -> dic
                 "error": str(exc),
             },
         )
-        raise WebhookError("Não foi possível contatar o backend do ValeZap") from exc
+        cause = "timeout" if isinstance(exc, requests.Timeout) else "connection"
+        raise WebhookError("Não foi possível contatar o backend do ValeZap", cause=cause) from exc
 
     if not response.ok:
         logger.error(
@@ -62,7 +316,7 @@ def dispatch_to_backend(session_token: str, player_id: str, message: str) -> dic
                 "body": response.text[:500],
             },
         )
-        raise WebhookError(f"Backend retornou status inesperado: {response.status_code}")
+        raise WebhookError(f"Backend retornou status inesperado: {response.status_code}", cause="status")
 
     try:
         data = response.json()
@@ -76,7 +330,7 @@ def dispatch_to_backend(session_token: str, player_id: str, message: str) -> dic
                 "body": response.text[:500],
             },
         )
-        raise WebhookError("Resposta do backend não está em JSON válido") from exc
+        raise WebhookError("Resposta do backend não está em JSON válido", cause="invalid_json") from exc
 
     if not isinstance(data, dict):
         logger.error(
@@ -88,6 +342,14 @@ def dispatch_to_backend(session_token: str, player_id: str, message: str) -> dic
                 "payload": data,
             },
         )
-        raise WebhookError("Formato de resposta inválido do backend")
+        raise WebhookError("Formato de resposta inválido do backend", cause="invalid_payload")
 
     return data
+
+
+def extract_reply(data: dict[str, Any]) -> str:
+    """Return the stripped ``mensagem`` of a backend response or raise ``WebhookError``."""
+    message = data.get("mensagem")
+    if not isinstance(message, str) or not message.strip():
+        raise WebhookError("Resposta invalida do backend", cause="invalid_reply")
+    return message.strip()
@@ -0,0 +1,130 @@
+﻿from __future__ import annotations
+
+import hashlib
+import json
+from datetime import timedelta
+from time import monotonic
+from typing import NamedTuple
+
+from sqlalchemy import and_, delete, func, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .database import session_scope
+from .events import get_broker
+from .models import IdempotencyKey
+
+MAX_KEY_LENGTH = 255
+
+
+class StoredResponse(NamedTuple):
+    request_hash: str
+    status_code: int | None
+    body: str | None
+
+    @property
+    def completed(self) -> bool:
+        return self.status_code is not None
+
+
+def request_fingerprint(payload: dict) -> str:
+    """Hash of the fields that make two sends "the same request"."""
+    material = [payload.get("session_token"), payload.get("player"), payload.get("message")]
+    return hashlib.sha256(json.dumps(material, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def claim_key(db, session_token: str, key: str, request_hash: str, lease_seconds: float, ttl_seconds: float) -> bool:
+    """Try to become the request that runs for ``key``; ``False`` when another one owns it.
+
+    A key is free when it was never used, when its in-flight owner has held
+    it for more than ``lease_seconds`` (the worker died mid-request), or when
+    its stored outcome is older than ``ttl_seconds``.
+    """
+    table = IdempotencyKey.__table__
+    now = func.now()
+    stmt = (
+        pg_insert(table)
+        .values(session_token=session_token, key=key, request_hash=request_hash)
+        .on_conflict_do_update(
+            index_elements=[table.c.session_token, table.c.key],
+            set_={
+                "request_hash": request_hash,
+                "status_code": None,
+                "response_body": None,
+                "created_at": now,
+                "completed_at": None,
+            },
+            where=or_(
+                and_(table.c.completed_at.is_(None), table.c.created_at < now - timedelta(seconds=lease_seconds)),
+                table.c.created_at < now - timedelta(seconds=ttl_seconds),
+            ),
+        )
+        .returning(table.c.key)
+    )
+    return db.execute(stmt).first() is not None
+
+
+def load_key(db, session_token: str, key: str) -> StoredResponse | None:
+    row = db.execute(
+        select(IdempotencyKey.request_hash, IdempotencyKey.status_code, IdempotencyKey.response_body).where(
+            IdempotencyKey.session_token == session_token,
+            IdempotencyKey.key == key,
+        )
+    ).first()
+    return StoredResponse(*row) if row is not None else None
+
+
+def complete_key(db, session_token: str, key: str, status_code: int, body: str) -> None:
+    db.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.session_token == session_token, IdempotencyKey.key == key)
+        .values(status_code=status_code, response_body=body, completed_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def release_key(db, session_token: str, key: str) -> None:
+    """Forget an in-flight key whose request failed, so a retry runs it again."""
+    db.execute(
+        delete(IdempotencyKey)
+        .where(
+            IdempotencyKey.session_token == session_token,
+            IdempotencyKey.key == key,
+            IdempotencyKey.completed_at.is_(None),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def wait_for_key(session_token: str, key: str, timeout: float, poll_interval: float) -> StoredResponse | None:
+    """Block until the in-flight request for ``key`` finishes, is released or ``timeout`` elapses.
+
+    Wakes on the session's message notifications (a successful send stores
+    the backend reply) and re-checks every ``poll_interval`` seconds for
+    outcomes that insert no message, such as a failure releasing the key.
+    """
+    deadline = monotonic() + timeout
+    subscription = get_broker().subscribe(session_token)
+    try:
+        while True:
+            with session_scope(session_identifier=session_token) as db:
+                stored = load_key(db, session_token, key)
+            remaining = deadline - monotonic()
+            if stored is None or stored.completed or remaining <= 0:
+                return stored
+            subscription.wait(min(poll_interval, remaining))
+    finally:
+        subscription.close()
+
+
+def purge_keys(db, ttl_seconds: float, limit: int) -> int:
+    """Delete up to ``limit`` keys older than ``ttl_seconds``; needs a role bypassing RLS."""
+    table = IdempotencyKey.__table__
+    expired = (
+        select(table.c.session_token, table.c.key)
+        .where(table.c.created_at < func.now() - timedelta(seconds=ttl_seconds))
+        .order_by(table.c.created_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = delete(table).where(tuple_(table.c.session_token, table.c.key).in_(expired))
+    return db.execute(stmt).rowcount
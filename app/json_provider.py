@@ -0,0 +1,80 @@
+﻿from __future__ import annotations
+
+import enum
+from datetime import date, datetime
+from typing import Any
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from .timing import timed
+
+try:  # pragma: no cover - optional dependency
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    return DefaultJSONProvider.default(value)
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    """Stdlib ``json`` with ISO-8601 datetimes and enums as their value.
+
+    Flask's default provider renders datetimes as HTTP dates; API payloads
+    use ISO-8601, so rows can be handed over without converting them first.
+    """
+
+    default = staticmethod(_default)
+    sort_keys = False
+
+    def response(self, *args: Any, **kwargs: Any):
+        with timed("json"):
+            return super().response(*args, **kwargs)
+
+
+class OrjsonProvider(StdlibJSONProvider):
+    """``orjson`` encoder: datetimes, enums and UTF-8 handled in native code."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return self._encode(obj).decode("utf-8")
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any):
+        with timed("json"):
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(self._encode(obj), mimetype=self.mimetype)
+
+    def _encode(self, obj: Any) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_default, option=option)
+
+
+JSON_PROVIDERS: dict[str, type[DefaultJSONProvider]] = {
+    "stdlib": StdlibJSONProvider,
+    "orjson": OrjsonProvider,
+}
+
+
+def init_json_provider(app: Flask) -> None:
+    """Install the provider selected by ``JSON_PROVIDER`` (``auto`` prefers orjson)."""
+    name = str(app.config.get("JSON_PROVIDER", "auto")).lower()
+    if name == "auto":
+        name = "orjson" if orjson is not None else "stdlib"
+    if name == "orjson" and orjson is None:
+        raise RuntimeError("JSON_PROVIDER=orjson requer o pacote orjson")
+    try:
+        provider_cls = JSON_PROVIDERS[name]
+    except KeyError as exc:
+        raise RuntimeError(f"JSON_PROVIDER desconhecido: {name}") from exc
+    app.json = provider_cls(app)
+
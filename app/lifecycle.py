@@ -0,0 +1,80 @@
+﻿from __future__ import annotations
+
+import time
+from typing import Any
+
+from flask import Flask
+
+from .database import pool_options, reset_pools_after_fork, warm_up_pools
+from .events import get_broker
+from .external import get_backend_client
+from .metrics import WORKER_STARTUP
+
+
+def after_fork() -> None:
+    """First thing a gunicorn worker runs: drop the connection pools inherited from the master.
+
+    ``preload_app`` builds the engines in the master. The backend client,
+    the LISTEN thread, the log listener and the write buffer are already
+    created lazily per pid, so only the pools need resetting.
+    """
+    reset_pools_after_fork()
+
+
+def warm_up_worker(app: Flask, forked_at: float | None = None) -> dict[str, Any]:
+    """Open the worker's connections before it accepts its first request.
+
+    Fills the database pools (primary and replicas), starts the broker's
+    LISTEN connection and opens a keep-alive connection to the backend, so
+    the first players served by a new worker do not pay for TCP/TLS and
+    Postgres authentication. Logs ``worker.ready`` with the time of each
+    step and, given ``forked_at`` (``time.monotonic()`` right after the
+    fork), the worker's whole startup time.
+    """
+    started = time.monotonic()
+    report: dict[str, Any] = {}
+    with app.app_context():
+        if app.config["WARMUP"]:
+            step = time.monotonic()
+            report["db_connections"] = warm_up_pools(pool_options(app.config)["pool_size"])
+            get_broker().ensure_listening()
+            report["db_ms"] = _elapsed_ms(step)
+
+            step = time.monotonic()
+            report["backend_connected"] = get_backend_client().warm_up(app.config["REMOTE_WEBHOOK_URL"])
+            report["backend_ms"] = _elapsed_ms(step)
+
+        report["warmup_ms"] = _elapsed_ms(started)
+        WORKER_STARTUP.labels(phase="warmup").observe(report["warmup_ms"] / 1000)
+        if forked_at is not None:
+            report["startup_ms"] = _elapsed_ms(forked_at)
+            WORKER_STARTUP.labels(phase="total").observe(report["startup_ms"] / 1000)
+
+        app.logger.info("Worker pronto", extra={"event": "worker.ready", **report})
+    return report
+
+
+def connection_budget(app: Flask, workers: int) -> int:
+    """Most database connections ``workers`` processes can open (pools plus LISTEN), logged at boot."""
+    config = app.config
+    options = pool_options(config)
+    per_engine = options["pool_size"] + options["max_overflow"]
+    engines = 1 + len(config.get("DATABASE_REPLICA_URLS") or ())
+    listen = 1 if config.get("EVENT_BROKER") == "postgres" else 0
+    budget = workers * (per_engine * engines + listen)
+    app.logger.info(
+        "Conexoes de banco previstas",
+        extra={
+            "event": "db.connection_budget",
+            "workers": workers,
+            "pool_size": options["pool_size"],
+            "max_overflow": options["max_overflow"],
+            "engines": engines,
+            "max_connections": budget,
+        },
+    )
+    return budget
+
+
+def _elapsed_ms(since: float) -> float:
+    return round((time.monotonic() - since) * 1000, 1)
@@ -0,0 +1,154 @@
+﻿from __future__ import annotations
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any
+
+from flask import Flask
+from flask.logging import default_handler
+
+TEXT_FORMAT = "[%(asctime)s] %(levelname)s in %(module)s: %(message)s"
+
+# Attributes every LogRecord has; anything else arrived through ``extra=``.
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+# Fields that may carry whole backend responses.
+BULKY_FIELDS = ("payload", "body")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, keeping the fields passed through ``extra=``.
+
+    ``payload``/``body`` are kept on a ``sample_rate`` fraction of records and
+    cut to ``max_chars`` characters, so a burst of backend failures does not
+    turn into megabytes of logs.
+    """
+
+    def __init__(self, max_chars: int = 512, sample_rate: float = 1.0) -> None:
+        super().__init__()
+        self.max_chars = max_chars
+        self.sample_rate = sample_rate
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        for key in BULKY_FIELDS:
+            if key in entry:
+                entry[key] = self._shrink(entry[key])
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        if record.stack_info:
+            entry["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+    def _shrink(self, value: Any) -> Any:
+        text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return f"<omitido: {len(text)} caracteres>"
+        if len(text) > self.max_chars:
+            return f"{text[: self.max_chars]}...<+{len(text) - self.max_chars} caracteres>"
+        return value
+
+
+class _ForkSafeQueueHandler(QueueHandler):
+    """Enqueue-only handler whose listener thread is (re)started in each process.
+
+    ``prepare`` keeps the record's ``extra`` fields and exception text intact
+    (the stdlib version folds them into the message) so the listener-side
+    formatter still sees them.
+    """
+
+    def __init__(self, target: logging.Handler) -> None:
+        super().__init__(queue.SimpleQueue())
+        self.target = target
+        self._listener: QueueListener | None = None
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.target.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self._ensure_started()
+        super().enqueue(record)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
+        super().close()
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Forked child: the parent's queue may hold records its thread never drained.
+                self.queue = queue.SimpleQueue()
+            self._listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+        atexit.register(self.close)
+
+
+_queue_handler: _ForkSafeQueueHandler | None = None
+
+
+def init_logging(app: Flask) -> None:
+    """Route ``app.logger`` through a queue: request threads only enqueue.
+
+    A listener thread formats (JSON by default, ``LOG_FORMAT=text`` for the
+    old single-line format) and writes to stderr. The handler is shared by
+    every app created in the process because the ``app`` logger is global.
+    """
+    global _queue_handler
+
+    level_name = str(app.config.get("LOG_LEVEL", "INFO")).upper()
+    level = getattr(logging, level_name, logging.INFO)
+
+    if _queue_handler is None:
+        stream = logging.StreamHandler()
+        if str(app.config.get("LOG_FORMAT", "json")).lower() == "text":
+            stream.setFormatter(logging.Formatter(TEXT_FORMAT))
+        else:
+            stream.setFormatter(
+                JsonFormatter(
+                    max_chars=app.config.get("LOG_PAYLOAD_MAX_CHARS", 512),
+                    sample_rate=app.config.get("LOG_PAYLOAD_SAMPLE_RATE", 1.0),
+                )
+            )
+        _queue_handler = _ForkSafeQueueHandler(stream)
+
+    logger = app.logger
+    logger.removeHandler(default_handler)
+    if _queue_handler not in logger.handlers:
+        logger.addHandler(_queue_handler)
+    logger.setLevel(level)
+    logger.debug("Logging configured", extra={"component": "bootstrap"})
@@ -0,0 +1,205 @@
+﻿from __future__ import annotations
+
+import hmac
+import os
+import threading
+import time
+
+from flask import Blueprint, Flask, Response, abort, current_app, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import text
+
+# With gunicorn, PROMETHEUS_MULTIPROC_DIR is set in gunicorn.conf.py before the
+# app is imported: every worker writes its samples to mmap files there and
+# whichever worker serves /metrics aggregates all of them.
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REQUEST_LATENCY = Histogram(
+    "valezap_http_request_duration_seconds",
+    "Tempo de resposta por rota.",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+BACKEND_LATENCY = Histogram(
+    "valezap_backend_dispatch_duration_seconds",
+    "Duracao das chamadas ao backend do ValeZap.",
+    ["outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+BACKEND_ERRORS = Counter(
+    "valezap_backend_dispatch_errors_total",
+    "Falhas ao chamar o backend, por causa (WebhookError.cause).",
+    ["cause"],
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    "valezap_db_pool_checkout_wait_seconds",
+    "Tempo para obter uma conexao do pool do SQLAlchemy (inclui abrir uma nova).",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+DB_READS = Counter(
+    "valezap_db_reads_total",
+    "Leituras de historico por destino (replica ou primario).",
+    ["target"],
+)
+POOL_SIZE = Gauge("valezap_db_pool_size", "Tamanho configurado do pool.", multiprocess_mode="livesum")
+POOL_CHECKED_OUT = Gauge(
+    "valezap_db_pool_checked_out",
+    "Conexoes emprestadas no momento.",
+    multiprocess_mode="livesum",
+)
+POOL_OVERFLOW = Gauge(
+    "valezap_db_pool_overflow",
+    "Conexoes abertas alem do tamanho do pool (negativo: ainda ha espaco no pool).",
+    multiprocess_mode="livesum",
+)
+ADMISSION_REJECTED = Counter(
+    "valezap_admission_rejected_total",
+    "Envios recusados pelo controle de admissao (rate_limit: 429, dispatch_saturated: 503).",
+    ["reason"],
+)
+WORKER_STARTUP = Histogram(
+    "valezap_worker_startup_seconds",
+    "Tempo do fork do worker ate ele estar pronto para atender (inclui o aquecimento).",
+    ["phase"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+OPEN_STREAMS = Gauge("valezap_sse_streams", "Streams SSE abertos.", multiprocess_mode="livesum")
+
+
+def observe_pool_checkout(seconds: float) -> None:
+    POOL_CHECKOUT_WAIT.observe(seconds)
+
+
+def observe_backend_dispatch(seconds: float, cause: str | None = None) -> None:
+    BACKEND_LATENCY.labels(outcome="error" if cause else "ok").observe(seconds)
+    if cause:
+        BACKEND_ERRORS.labels(cause=cause).inc()
+
+
+def record_pool_state() -> None:
+    """Copy this worker's pool counters into its gauges (summed across live workers)."""
+    from .database import get_engine
+
+    pool = get_engine().pool
+    if hasattr(pool, "checkedout"):
+        POOL_SIZE.set(pool.size())
+        POOL_CHECKED_OUT.set(pool.checkedout())
+        POOL_OVERFLOW.set(pool.overflow())
+
+
+class SessionCollector:
+    """Active/expired-but-open session counts, queried at scrape time.
+
+    Uses the partial index on active sessions and caches the result for
+    ``ttl`` seconds so frequent scrapes cost one query per period. The count
+    goes through ``valezap_session_counts()`` (``012_session_counts.sql``), a
+    ``SECURITY DEFINER`` function that sees past RLS; if it is missing,
+    nothing is exported (a zero would lie).
+    """
+
+    def __init__(self, app: Flask, ttl: float) -> None:
+        self.app = app
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cached: tuple[float, tuple[int, int] | None] = (0.0, None)
+
+    def describe(self):
+        # Keeps registration from running the query (auto-describe calls collect()).
+        return [
+            GaugeMetricFamily("valezap_active_sessions", "Sessoes ativas e dentro da validade."),
+            GaugeMetricFamily("valezap_expired_open_sessions", "Sessoes vencidas ainda nao encerradas pelo sweeper."),
+        ]
+
+    def collect(self):
+        counts = self._counts()
+        if counts is None:
+            return
+        active, awaiting_sweep = counts
+        yield GaugeMetricFamily("valezap_active_sessions", "Sessoes ativas e dentro da validade.", value=active)
+        yield GaugeMetricFamily(
+            "valezap_expired_open_sessions",
+            "Sessoes vencidas ainda nao encerradas pelo sweeper.",
+            value=awaiting_sweep,
+        )
+
+    def _counts(self) -> tuple[int, int] | None:
+        with self._lock:
+            fetched_at, counts = self._cached
+            if time.monotonic() - fetched_at < self.ttl:
+                return counts
+            counts = self._query()
+            self._cached = (time.monotonic(), counts)
+            return counts
+
+    def _query(self) -> tuple[int, int] | None:
+        from .database import session_scope
+
+        stmt = text("SELECT active, awaiting_sweep FROM valezap_session_counts()")
+        try:
+            with self.app.app_context(), session_scope() as db:
+                active, awaiting_sweep = db.execute(stmt).one()
+        except Exception:  # pragma: no cover - a scrape must not fail on a DB hiccup
+            self.app.logger.exception("Falha ao contar sessoes", extra={"event": "metrics.sessions.error"})
+            return None
+        return active, awaiting_sweep
+
+
+metrics_bp = Blueprint("metrics", __name__)
+_registry: CollectorRegistry | None = None
+
+
+@metrics_bp.get("/metrics")
+def export_metrics():
+    token = current_app.config.get("METRICS_TOKEN")
+    if token:
+        provided = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(provided, f"Bearer {token}"):
+            abort(401, "Token de metricas invalido")
+    elif not current_app.config.get("METRICS_PUBLIC"):
+        # Closed unless a token is configured or the endpoint is opened explicitly.
+        abort(404)
+
+    record_pool_state()
+    return Response(generate_latest(_registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app: Flask) -> None:
+    """Time every request, register ``/metrics`` and the scrape-time collectors."""
+    global _registry
+
+    if _registry is None:
+        if MULTIPROCESS:
+            _registry = CollectorRegistry()
+            MultiProcessCollector(_registry)
+        else:
+            _registry = REGISTRY
+        _registry.register(SessionCollector(app, app.config["METRICS_SESSIONS_TTL"]))
+
+    app.register_blueprint(metrics_bp)
+
+    @app.before_request
+    def start_timer() -> None:
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+            REQUEST_LATENCY.labels(request.method, route, str(response.status_code)).observe(
+                time.perf_counter() - started
+            )
+        record_pool_state()
+        return response
@@ -3,8 +3,9 @@
 import enum
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, DateTime, Enum, ForeignKey, Integer, String, Text, func
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import Boolean, Column, DateTime, Enum, ForeignKey, Index, Integer, LargeBinary, String, Text, func, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import declarative_base, deferred, relationship
 
 Base = declarative_base()
 
@@ -13,6 +14,13 @@ class Sender(enum.Enum):
     VALEZAP = "valezap"
 
 
+class OutboxStatus(enum.Enum):
+    PENDING = "pending"
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+
+
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
 
@@ -22,9 +30,24 @@ class ChatSession(Base):
     is_active = Column(Boolean, nullable=False, default=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     ended_at = Column(DateTime(timezone=True))
+    expires_at = Column(DateTime(timezone=True))
+    # Kept by the statement inserting each message (conversation._insert_messages).
+    message_count = Column(Integer, nullable=False, default=0, server_default=text("0"))
+    last_message_at = Column(DateTime(timezone=True))
+    last_sender = Column(Enum(Sender))
 
     messages = relationship("Message", back_populates="session", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index("idx_chat_sessions_active_expires", "expires_at", postgresql_where=text("is_active")),
+        Index(
+            "idx_chat_sessions_active_activity",
+            func.coalesce(last_message_at, created_at).desc(),
+            id.desc(),
+            postgresql_where=text("is_active"),
+        ),
+    )
+
 
 class Message(Base):
     __tablename__ = "messages"
@@ -34,14 +57,87 @@ class Message(Base):
         String(64),
         ForeignKey("chat_sessions.session_token", ondelete="CASCADE"),
         nullable=False,
-        index=True,
     )
     sender = Column(Enum(Sender), nullable=False)
     content = Column(Text, nullable=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # Part of the primary key because the table is range-partitioned on it.
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, primary_key=True)
+    # Filled by the messages_content_tsv trigger; older rows by `flask backfill-search` (app/search.py).
+    # Plain text on SQLite, so benchmarks/serialization.py can still create the table there.
+    content_tsv = deferred(Column(TSVECTOR().with_variant(Text(), "sqlite")))
 
     session = relationship("ChatSession", back_populates="messages")
 
+    __table_args__ = (
+        Index("idx_messages_session_created_id", "session_token", "created_at", "id"),
+        Index("idx_messages_content_tsv", "content_tsv", postgresql_using="gin"),
+    )
+
+
+class MessageArchive(Base):
+    """Compressed history of an ended session, moved out of ``messages``."""
+
+    __tablename__ = "messages_archive"
+
+    session_token = Column(
+        String(64),
+        ForeignKey("chat_sessions.session_token", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    message_count = Column(Integer, nullable=False)
+    first_message_at = Column(DateTime(timezone=True), nullable=False)
+    last_message_at = Column(DateTime(timezone=True), nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class OutboxEntry(Base):
+    """Player message waiting to be dispatched to the backend in async mode."""
+
+    __tablename__ = "backend_outbox"
+
+    id = Column(Integer, primary_key=True)
+    session_token = Column(
+        String(64),
+        ForeignKey("chat_sessions.session_token", ondelete="CASCADE"),
+        nullable=False,
+    )
+    player_id = Column(String(128), nullable=False)
+    content = Column(Text, nullable=False)
+    status = Column(Enum(OutboxStatus), nullable=False, default=OutboxStatus.PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    locked_until = Column(DateTime(timezone=True))
+    last_error = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    processed_at = Column(DateTime(timezone=True))
+
+
+class IdempotencyKey(Base):
+    """Stored outcome of a ``POST /api/messages`` sent with an ``Idempotency-Key``."""
+
+    __tablename__ = "idempotency_keys"
+
+    session_token = Column(String(64), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    # NULL while the first request is still in flight.
+    status_code = Column(Integer)
+    response_body = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    completed_at = Column(DateTime(timezone=True))
+
+    __table_args__ = (Index("idx_idempotency_keys_created_at", "created_at"),)
+
 
-__all__ = ["Base", "ChatSession", "Message", "Sender"]
+__all__ = [
+    "Base",
+    "ChatSession",
+    "IdempotencyKey",
+    "Message",
+    "MessageArchive",
+    "OutboxEntry",
+    "OutboxStatus",
+    "Sender",
+]
 
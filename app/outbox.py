@@ -0,0 +1,434 @@
+﻿from __future__ import annotations
+
+import signal
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, func, insert, or_, select, update
+from sqlalchemy.orm import aliased
+
+from .admission import dispatch_slot
+from .conversation import record_backend_reply
+from .database import session_scope
+from .external import WebhookError, dispatch_to_backend, extract_reply
+from .models import OutboxEntry, OutboxStatus
+
+_OPEN_STATUSES = (OutboxStatus.PENDING, OutboxStatus.PROCESSING)
+
+
+# Messages of one coalesced dispatch are sent as one text, one per line.
+COALESCE_SEPARATOR = "\n"
+
+
+@dataclass(frozen=True)
+class ClaimedEntry:
+    """One backend dispatch: a single outbox row, or several coalesced ones (``ids``)."""
+
+    id: int
+    session_token: str
+    player_id: str
+    content: str
+    attempts: int
+    ids: tuple[int, ...] = ()
+
+    @property
+    def entry_ids(self) -> tuple[int, ...]:
+        return self.ids or (self.id,)
+
+
+def enqueue_dispatch(db, session_token: str, player_id: str, content: str, delay_seconds: float = 0) -> int:
+    """Queue a player message for the dispatcher inside the caller's transaction; returns the row id.
+
+    ``delay_seconds`` keeps the dispatcher off the row for that long.
+    """
+    available_at = func.now() + timedelta(seconds=delay_seconds) if delay_seconds > 0 else func.now()
+    return db.execute(
+        insert(OutboxEntry)
+        .values(
+            session_token=session_token,
+            player_id=player_id,
+            content=content,
+            status=OutboxStatus.PENDING,
+            attempts=0,
+            available_at=available_at,
+        )
+        .returning(OutboxEntry.id)
+    ).scalar_one()
+
+
+def has_pending_before(db, session_token: str, entry_id: int) -> bool:
+    """Whether an older row of the session is waiting for its request to claim it (and ``entry_id`` with it).
+
+    Rows past ``available_at`` lost their request and do not count: they
+    are claimed by the next batch or by the dispatcher.
+    """
+    stmt = select(OutboxEntry.id).where(
+        OutboxEntry.session_token == session_token,
+        OutboxEntry.id < entry_id,
+        OutboxEntry.status == OutboxStatus.PENDING,
+        OutboxEntry.available_at > func.now(),
+    )
+    return db.execute(stmt.exists().select()).scalar_one()
+
+
+def hand_over(db, entry_id: int, delay_seconds: float) -> None:
+    """Let the dispatcher take ``entry_id`` after ``delay_seconds`` instead of the full hold.
+
+    Used by a request that joined another one's batch: if that batch was
+    claimed before this row committed, the row is not left waiting for the
+    opener's lease to run out.
+    """
+    db.execute(
+        update(OutboxEntry)
+        .where(OutboxEntry.id == entry_id, OutboxEntry.status == OutboxStatus.PENDING)
+        .values(available_at=func.now() + timedelta(seconds=delay_seconds))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def is_pending(db, entry_id: int) -> bool:
+    return db.execute(select(OutboxEntry.status).where(OutboxEntry.id == entry_id)).scalar_one() == OutboxStatus.PENDING
+
+
+def _claim_values(lease_seconds: float) -> dict:
+    return {
+        "status": OutboxStatus.PROCESSING,
+        "attempts": OutboxEntry.attempts + 1,
+        "locked_until": func.now() + timedelta(seconds=lease_seconds),
+    }
+
+
+def _claim_followers(db, head: ClaimedEntry, lease_seconds: float, limit: int) -> ClaimedEntry:
+    """Lease the session's pending rows queued after ``head`` (ready or not) and merge them into it."""
+    if limit <= 1:
+        return head
+    followers = (
+        select(OutboxEntry.id)
+        .where(
+            OutboxEntry.session_token == head.session_token,
+            OutboxEntry.id > head.id,
+            OutboxEntry.status == OutboxStatus.PENDING,
+        )
+        .order_by(OutboxEntry.id)
+        .limit(limit - 1)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(OutboxEntry)
+        .where(OutboxEntry.id.in_(followers.scalar_subquery()))
+        .values(**_claim_values(lease_seconds))
+        .returning(OutboxEntry.id, OutboxEntry.content)
+        .execution_options(synchronize_session=False)
+    )
+    rows = sorted(db.execute(stmt).all())
+    if not rows:
+        return head
+    return ClaimedEntry(
+        head.id,
+        head.session_token,
+        head.player_id,
+        COALESCE_SEPARATOR.join([head.content, *(content for _, content in rows)]),
+        head.attempts,
+        ids=(head.id, *(row_id for row_id, _ in rows)),
+    )
+
+
+def claim_session(db, session_token: str, lease_seconds: float, limit: int) -> ClaimedEntry | None:
+    """Lease up to ``limit`` pending rows of one session as a single coalesced dispatch.
+
+    Used by a request in coalescing mode once its window has passed. Rows
+    whose lease expired (their request died mid-call) are taken again.
+    Returns ``None`` while an earlier dispatch of the session is still in
+    flight (replies stay in order) or when nothing is left to claim.
+    """
+    in_flight = (
+        select(OutboxEntry.id)
+        .where(
+            OutboxEntry.session_token == session_token,
+            OutboxEntry.status == OutboxStatus.PROCESSING,
+            OutboxEntry.locked_until >= func.now(),
+        )
+        .exists()
+    )
+    head = (
+        select(OutboxEntry.id)
+        .where(
+            OutboxEntry.session_token == session_token,
+            or_(
+                OutboxEntry.status == OutboxStatus.PENDING,
+                and_(OutboxEntry.status == OutboxStatus.PROCESSING, OutboxEntry.locked_until < func.now()),
+            ),
+            ~in_flight,
+        )
+        .order_by(OutboxEntry.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(OutboxEntry)
+        .where(OutboxEntry.id.in_(head.scalar_subquery()))
+        .values(**_claim_values(lease_seconds))
+        .returning(
+            OutboxEntry.id,
+            OutboxEntry.session_token,
+            OutboxEntry.player_id,
+            OutboxEntry.content,
+            OutboxEntry.attempts,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    row = db.execute(stmt).first()
+    if row is None:
+        return None
+    return _claim_followers(db, ClaimedEntry(*row), lease_seconds, limit)
+
+
+def claim_batch(limit: int, lease_seconds: float, coalesce_limit: int = 1) -> list[ClaimedEntry]:
+    """Lease up to ``limit`` entries, at most one per session and oldest first.
+
+    An entry is only claimable when no older unfinished entry exists for the
+    same session, which keeps replies in the order the player sent them.
+    Expired leases (a dispatcher that died mid-call) become claimable again.
+    With ``coalesce_limit`` > 1 each claimed entry also takes the session's
+    pending entries queued after it, up to that many messages in total.
+    """
+    older = aliased(OutboxEntry)
+    blocked = (
+        select(older.id)
+        .where(
+            older.session_token == OutboxEntry.session_token,
+            older.id < OutboxEntry.id,
+            older.status.in_(_OPEN_STATUSES),
+        )
+        .exists()
+    )
+    candidates = (
+        select(OutboxEntry.id)
+        .where(
+            or_(
+                and_(OutboxEntry.status == OutboxStatus.PENDING, OutboxEntry.available_at <= func.now()),
+                and_(OutboxEntry.status == OutboxStatus.PROCESSING, OutboxEntry.locked_until < func.now()),
+            ),
+            ~blocked,
+        )
+        .order_by(OutboxEntry.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(OutboxEntry)
+        .where(OutboxEntry.id.in_(candidates.scalar_subquery()))
+        .values(**_claim_values(lease_seconds))
+        .returning(
+            OutboxEntry.id,
+            OutboxEntry.session_token,
+            OutboxEntry.player_id,
+            OutboxEntry.content,
+            OutboxEntry.attempts,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    with session_scope() as db:
+        entries = [ClaimedEntry(*row) for row in sorted(db.execute(stmt).all())]
+        if coalesce_limit > 1:
+            entries = [_claim_followers(db, entry, lease_seconds, coalesce_limit) for entry in entries]
+    return entries
+
+
+def _owned(entry: ClaimedEntry):
+    # Every claim bumps ``attempts``: a head row with another count was claimed again by someone else.
+    return (
+        OutboxEntry.id == entry.id,
+        OutboxEntry.status == OutboxStatus.PROCESSING,
+        OutboxEntry.attempts == entry.attempts,
+    )
+
+
+def renew_lease(entry: ClaimedEntry, lease_seconds: float) -> bool:
+    """Restart the lease of a claimed entry right before it is dispatched.
+
+    A batch is processed one entry at a time, so without this the lease of
+    the last entries runs out while the first ones are still being sent and
+    another dispatcher claims them too. Returns ``False`` when that already
+    happened: the entry is someone else's now and must not be sent.
+    """
+    locked_until = func.now() + timedelta(seconds=lease_seconds)
+    with session_scope() as db:
+        head = db.execute(
+            update(OutboxEntry)
+            .where(*_owned(entry))
+            .values(locked_until=locked_until)
+            .returning(OutboxEntry.id)
+            .execution_options(synchronize_session=False)
+        ).first()
+        if head is None:
+            return False
+        if len(entry.entry_ids) > 1:
+            db.execute(
+                update(OutboxEntry)
+                .where(OutboxEntry.id.in_(entry.entry_ids[1:]), OutboxEntry.status == OutboxStatus.PROCESSING)
+                .values(locked_until=locked_until)
+                .execution_options(synchronize_session=False)
+            )
+    return True
+
+
+def still_owned(db, entry: ClaimedEntry) -> bool:
+    """Lock the entry's head row if this dispatcher still holds it, in the transaction storing the reply."""
+    stmt = select(OutboxEntry.id).where(*_owned(entry)).with_for_update()
+    return db.execute(stmt).first() is not None
+
+
+def complete_entry(db, entry: ClaimedEntry, processed_at: datetime) -> None:
+    """Mark every row of a dispatched entry done, in the transaction storing its reply."""
+    db.execute(
+        update(OutboxEntry)
+        .where(OutboxEntry.id.in_(entry.entry_ids))
+        .values(status=OutboxStatus.DONE, processed_at=processed_at, locked_until=None, last_error=None)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def process_entry(entry: ClaimedEntry, lease_seconds: float) -> None:
+    """Dispatch one claimed entry and persist the backend reply.
+
+    The call waits for a ``DISPATCH_CONCURRENCY`` slot, then renews the
+    lease, so the lease only has to cover this one dispatch (timeouts and
+    retries included). A reply that arrives after the entry was claimed
+    again elsewhere is dropped instead of stored twice.
+    """
+    logger = current_app.logger
+    with dispatch_slot():
+        if not renew_lease(entry, lease_seconds):
+            logger.warning(
+                "Entrada do outbox assumida por outro dispatcher",
+                extra={"event": "outbox.entry.lost", "outbox_id": entry.id, "session_token": entry.session_token},
+            )
+            return
+        try:
+            reply = extract_reply(dispatch_to_backend(entry.session_token, entry.player_id, entry.content))
+        except WebhookError as exc:
+            reschedule_entry(entry, str(exc))
+            return
+
+    received_at = datetime.now(timezone.utc)
+    with session_scope(session_identifier=entry.session_token) as db:
+        if not still_owned(db, entry):
+            logger.warning(
+                "Lease do outbox expirou durante o despacho, resposta descartada",
+                extra={"event": "outbox.entry.lost", "outbox_id": entry.id, "session_token": entry.session_token},
+            )
+            return
+        _, ended = record_backend_reply(db, entry.session_token, reply, received_at, player_id=entry.player_id)
+        complete_entry(db, entry, received_at)
+
+    logger.info(
+        "Resposta assincrona registrada",
+        extra={
+            "event": "outbox.entry.done",
+            "outbox_id": entry.id,
+            "session_token": entry.session_token,
+            "player": entry.player_id,
+            "coalesced": len(entry.entry_ids),
+            "ended": ended,
+        },
+    )
+
+
+def reschedule_entry(entry: ClaimedEntry, error: str, retry: bool = True) -> None:
+    """Put a failed entry back for a later attempt, or mark it ``FAILED`` once attempts run out (or without ``retry``)."""
+    config = current_app.config
+    exhausted = not retry or entry.attempts >= config["OUTBOX_MAX_ATTEMPTS"]
+    delay = config["OUTBOX_RETRY_BASE_SECONDS"] * (2 ** (entry.attempts - 1))
+    values = {"locked_until": None, "last_error": error[:500]}
+    if exhausted:
+        values.update(status=OutboxStatus.FAILED, processed_at=datetime.now(timezone.utc))
+    else:
+        values.update(status=OutboxStatus.PENDING, available_at=func.now() + timedelta(seconds=delay))
+
+    with session_scope() as db:
+        db.execute(
+            update(OutboxEntry)
+            .where(OutboxEntry.id.in_(entry.entry_ids))
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+
+    current_app.logger.error(
+        "Falha ao despachar mensagem do outbox",
+        extra={
+            "event": "outbox.entry.failed" if exhausted else "outbox.entry.retry",
+            "outbox_id": entry.id,
+            "session_token": entry.session_token,
+            "attempts": entry.attempts,
+            "error": error,
+        },
+    )
+
+
+def drain_once(limit: int) -> int:
+    """Claim and process one batch; returns how many entries were handled."""
+    config = current_app.config
+    coalesce_limit = config["COALESCE_MAX_MESSAGES"] if config["COALESCE_WINDOW_SECONDS"] > 0 else 1
+    lease_seconds = config["OUTBOX_LEASE_SECONDS"]
+    entries = claim_batch(limit, lease_seconds, coalesce_limit)
+    for entry in entries:
+        process_entry(entry, lease_seconds)
+    return len(entries)
+
+
+class OutboxDispatcher:
+    """Pool of threads draining the outbox, outside the request-serving workers."""
+
+    def __init__(self, app: Flask, workers: int) -> None:
+        self.app = app
+        self.workers = workers
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"outbox-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self) -> None:
+        config = self.app.config
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    handled = drain_once(config["OUTBOX_BATCH_SIZE"])
+                except Exception:  # pragma: no cover - keeps the pool alive on DB hiccups
+                    self.app.logger.exception("Erro no dispatcher do outbox", extra={"event": "outbox.error"})
+                    handled = 0
+            if not handled:
+                self._stop.wait(config["OUTBOX_POLL_SECONDS"])
+
+
+@click.command("dispatch-outbox")
+@click.option("--workers", type=int, default=None, help="Threads de despacho (default: VALEZAP_OUTBOX_WORKERS).")
+@with_appcontext
+def dispatch_outbox_command(workers: int | None) -> None:
+    """Drain backend_outbox until interrupted."""
+    app = current_app._get_current_object()
+    dispatcher = OutboxDispatcher(app, workers or app.config["OUTBOX_WORKERS"])
+    dispatcher.start()
+    click.echo(f"Dispatcher do outbox iniciado com {dispatcher.workers} threads")
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    try:
+        stopping.wait()
+    except KeyboardInterrupt:
+        pass
+    dispatcher.stop(timeout=app.config["REMOTE_WEBHOOK_TIMEOUT"])
@@ -0,0 +1,87 @@
+﻿from __future__ import annotations
+
+import base64
+import math
+from datetime import datetime, timezone
+
+
+def encode_cursor(created_at: datetime, message_id: int) -> str:
+    """Build an opaque keyset cursor pointing at ``(created_at, id)``."""
+    return _pack(f"{created_at.isoformat()}|{message_id}")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Return the ``(created_at, id)`` pair stored in a cursor built by :func:`encode_cursor`."""
+    try:
+        created_part, id_part = _unpack(cursor).rsplit("|", 1)
+        return parse_timestamp(created_part), int(id_part)
+    except ValueError as exc:
+        raise ValueError("Cursor invalido") from exc
+
+
+def encode_rank_cursor(rank: float, message_id: int) -> str:
+    """Build an opaque keyset cursor pointing at a ``(rank, id)`` search hit."""
+    return _pack(f"{rank!r}|{message_id}")
+
+
+def decode_rank_cursor(cursor: str) -> tuple[float, int]:
+    """Return the ``(rank, id)`` pair stored in a cursor built by :func:`encode_rank_cursor`."""
+    try:
+        rank_part, id_part = _unpack(cursor).rsplit("|", 1)
+        rank = float(rank_part)
+        if not math.isfinite(rank):
+            raise ValueError(rank_part)
+        return rank, int(id_part)
+    except ValueError as exc:
+        raise ValueError("Cursor invalido") from exc
+
+
+def _pack(raw: str) -> str:
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _unpack(cursor: str) -> str:
+    if not cursor:
+        raise ValueError("Cursor invalido")
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        return base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+    except (UnicodeError, ValueError) as exc:
+        raise ValueError("Cursor invalido") from exc
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse an ISO-8601 timestamp, assuming UTC when no offset is given."""
+    try:
+        parsed = datetime.fromisoformat(value.strip())
+    except ValueError as exc:
+        raise ValueError("Data invalida") from exc
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def parse_message_id(raw: str | None) -> int | None:
+    """Parse the optional ``after_id`` query argument."""
+    if raw is None or raw == "":
+        return None
+    try:
+        value = int(raw)
+    except (TypeError, ValueError) as exc:
+        raise ValueError("after_id invalido") from exc
+    if value < 1:
+        raise ValueError("after_id invalido")
+    return value
+
+
+def parse_limit(raw: str | None, default: int, maximum: int) -> int:
+    """Clamp the ``limit`` query argument to ``1..maximum``."""
+    if raw is None or raw == "":
+        return min(default, maximum)
+    try:
+        value = int(raw)
+    except (TypeError, ValueError) as exc:
+        raise ValueError("limit invalido") from exc
+    if value < 1:
+        raise ValueError("limit invalido")
+    return min(value, maximum)
@@ -0,0 +1,179 @@
+﻿from __future__ import annotations
+
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import REAL, cast, func, select, text, tuple_, update
+from sqlalchemy.dialects.postgresql import REGCONFIG
+
+from .database import get_engine, role_bypasses_rls, session_scope
+from .models import ChatSession, Message
+
+# Must match the trigger in migrations/011_messages_search.sql.
+SEARCH_CONFIG = "portuguese"
+MAX_QUERY_LENGTH = 200
+# Plain-text markers: snippets hold player text and must not be rendered as HTML.
+SNIPPET_OPTIONS = 'StartSel=**, StopSel=**, MaxWords=25, MinWords=8, MaxFragments=2, FragmentDelimiter=" ... "'
+PARENT_INDEX = "idx_messages_content_tsv"
+
+_PARTITIONS_WITHOUT_INDEX = text(
+    """
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'messages'::regclass
+      AND NOT EXISTS (
+          SELECT 1
+          FROM pg_inherits attached
+          JOIN pg_index ix ON ix.indexrelid = attached.inhrelid
+          WHERE attached.inhparent = CAST(:parent AS regclass) AND ix.indrelid = c.oid
+      )
+    ORDER BY c.relname
+    """
+)
+_INDEX_STATE = text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)")
+
+
+def parse_query(raw: str | None) -> str:
+    """Validate the ``q`` argument: web-search syntax (``"frase exata"``, ``-palavra``, ``or``)."""
+    terms = (raw or "").strip()
+    if not terms:
+        raise ValueError("Parametro q obrigatorio")
+    if len(terms) > MAX_QUERY_LENGTH:
+        raise ValueError(f"Busca muito longa (maximo {MAX_QUERY_LENGTH} caracteres)")
+    return terms
+
+
+def search_messages(db, terms: str, anchor: tuple[float, int] | None, limit: int):
+    """Messages matching ``terms``, best rank first, as one keyset page on ``(rank, id)``.
+
+    Every match is ranked (that is what ordering by relevance costs), but
+    the snippet, the expensive part, is only built for the page's rows.
+    Rows the backfill has not reached yet (``content_tsv`` still NULL) and
+    archived sessions never match.
+    """
+    config = cast(SEARCH_CONFIG, REGCONFIG)
+    tsquery = func.websearch_to_tsquery(config, terms)
+    rank = func.ts_rank(Message.content_tsv, tsquery)
+    page = (
+        select(
+            Message.id,
+            Message.session_token,
+            Message.sender,
+            Message.content,
+            Message.created_at,
+            rank.label("rank"),
+        )
+        .where(Message.content_tsv.bool_op("@@")(tsquery))
+        .order_by(rank.desc(), Message.id.desc())
+        .limit(limit + 1)
+    )
+    if anchor is not None:
+        # ts_rank is a real: compare as one, or the cursor's decimal text would not round-trip.
+        page = page.where(tuple_(rank, Message.id) < tuple_(cast(anchor[0], REAL), anchor[1]))
+    page = page.subquery()
+
+    stmt = (
+        select(
+            page.c.id,
+            page.c.session_token,
+            ChatSession.player_id,
+            ChatSession.is_active,
+            page.c.sender,
+            page.c.created_at,
+            page.c.rank,
+            func.ts_headline(config, page.c.content, tsquery, SNIPPET_OPTIONS).label("snippet"),
+        )
+        .join(ChatSession, ChatSession.session_token == page.c.session_token)
+        .order_by(page.c.rank.desc(), page.c.id.desc())
+    )
+    rows = db.execute(stmt).all()
+    return rows[:limit], len(rows) > limit
+
+
+def backfill_batch(db, after_id: int, limit: int) -> tuple[int | None, int]:
+    """Fill ``content_tsv`` for the next ``limit`` message ids after ``after_id``.
+
+    Returns the last id covered (``None`` past the end) and how many rows
+    were updated. Only those rows are locked, for one short transaction.
+    """
+    ids = select(Message.id).where(Message.id > after_id).order_by(Message.id).limit(limit).subquery()
+    last_id = db.execute(select(func.max(ids.c.id))).scalar_one()
+    if last_id is None:
+        return None, 0
+    stmt = (
+        update(Message)
+        .where(Message.id > after_id, Message.id <= last_id, Message.content_tsv.is_(None))
+        .values(content_tsv=func.to_tsvector(cast(SEARCH_CONFIG, REGCONFIG), Message.content))
+        .execution_options(synchronize_session=False)
+    )
+    return last_id, db.execute(stmt).rowcount
+
+
+def index_partitions(connection) -> list[str]:
+    """Build and attach the GIN index of every partition still missing it; returns their names.
+
+    ``connection`` must be in autocommit: each index is built with
+    ``CREATE INDEX CONCURRENTLY``, which does not block writes. A leftover
+    invalid index from an interrupted run is dropped and rebuilt. Once the
+    last partition is attached, Postgres marks the parent index valid.
+    """
+    quote = connection.dialect.identifier_preparer.quote
+    built = []
+    for partition in connection.execute(_PARTITIONS_WITHOUT_INDEX, {"parent": PARENT_INDEX}).scalars().all():
+        name = f"{partition}_content_tsv_idx"
+        valid = connection.execute(_INDEX_STATE, {"name": name}).scalar_one_or_none()
+        if valid is False:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY {quote(name)}"))
+        if not valid:
+            connection.execute(
+                text(f"CREATE INDEX CONCURRENTLY {quote(name)} ON {quote(partition)} USING GIN (content_tsv)")
+            )
+        connection.execute(text(f"ALTER INDEX {quote(PARENT_INDEX)} ATTACH PARTITION {quote(name)}"))
+        built.append(partition)
+    return built
+
+
+@click.command("backfill-search")
+@click.option(
+    "--batch-size", type=int, default=None, help="Mensagens por transacao (default: VALEZAP_SEARCH_BACKFILL_BATCH_SIZE)."
+)
+@click.option("--pause", type=float, default=0.0, show_default=True, help="Segundos de espera entre os lotes.")
+@click.option("--skip-index", is_flag=True, help="Apenas preenche content_tsv, sem criar os indices.")
+@with_appcontext
+def backfill_search_command(batch_size: int | None, pause: float, skip_index: bool) -> None:
+    """Fill content_tsv for existing messages, then index each partition concurrently.
+
+    The column is filled before the indexes exist so the updates stay cheap
+    (no GIN maintenance). Safe to interrupt and run again.
+    """
+    limit = batch_size or current_app.config["SEARCH_BACKFILL_BATCH_SIZE"]
+
+    with session_scope() as db:
+        # Under RLS the batches would see no rows and report success.
+        if not role_bypasses_rls(db):
+            raise click.ClickException("backfill-search precisa de um papel superuser ou BYPASSRLS")
+
+    after_id, updated_total = 0, 0
+    while True:
+        with session_scope() as db:
+            last_id, updated = backfill_batch(db, after_id, limit)
+        if last_id is None:
+            break
+        after_id = last_id
+        updated_total += updated
+        if pause > 0:
+            time.sleep(pause)
+
+    indexed: list[str] = []
+    if not skip_index:
+        with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            indexed = index_partitions(connection)
+
+    current_app.logger.info(
+        "Indice de busca preenchido",
+        extra={"event": "search.backfill.done", "messages_updated": updated_total, "partitions_indexed": indexed},
+    )
+    click.echo(f"{updated_total} mensagens preenchidas; particoes indexadas: {', '.join(indexed) or '-'}")
@@ -0,0 +1,150 @@
+﻿from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from flask import Flask
+from sqlalchemy import select
+
+from .events import get_broker
+from .models import ChatSession
+
+
+@dataclass(frozen=True)
+class SessionState:
+    session_token: str
+    player_id: str
+    is_active: bool
+    expires_at: datetime | None = None
+
+    def is_expired(self, now: datetime | None = None) -> bool:
+        return self.expires_at is not None and self.expires_at <= (now or datetime.now(timezone.utc))
+
+    def is_open(self, now: datetime | None = None) -> bool:
+        """Active and not past ``expires_at``, even if the sweeper has not closed it yet."""
+        return self.is_active and not self.is_expired(now)
+
+
+class SessionStateCache:
+    """Bounded LRU of session ownership/activity with a per-entry TTL.
+
+    ``player_id`` and ``expires_at`` never change and ``is_active`` only flips
+    to ``False``, so
+    an entry can only be wrong by still saying "active" after another worker
+    ended the session. Entries are dropped on the ``sessions_notify`` channel
+    to close that window; the conditional writes in ``conversation`` remain
+    the source of truth, so a stale entry can never store a message in an
+    ended session.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock=time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: OrderedDict[str, tuple[SessionState, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_token: str) -> SessionState | None:
+        with self._lock:
+            entry = self._entries.get(session_token)
+            if entry is None:
+                self.misses += 1
+                return None
+            state, expires_at = entry
+            if expires_at <= self._clock():
+                del self._entries[session_token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_token)
+            self.hits += 1
+            return state
+
+    def put(self, state: SessionState, generation: int | None = None) -> None:
+        """Store ``state`` unless an invalidation happened since ``generation`` was read."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[state.session_token] = (state, self._clock() + self.ttl)
+            self._entries.move_to_end(state.session_token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_token: str | None) -> None:
+        """Drop one session, or everything when ``session_token`` is ``None``."""
+        with self._lock:
+            self.generation += 1
+            if session_token is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(session_token, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_cache: SessionStateCache | None = None
+
+
+def init_session_cache(app: Flask) -> None:
+    """Create the per-process cache and hook it to session-ended events."""
+    global _cache
+
+    if _cache is not None:
+        return
+
+    ttl = app.config.get("SESSION_CACHE_TTL") or app.config["SESSION_TTL"].total_seconds()
+    _cache = SessionStateCache(app.config["SESSION_CACHE_SIZE"], ttl)
+    get_broker().on_session_ended(_cache.invalidate)
+
+
+def get_session_cache() -> SessionStateCache:
+    if _cache is None:
+        raise RuntimeError("Session cache has not been initialized")
+    return _cache
+
+
+def load_session_state(db, session_token: str, use_cache: bool = True) -> SessionState | None:
+    """Return ownership/activity of a session, from the cache when possible."""
+    cache = get_session_cache()
+    if use_cache:
+        state = cache.get(session_token)
+        if state is not None:
+            return state
+
+    generation = cache.generation
+    stmt = select(ChatSession.player_id, ChatSession.is_active, ChatSession.expires_at).where(
+        ChatSession.session_token == session_token
+    )
+    row = db.execute(stmt).first()
+    if row is None:
+        return None
+
+    state = SessionState(
+        session_token=session_token,
+        player_id=row.player_id,
+        is_active=row.is_active,
+        expires_at=row.expires_at,
+    )
+    remember_session(state, generation)
+    return state
+
+
+def remember_session(state: SessionState, generation: int | None = None) -> None:
+    """Cache ``state``, making sure this worker receives invalidations first.
+
+    Nothing is cached while the broker is disconnected, as invalidations
+    would be missed; reads go to the database until it is back.
+    """
+    broker = get_broker()
+    broker.ensure_listening()
+    if not broker.is_listening():
+        return
+    get_session_cache().put(state, generation)
@@ -1,4 +1,4 @@
-(() => {
+﻿(() => {
   const data = (document.body && document.body.dataset) || {};
   const config = {
     maxMessageLength: Number.parseInt(data.maxMessageLength || '700', 10),
@@ -17,6 +17,9 @@
   let sessionToken = null;
   let playerId = null;
   let conversationEnded = false;
+  let historyCursor = null;
+  let messageStream = null;
+  const renderedIds = new Set();
 
   const phonePattern = /^[1-9]\d{7,14}$/;
 
@@ -113,12 +116,27 @@
   }
 
   function renderMessages(messages) {
-    chatLog.innerHTML = '';
+    chatLog.querySelectorAll('.message[data-provisional]').forEach(function (bubble) {
+      bubble.remove();
+    });
     messages.forEach(function (message) {
+      if (message.id != null) {
+        if (renderedIds.has(message.id)) {
+          return;
+        }
+        renderedIds.add(message.id);
+      }
       appendMessage(message);
     });
   }
 
+  function markProvisional(bubble) {
+    if (bubble) {
+      bubble.dataset.provisional = 'true';
+    }
+    return bubble;
+  }
+
   function updateStatus(text, type) {
     if (!text) {
       formStatus.textContent = '';
@@ -148,6 +166,7 @@
 
   function endConversation() {
     conversationEnded = true;
+    closeStream();
     lockInput();
     updateStatus('Conversa encerrada. Obrigado!', 'success');
   }
@@ -247,23 +266,102 @@
     if (!sessionToken) {
       return;
     }
-    const response = await fetch('/api/messages?session_token=' + encodeURIComponent(sessionToken));
-    if (!response.ok) {
-      throw new Error('Falha ao carregar mensagens anteriores');
+    const fresh = [];
+    let isActive = true;
+    let hasMore = true;
+    while (hasMore) {
+      let url = '/api/messages?session_token=' + encodeURIComponent(sessionToken);
+      if (historyCursor) {
+        url += '&cursor=' + encodeURIComponent(historyCursor);
+      }
+      const response = await fetch(url);
+      if (!response.ok) {
+        throw new Error('Falha ao carregar mensagens anteriores');
+      }
+      const payload = await response.json();
+      const page = payload.messages || [];
+      page.forEach(function (message) {
+        fresh.push({
+          id: message.id,
+          sender: (message.sender ? String(message.sender).toLowerCase() : 'valezap'),
+          content: message.content || '',
+          created_at: message.created_at,
+        });
+      });
+      historyCursor = payload.next_cursor || historyCursor;
+      isActive = payload.is_active !== false;
+      hasMore = Boolean(payload.has_more) && page.length > 0;
+    }
+    if (fresh.length) {
+      renderMessages(fresh);
+    }
+    if (!isActive) {
+      endConversation();
+    }
+  }
+
+  // When the server has no stream to spare (503), poll the history instead and retry the stream later.
+  const POLL_INTERVAL_MS = 3000;
+  const POLLS_BEFORE_STREAM_RETRY = 10;
+  let pollTimer = null;
+
+  function pollHistory(remaining) {
+    pollTimer = setTimeout(async function () {
+      pollTimer = null;
+      if (conversationEnded) {
+        return;
+      }
+      try {
+        await loadHistory();
+      } catch (error) {
+        console.error('Falha ao atualizar mensagens', error);
+      }
+      if (remaining > 1) {
+        pollHistory(remaining - 1);
+      } else {
+        openStream();
+      }
+    }, POLL_INTERVAL_MS);
+  }
+
+  function closeStream() {
+    if (messageStream) {
+      messageStream.close();
+      messageStream = null;
+    }
+  }
+
+  function openStream() {
+    if (!sessionToken || conversationEnded || !window.EventSource) {
+      return;
     }
-    const payload = await response.json();
-    const normalised = (payload.messages || []).map(function (message) {
-      return {
+    let url = '/api/messages/stream?session_token=' + encodeURIComponent(sessionToken);
+    if (historyCursor) {
+      url += '&cursor=' + encodeURIComponent(historyCursor);
+    }
+    messageStream = new EventSource(url);
+    messageStream.addEventListener('message', function (event) {
+      const message = JSON.parse(event.data);
+      historyCursor = event.lastEventId || historyCursor;
+      renderMessages([{
         id: message.id,
         sender: (message.sender ? String(message.sender).toLowerCase() : 'valezap'),
         content: message.content || '',
         created_at: message.created_at,
-      };
+      }]);
     });
-    renderMessages(normalised);
-    if (payload.is_active === false) {
+    messageStream.addEventListener('ended', function () {
       endConversation();
-    }
+    });
+    messageStream.addEventListener('error', function () {
+      // CLOSED means the server refused the stream; transient drops reconnect on their own.
+      if (messageStream && messageStream.readyState === EventSource.CLOSED) {
+        closeStream();
+        if (!pollTimer) {
+          pollHistory(POLLS_BEFORE_STREAM_RETRY);
+        }
+      }
+    });
   }
 
   function autoResizeTextarea() {
@@ -291,11 +389,11 @@
     lockInput();
     updateStatus('Enviando...', 'info');
 
-    const pendingBubble = appendMessage({
+    const pendingBubble = markProvisional(appendMessage({
       sender: 'player',
       content: rawMessage,
       created_at: new Date().toISOString(),
-    });
+    }));
     messageInput.value = '';
     autoResizeTextarea();
 
@@ -327,16 +425,18 @@
         }
       }
 
-      if (payload.valezap_message) {
+      if (payload.valezap_message && !messageStream) {
         const valezapMessage = {
           sender: (payload.valezap_message.sender ? String(payload.valezap_message.sender).toLowerCase() : 'valezap'),
           content: payload.valezap_message.content || '',
           created_at: payload.valezap_message.created_at,
         };
-        appendMessage(valezapMessage);
+        markProvisional(appendMessage(valezapMessage));
       }
 
-      await loadHistory();
+      if (!messageStream) {
+        await loadHistory();
+      }
 
       if (payload.ended) {
         endConversation();
@@ -375,6 +475,7 @@
       await loadHistory();
 
       sessionToken = sessionData.session_token;
+      openStream();
       unlockInput();
     } catch (error) {
       console.error('Falha ao inicializar o ValeZap', error);
@@ -0,0 +1,127 @@
+﻿from __future__ import annotations
+
+import signal
+import threading
+
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, update
+
+from .database import role_bypasses_rls, session_scope
+from .idempotency import purge_keys
+from .models import ChatSession
+
+
+def expire_sessions(db, limit: int) -> list[str]:
+    """Close up to ``limit`` active sessions past ``expires_at``; returns their tokens.
+
+    The candidates come from the partial index on active sessions, oldest
+    expiry first, and are locked with ``SKIP LOCKED`` so a batch never waits
+    on (or blocks for long) a request writing to one of them. ``ended_at``
+    records when the session expired, not when it was swept. The
+    ``sessions_notify`` trigger drops each one from the workers' caches.
+    """
+    candidates = (
+        select(ChatSession.id)
+        .where(ChatSession.is_active.is_(True), ChatSession.expires_at <= func.now())
+        .order_by(ChatSession.expires_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(ChatSession)
+        .where(ChatSession.id.in_(candidates.scalar_subquery()))
+        .values(is_active=False, ended_at=ChatSession.expires_at)
+        .returning(ChatSession.session_token)
+        .execution_options(synchronize_session=False)
+    )
+    return db.execute(stmt).scalars().all()
+
+
+def sweep_once(limit: int) -> int:
+    """Expire batches of ``limit`` sessions until a batch comes back short.
+
+    Also drops idempotency keys past their retention, in batches of the same size.
+    """
+    total = 0
+    while True:
+        with session_scope() as db:
+            expired = expire_sessions(db, limit)
+        total += len(expired)
+        if len(expired) < limit:
+            break
+    if total:
+        current_app.logger.info(
+            "Sessoes expiradas encerradas",
+            extra={"event": "session.expired", "count": total},
+        )
+
+    purged = 0
+    while True:
+        with session_scope() as db:
+            deleted = purge_keys(db, current_app.config["IDEMPOTENCY_TTL_SECONDS"], limit)
+        purged += deleted
+        if deleted < limit:
+            break
+    if purged:
+        current_app.logger.info(
+            "Chaves de idempotencia expiradas removidas",
+            extra={"event": "idempotency.purged", "count": purged},
+        )
+    return total
+
+
+class SessionSweeper:
+    """Background thread closing expired sessions every ``interval`` seconds."""
+
+    def __init__(self, app: Flask, interval: float) -> None:
+        self.app = app
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="session-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    sweep_once(self.app.config["SESSION_SWEEP_BATCH_SIZE"])
+                except Exception:  # pragma: no cover - keeps the sweeper alive on DB hiccups
+                    self.app.logger.exception("Erro no sweeper de sessoes", extra={"event": "session.sweeper.error"})
+            self._stop.wait(self.interval)
+
+
+@click.command("sweep-sessions")
+@click.option("--once", is_flag=True, help="Executa uma varredura e sai.")
+@with_appcontext
+def sweep_sessions_command(once: bool) -> None:
+    """Close expired sessions in bounded batches until interrupted."""
+    app = current_app._get_current_object()
+    with session_scope() as db:
+        if not role_bypasses_rls(db):
+            raise click.ClickException("sweep-sessions precisa de um papel superuser ou BYPASSRLS")
+
+    if once:
+        click.echo(f"{sweep_once(app.config['SESSION_SWEEP_BATCH_SIZE'])} sessoes expiradas encerradas")
+        return
+
+    sweeper = SessionSweeper(app, app.config["SESSION_SWEEP_INTERVAL"])
+    sweeper.start()
+    click.echo(f"Sweeper de sessoes iniciado (intervalo de {sweeper.interval}s)")
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    try:
+        stopping.wait()
+    except KeyboardInterrupt:
+        pass
+    sweeper.stop(timeout=sweeper.interval)
@@ -0,0 +1,154 @@
+﻿from __future__ import annotations
+
+import hmac
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Iterator
+
+from flask import Flask, current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestTiming:
+    """Time spent per phase during one request: ``{phase: [seconds, count]}``, in first-seen order."""
+
+    __slots__ = ("started", "phases")
+
+    def __init__(self) -> None:
+        self.started = perf_counter()
+        self.phases: dict[str, list] = {}
+
+    def add(self, phase: str, seconds: float) -> None:
+        entry = self.phases.get(phase)
+        if entry is None:
+            self.phases[phase] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def header(self, total: float) -> str:
+        """``Server-Timing`` value: one metric per phase, then ``total``, in milliseconds."""
+        metrics = [f"{phase};dur={seconds * 1000:.2f}" for phase, (seconds, _) in self.phases.items()]
+        metrics.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(metrics)
+
+    def summary(self) -> dict[str, dict]:
+        return {
+            phase: {"duration_ms": round(seconds * 1000, 2), "count": count}
+            for phase, (seconds, count) in self.phases.items()
+        }
+
+
+# The collector of the request running in this thread; None outside requests
+# (write buffer, outbox dispatcher, CLI), where every hook is one lookup.
+_current: ContextVar[RequestTiming | None] = ContextVar("valezap_request_timing", default=None)
+
+
+def record(phase: str, seconds: float) -> None:
+    """Add ``seconds`` to ``phase`` of the current request, if any."""
+    timing = _current.get()
+    if timing is not None:
+        timing.add(phase, seconds)
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """Time the block as ``phase`` of the current request (nothing outside requests)."""
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(phase, perf_counter() - started)
+
+
+def _statement_phase(context) -> str:
+    if context is not None:
+        if context.isinsert:
+            return "db-insert"
+        if context.isupdate:
+            return "db-update"
+        if context.isdelete:
+            return "db-delete"
+    return "db-query"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if _current.get() is not None:
+        conn.info["timing_started"] = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    started = conn.info.pop("timing_started", None)
+    timing = _current.get()
+    if started is not None and timing is not None:
+        timing.add(_statement_phase(context), perf_counter() - started)
+
+
+def _header_allowed() -> bool:
+    """Whether this request may see ``Server-Timing``: it maps the backend and database latency."""
+    config = current_app.config
+    if config.get("SERVER_TIMING_PUBLIC"):
+        return True
+    trusted = config.get("SERVER_TIMING_TRUSTED_HEADER")
+    # Set by the proxy in front of the app, which must strip it from client requests.
+    if trusted and trusted in request.headers:
+        return True
+    token = config.get("ADMIN_TOKEN")
+    return bool(token) and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+
+
+def init_timing(app: Flask) -> None:
+    """Break each request's time into phases for ``Server-Timing`` and the slow-request log.
+
+    SQL statements are timed by cursor events on every engine (primary,
+    replicas, export), split by kind; the RLS ``set_config`` round trip,
+    commits, the backend call, JSON encoding and compression by ``timed``
+    blocks where they happen. Register before the other request hooks so
+    ``total`` spans them all. The slow-request log covers every request; the
+    header is only sent when ``_header_allowed``. ``SERVER_TIMING=false``
+    installs nothing.
+    """
+    if not app.config.get("SERVER_TIMING", True):
+        return
+
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    @app.before_request
+    def start_timing() -> None:
+        _current.set(RequestTiming())
+
+    @app.after_request
+    def emit_timing(response):
+        timing = _current.get()
+        if timing is None:
+            return response
+        total = perf_counter() - timing.started
+        if _header_allowed():
+            response.headers["Server-Timing"] = timing.header(total)
+
+        threshold = current_app.config.get("SLOW_REQUEST_MS", 0)
+        if threshold > 0 and total * 1000 >= threshold:
+            current_app.logger.warning(
+                "Requisicao lenta",
+                extra={
+                    "event": "request.slow",
+                    "method": request.method,
+                    "route": request.url_rule.rule if request.url_rule is not None else "<unmatched>",
+                    "status": response.status_code,
+                    "duration_ms": round(total * 1000, 2),
+                    "phases": timing.summary(),
+                },
+            )
+        return response
+
+    @app.teardown_request
+    def stop_timing(_exc) -> None:
+        _current.set(None)
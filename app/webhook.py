@@ -3,22 +3,18 @@
 from datetime import datetime, timezone
 
 from flask import Blueprint, abort, current_app, jsonify, request
-from sqlalchemy import select
 
-from .database import session_scope
-from .models import ChatSession, Message, Sender
+from .conversation import record_backend_replies, record_backend_reply, spread_timestamps
+from .database import session_scope, switch_session_identifier
+from .models import Sender
 from .security import is_end_of_conversation, normalise_player
+from .session_state import get_session_cache, load_session_state
+from .write_buffer import PendingMessage, get_write_buffer
 
 webhook_bp = Blueprint("webhook", __name__)
 
 
-def _load_session(db, session_token: str) -> ChatSession | None:
-    stmt = select(ChatSession).where(ChatSession.session_token == session_token)
-    return db.execute(stmt).scalar_one_or_none()
-
-
-@webhook_bp.post("/vale")
-def receive_backend_message():
+def _require_api_key() -> None:
     expected_api_key = current_app.config["WEBHOOK_API_KEY"]
     provided_api_key = request.headers.get("X-API-Key")
     if expected_api_key and provided_api_key != expected_api_key:
@@ -31,43 +27,67 @@ def receive_backend_message():
         )
         abort(401, "API key invalida")
 
-    payload = request.get_json(silent=True) or {}
+
+def _parse_item(payload) -> tuple[str, str, str]:
+    """Validate one ``{sessao, player, mensagem}`` payload; raises ``ValueError``."""
+    if not isinstance(payload, dict):
+        raise ValueError("item invalido")
 
     session_token = payload.get("sessao")
     player = normalise_player(payload.get("player"))
     raw_message = payload.get("mensagem")
 
-    if not session_token:
-        abort(400, "sessao obrigatoria")
+    if not session_token or not isinstance(session_token, str):
+        raise ValueError("sessao obrigatoria")
     if not player:
-        abort(400, "player invalido")
+        raise ValueError("player invalido")
     if not isinstance(raw_message, str):
-        abort(400, "mensagem invalida")
+        raise ValueError("mensagem invalida")
 
     message_text = raw_message.strip()
     if not message_text:
-        abort(400, "mensagem vazia")
+        raise ValueError("mensagem vazia")
+    return session_token, player, message_text
 
-    with session_scope(session_identifier=session_token) as db:
-        chat_session = _load_session(db, session_token)
-        if chat_session is None:
-            abort(404, "Sessao nao encontrada")
-        if chat_session.player_id != player:
-            abort(403, "Sessao nao pertence ao player informado")
 
-        received_at = datetime.now(timezone.utc)
-        incoming = Message(
-            session_token=session_token,
-            sender=Sender.VALEZAP,
-            content=message_text,
-            created_at=received_at,
-        )
-        db.add(incoming)
+@webhook_bp.post("/vale")
+def receive_backend_message():
+    _require_api_key()
 
+    payload = request.get_json(silent=True) or {}
+    try:
+        session_token, player, message_text = _parse_item(payload)
+    except ValueError as exc:
+        abort(400, str(exc))
+
+    cached_state = get_session_cache().get(session_token)
+    if cached_state is not None and cached_state.player_id != player:
+        abort(403, "Sessao nao pertence ao player informado")
+
+    write_buffer = get_write_buffer()
+    if write_buffer is not None:
+        state = cached_state
+        if state is None:
+            with session_scope(session_identifier=session_token) as db:
+                state = load_session_state(db, session_token)
+        if state is None:
+            abort(404, "Sessao nao encontrada")
+        if state.player_id != player:
+            abort(403, "Sessao nao pertence ao player informado")
+        if write_buffer.write(PendingMessage(session_token, player, Sender.VALEZAP, message_text)) is None:
+            with session_scope(session_identifier=session_token) as db:
+                if load_session_state(db, session_token, use_cache=False) is None:
+                    abort(404, "Sessao nao encontrada")
+            abort(403, "Sessao nao pertence ao player informado")
         ended = is_end_of_conversation(message_text)
-        if ended:
-            chat_session.is_active = False
-            chat_session.ended_at = received_at
+    else:
+        with session_scope(session_identifier=session_token) as db:
+            received_at = datetime.now(timezone.utc)
+            message_id, ended = record_backend_reply(db, session_token, message_text, received_at, player_id=player)
+            if message_id is None:
+                if load_session_state(db, session_token, use_cache=False) is None:
+                    abort(404, "Sessao nao encontrada")
+                abort(403, "Sessao nao pertence ao player informado")
 
     current_app.logger.info(
         "Mensagem recebida via webhook",
@@ -80,3 +100,85 @@ def receive_backend_message():
     )
 
     return jsonify({"status": "ok", "ended": ended}), 200
+
+
+@webhook_bp.post("/vale/batch")
+def receive_backend_batch():
+    """Store many backend messages at once.
+
+    Items are grouped by ``(sessao, player)``. All groups share one
+    transaction: the RLS context is switched per group, groups are written in
+    ``sessao`` order (the lock order of the write buffer) and each group is a
+    single multi-row insert (plus the session update when it ends the
+    conversation). Invalid items and unknown/foreign sessions are reported
+    per item without failing the rest of the batch.
+    """
+    _require_api_key()
+
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        abort(400, "lista de mensagens obrigatoria")
+    max_items = current_app.config["WEBHOOK_BATCH_MAX"]
+    if len(items) > max_items:
+        abort(413, f"maximo de {max_items} mensagens por lote")
+
+    results: list[dict] = [{} for _ in items]
+    groups: dict[tuple[str, str], list[tuple[int, str]]] = {}
+    for index, item in enumerate(items):
+        try:
+            session_token, player, message_text = _parse_item(item)
+        except ValueError as exc:
+            results[index] = {"index": index, "status": 400, "error": str(exc)}
+            continue
+        cached_state = get_session_cache().get(session_token)
+        if cached_state is not None and cached_state.player_id != player:
+            results[index] = {"index": index, "status": 403, "error": "Sessao nao pertence ao player informado"}
+            continue
+        groups.setdefault((session_token, player), []).append((index, message_text))
+
+    ended_sessions: list[str] = []
+    if groups:
+        # Sorted so concurrent batches lock the session rows in the same order.
+        ordered = sorted(groups.items())
+        with session_scope(session_identifier=ordered[0][0][0]) as db:
+            received_at = datetime.now(timezone.utc)
+            for position, ((session_token, player), entries) in enumerate(ordered):
+                if position:
+                    switch_session_identifier(db, session_token)
+                contents = [message_text for _, message_text in entries]
+                message_ids, ended = record_backend_replies(
+                    db, session_token, spread_timestamps(contents, received_at), player_id=player
+                )
+                if message_ids is None:
+                    if load_session_state(db, session_token, use_cache=False) is None:
+                        failure = {"status": 404, "error": "Sessao nao encontrada"}
+                    else:
+                        failure = {"status": 403, "error": "Sessao nao pertence ao player informado"}
+                    for index, _ in entries:
+                        results[index] = {"index": index, **failure}
+                    continue
+
+                if ended and session_token not in ended_sessions:
+                    ended_sessions.append(session_token)
+                for (index, _), message_id in zip(entries, message_ids):
+                    results[index] = {
+                        "index": index,
+                        "status": 200,
+                        "id": message_id,
+                        "sessao": session_token,
+                        "ended": ended,
+                    }
+
+    stored = sum(1 for result in results if result.get("status") == 200)
+    current_app.logger.info(
+        "Lote recebido via webhook",
+        extra={
+            "event": "webhook.batch.received",
+            "items": len(items),
+            "stored": stored,
+            "sessions": len(groups),
+            "ended_sessions": len(ended_sessions),
+        },
+    )
+
+    return jsonify({"status": "ok", "stored": stored, "results": results, "ended_sessions": ended_sessions}), 200
@@ -0,0 +1,279 @@
+﻿from __future__ import annotations
+
+import atexit
+import os
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from itertools import groupby
+
+from flask import Flask
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from .conversation import record_backend_replies, record_player_messages, spread_timestamps
+from .database import session_scope, switch_session_identifier
+from .models import ChatSession, Sender
+
+
+# Deadlock and serialization failure: the transaction lost a race, the database is fine.
+_RETRYABLE_SQLSTATES = frozenset({"40P01", "40001"})
+
+
+@dataclass(frozen=True)
+class PendingMessage:
+    session_token: str
+    player_id: str
+    sender: Sender
+    content: str
+
+
+# ``(id, created_at)`` of a stored row, ``None`` when its session did not match.
+StoredMessage = tuple[int, datetime] | None
+
+
+class MessageBuffer:
+    """Per-worker group commit for messages.
+
+    Writers queue a row and wait for it: a background thread writes
+    everything pending every ``flush_interval`` seconds, or as soon as
+    ``max_rows`` rows are waiting, in a single transaction: one multi-row
+    insert per run of same-sender messages of a session, one COMMIT for the
+    whole batch. A writer returns only after its row committed, so every
+    worker reads it from then on and nothing is lost if the process dies.
+
+    The ``created_at`` of each row (the ordering key of cursors and streams)
+    is assigned inside the flush, after the session row is locked: rows of a
+    session become visible in key order, so a cursor never moves past a row
+    that is still uncommitted. Flushes are serialised and the queue is FIFO,
+    so messages of a session keep the order they were queued in.
+
+    Rows are still written with the conditional statements from
+    ``conversation``: a row whose session ended (or never matched) resolves
+    to ``None``. Session rows are locked in token order, the same order as
+    the batch webhook, so concurrent batches never wait on each other in a
+    cycle; a deadlock or serialization failure is still retried once. When
+    the batch transaction fails, its sessions and then its rows are retried
+    in transactions of their own, so a bad row only fails its own writer; a
+    database outage fails the whole batch at once.
+    """
+
+    def __init__(self, app: Flask, max_rows: int, flush_interval: float, max_pending: int) -> None:
+        self.app = app
+        self.max_rows = max(max_rows, 1)
+        self.flush_interval = flush_interval
+        self.max_pending = max(max_pending, self.max_rows)
+        self._reset()
+
+    def _reset(self) -> None:
+        self._pending: list[tuple[PendingMessage, Future]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.rows_failed = 0
+
+    def append(self, message: PendingMessage) -> Future:
+        """Queue ``message``; the future resolves to its ``StoredMessage`` once the flush commits."""
+        self._ensure_started()
+        ticket: Future = Future()
+        with self._lock:
+            self._pending.append((message, ticket))
+            size = len(self._pending)
+        if size >= self.max_pending:
+            # Backpressure: the writer pays for the flush instead of growing the queue.
+            self.flush()
+        elif size >= self.max_rows:
+            self._wake.set()
+        return ticket
+
+    def write(self, message: PendingMessage) -> StoredMessage:
+        """Queue ``message`` and wait for the flush that commits it."""
+        return self.append(message).result()
+
+    def flush(self) -> int:
+        """Write everything pending and wake its writers; returns how many rows were stored."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            with self.app.app_context():
+                outcomes = self._write_isolating([message for message, _ in batch])
+            written = 0
+            for (_, ticket), outcome in zip(batch, outcomes):
+                if isinstance(outcome, Exception):
+                    self.rows_failed += 1
+                    ticket.set_exception(outcome)
+                    continue
+                if outcome is None:
+                    self.rows_dropped += 1
+                else:
+                    written += 1
+                ticket.set_result(outcome)
+            self.flushes += 1
+            self.rows_written += written
+            return written
+
+    def close(self) -> None:
+        """Stop the flusher thread and write whatever is still pending."""
+        self._stop.set()
+        self._wake.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(self.flush_interval * 10 + 5)
+        self.flush()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Forked child: the parent's queue and thread belong to the parent.
+                self._reset()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="write-buffer", daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:  # pragma: no cover - failures reach the writers through their futures
+                self.app.logger.exception(
+                    "Erro ao gravar buffer de mensagens",
+                    extra={"event": "write_buffer.error", "pending": len(self)},
+                )
+
+    def _write_isolating(self, messages: list[PendingMessage]) -> list[StoredMessage | Exception]:
+        """``_write`` in ever smaller transactions until only the failing rows are left."""
+        try:
+            return self._write_retrying(messages)
+        except (OperationalError, PoolTimeoutError) as exc:
+            # The database is unavailable, not the rows: splitting would only multiply the wait.
+            self._log_failure(messages, exc)
+            return [exc] * len(messages)
+        except Exception as exc:
+            if len(messages) == 1:
+                self._log_failure(messages, exc)
+                return [exc]
+            self.app.logger.warning(
+                "Lote do buffer falhou, gravando em partes",
+                extra={"event": "write_buffer.split", "count": len(messages), "error": str(exc)},
+            )
+
+        positions: dict[str, list[int]] = {}
+        for index, message in enumerate(messages):
+            positions.setdefault(message.session_token, []).append(index)
+        if len(positions) > 1:
+            parts = list(positions.values())
+        else:
+            # Row by row, in queue order, so the session keeps its order.
+            parts = [[index] for index in range(len(messages))]
+
+        outcomes: list[StoredMessage | Exception] = [None] * len(messages)
+        for part in parts:
+            for index, outcome in zip(part, self._write_isolating([messages[index] for index in part])):
+                outcomes[index] = outcome
+        return outcomes
+
+    def _write_retrying(self, messages: list[PendingMessage]) -> list[StoredMessage]:
+        try:
+            return self._write(messages)
+        except OperationalError as exc:
+            if getattr(exc.orig, "sqlstate", None) not in _RETRYABLE_SQLSTATES:
+                raise
+            self.app.logger.warning(
+                "Lote do buffer abortado pelo banco, repetindo",
+                extra={"event": "write_buffer.retry", "count": len(messages), "error": str(exc)},
+            )
+        return self._write(messages)
+
+    def _log_failure(self, messages: list[PendingMessage], exc: Exception) -> None:
+        self.app.logger.error(
+            "Mensagens do buffer nao gravadas",
+            extra={
+                "event": "write_buffer.failed",
+                "sessions": len({message.session_token for message in messages}),
+                "count": len(messages),
+                "error": str(exc),
+            },
+        )
+
+    def _write(self, batch: list[PendingMessage]) -> list[StoredMessage]:
+        sessions: dict[str, list[int]] = {}
+        for index, message in enumerate(batch):
+            sessions.setdefault(message.session_token, []).append(index)
+        # Lock order: every writer takes session rows sorted by token.
+        ordered = sorted(sessions.items())
+
+        outcomes: list[StoredMessage] = [None] * len(batch)
+        with session_scope(session_identifier=ordered[0][0]) as db:
+            for position, (session_token, indexes) in enumerate(ordered):
+                if position:
+                    switch_session_identifier(db, session_token)
+                # Stamped under the session row lock: every other write to the session commits before or after us.
+                db.execute(
+                    select(ChatSession.session_token).where(ChatSession.session_token == session_token).with_for_update()
+                )
+                entries = spread_timestamps([batch[index].content for index in indexes], datetime.now(timezone.utc))
+                runs = groupby(zip(indexes, entries), key=lambda pair: (batch[pair[0]].sender, batch[pair[0]].player_id))
+                for (sender, player_id), pairs in runs:
+                    pairs = list(pairs)
+                    run = [entry for _, entry in pairs]
+                    if sender == Sender.PLAYER:
+                        message_ids = record_player_messages(db, session_token, player_id, run)
+                    else:
+                        message_ids, _ = record_backend_replies(db, session_token, run, player_id=player_id)
+                    if message_ids is None:
+                        self.app.logger.warning(
+                            "Mensagens do buffer descartadas",
+                            extra={
+                                "event": "write_buffer.dropped",
+                                "session_token": session_token,
+                                "player": player_id,
+                                "sender": sender.value,
+                                "count": len(run),
+                            },
+                        )
+                        continue
+                    for (index, (_, created_at)), message_id in zip(pairs, message_ids):
+                        outcomes[index] = (message_id, created_at)
+        return outcomes
+
+
+_buffer: MessageBuffer | None = None
+
+
+def init_write_buffer(app: Flask) -> None:
+    """Create the per-process buffer when ``WRITE_BUFFER`` is enabled."""
+    global _buffer
+
+    if _buffer is not None or not app.config["WRITE_BUFFER"]:
+        return
+
+    _buffer = MessageBuffer(
+        app,
+        max_rows=app.config["WRITE_BUFFER_MAX_ROWS"],
+        flush_interval=app.config["WRITE_BUFFER_FLUSH_SECONDS"],
+        max_pending=app.config["WRITE_BUFFER_MAX_PENDING"],
+    )
+
+
+def get_write_buffer() -> MessageBuffer | None:
+    return _buffer
@@ -0,0 +1,93 @@
+﻿"""Local stand-in for the n8n webhook, for load tests.
+
+Answers ``POST`` bodies shaped like ``dispatch_to_backend`` sends them
+(``sessao``, ``player``, ``mensagem``) with ``{"mensagem": ...}`` after a
+configurable delay. A fraction of calls can fail with HTTP 500 and a
+fraction can end the conversation with "fim da interação" (a player
+message "tchau" always does).
+
+    python benchmarks/fake_backend.py --port 8765 --latency-ms 150 --jitter-ms 50 --error-rate 0.01
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+END_REPLY = "fim da interação"
+
+
+class FakeBackendServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms: float, jitter_ms: float, error_rate: float, end_rate: float) -> None:
+        super().__init__(address, FakeBackendHandler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.end_rate = end_rate
+
+
+class FakeBackendHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeBackendServer
+
+    def do_POST(self) -> None:  # noqa: N802 - http.server naming
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._reply(400, {"erro": "json invalido"})
+            return
+
+        server = self.server
+        delay = server.latency_ms + random.uniform(-server.jitter_ms, server.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        if random.random() < server.error_rate:
+            self._reply(500, {"erro": "falha simulada"})
+            return
+
+        message = str(body.get("mensagem", ""))
+        if message.strip().casefold() == "tchau" or random.random() < server.end_rate:
+            self._reply(200, {"mensagem": END_REPLY})
+        else:
+            self._reply(200, {"mensagem": f"eco: {message}"})
+
+    def _reply(self, status: int, payload: dict) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:  # noqa: A002 - keep the output clean
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="latencia media de cada resposta")
+    parser.add_argument("--jitter-ms", type=float, default=20.0, help="variacao uniforme em torno da media")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fracao de respostas HTTP 500")
+    parser.add_argument("--end-rate", type=float, default=0.05, help="fracao de respostas 'fim da interação'")
+    args = parser.parse_args()
+
+    server = FakeBackendServer((args.host, args.port), args.latency_ms, args.jitter_ms, args.error_rate, args.end_rate)
+    print(f"Backend simulado em http://{args.host}:{args.port}/", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
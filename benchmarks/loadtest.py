@@ -0,0 +1,347 @@
+﻿"""Throughput and latency of the app under gunicorn, against a fake n8n backend.
+
+Starts ``benchmarks/fake_backend.py`` and gunicorn (``gunicorn.conf.py``,
+pointing ``VALEZAP_BACKEND_URL`` at the fake), then runs ``--users``
+virtual players for ``--duration`` seconds. Each player opens a session
+and repeats a weighted mix of operations until the conversation ends
+(backend "fim da interação", expiry), when it opens a new one:
+
+- ``send``: ``POST /api/messages`` (waits for the backend reply);
+- ``history``: ``GET /api/messages`` with ``after_id`` and ``If-None-Match``,
+  like the UI polling;
+- ``webhook``: ``POST /webhook/vale``, a message pushed by the backend.
+
+Reports requests/s and p50/p95/p99 latency per operation (``session`` is
+``POST /api/session``). Rate-limited requests (429) are counted in their
+own column, apart from errors and latencies. Unless set in the
+environment, the per-player and per-session rate limits are disabled in
+the gunicorn started here: the run measures the server, not the limiter. ``--save-baseline NAME`` stores the results in
+``benchmarks/baselines/NAME.json``; ``--baseline NAME`` compares against
+it and exits with status 1 when p95 or requests/s regress by more than
+``--tolerance``.
+
+    DATABASE_URL=postgresql+psycopg://... python benchmarks/loadtest.py --users 20 --duration 30 --mix chat
+    python benchmarks/loadtest.py --mix chat --save-baseline chat
+    python benchmarks/loadtest.py --mix chat --baseline chat
+
+Use ``--url`` to target an app that is already running (the fake backend
+and gunicorn are then not started).
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINES_DIR = ROOT / "benchmarks" / "baselines"
+
+# Relative weights of the operations each virtual player repeats.
+MIXES: dict[str, dict[str, int]] = {
+    "chat": {"send": 5, "history": 4, "webhook": 1},
+    "read-heavy": {"send": 1, "history": 8, "webhook": 1},
+    "webhook": {"send": 1, "history": 3, "webhook": 6},
+}
+OPERATIONS = ("session", "send", "history", "webhook")
+
+# Statuses that are part of a normal conversation, not failures.
+EXPECTED_STATUSES = {200, 201, 202, 304}
+CONVERSATION_OVER = {403, 409}
+THROTTLED = 429
+# Applied to the gunicorn started here unless already set in the environment.
+DISABLED_RATE_LIMITS = {
+    "VALEZAP_RATE_LIMIT_PLAYER_PER_MINUTE": "0",
+    "VALEZAP_RATE_LIMIT_SESSION_PER_MINUTE": "0",
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise SystemExit(f"{url} nao respondeu em {timeout:.0f}s")
+
+
+def start_processes(args) -> tuple[str, list[subprocess.Popen]]:
+    backend_port = free_port()
+    app_port = free_port()
+    backend = subprocess.Popen(
+        [
+            sys.executable,
+            str(ROOT / "benchmarks" / "fake_backend.py"),
+            "--port", str(backend_port),
+            "--latency-ms", str(args.backend_latency_ms),
+            "--jitter-ms", str(args.backend_jitter_ms),
+            "--error-rate", str(args.backend_error_rate),
+            "--end-rate", str(args.backend_end_rate),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+
+    env = dict(os.environ, VALEZAP_BACKEND_URL=f"http://127.0.0.1:{backend_port}/webhook")
+    env.setdefault("LOG_LEVEL", "WARNING")
+    for name, value in DISABLED_RATE_LIMITS.items():
+        env.setdefault(name, value)
+    command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-b", f"127.0.0.1:{app_port}"]
+    if args.workers:
+        command += ["-w", str(args.workers)]
+    app = subprocess.Popen([*command, "wsgi:app"], cwd=ROOT, env=env, stderr=subprocess.DEVNULL if args.quiet else None)
+
+    base_url = f"http://127.0.0.1:{app_port}"
+    wait_until_ready(f"http://127.0.0.1:{backend_port}/", timeout=10)
+    wait_until_ready(f"{base_url}/", timeout=30)
+    return base_url, [app, backend]
+
+
+def stop_processes(processes: list[subprocess.Popen]) -> None:
+    for process in processes:
+        process.send_signal(signal.SIGTERM)
+    for process in processes:
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+class VirtualPlayer(threading.Thread):
+    """One player looping over the mix; latencies are kept per operation."""
+
+    def __init__(self, base_url: str, mix: dict[str, int], api_key: str, start_at: float, stop_at: float) -> None:
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.operations = list(mix)
+        self.weights = list(mix.values())
+        self.api_key = api_key
+        self.start_at = start_at
+        self.stop_at = stop_at
+        self.http = requests.Session()
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.throttled: dict[str, int] = defaultdict(int)
+        self.player = f"55119{random.randrange(10**8):08d}"
+        self.token: str | None = None
+        self.last_id = 0
+        self.etag: str | None = None
+        self.counter = 0
+
+    def run(self) -> None:
+        while time.monotonic() < self.stop_at:
+            if self.token is None:
+                self.open_session()
+                continue
+            operation = random.choices(self.operations, self.weights)[0]
+            getattr(self, operation)()
+
+    def call(self, operation: str, method: str, path: str, **kwargs) -> requests.Response | None:
+        started = time.monotonic()
+        try:
+            response = self.http.request(method, f"{self.base_url}{path}", timeout=30, **kwargs)
+        except requests.RequestException:
+            response = None
+        finished = time.monotonic()
+        if started < self.start_at or finished > self.stop_at:
+            return response  # warm-up or cut off by the end of the run
+        status = response.status_code if response is not None else None
+        if status in EXPECTED_STATUSES or status in CONVERSATION_OVER:
+            self.latencies[operation].append(finished - started)
+        elif status == THROTTLED:
+            self.throttled[operation] += 1
+        else:
+            self.errors[operation] += 1
+        return response
+
+    def open_session(self) -> None:
+        response = self.call("session", "POST", "/api/session", json={"player": self.player})
+        if response is not None and response.status_code == 201:
+            self.token = response.json()["session_token"]
+            self.last_id = 0
+            self.etag = None
+        else:
+            time.sleep(0.1)
+
+    def send(self) -> None:
+        self.counter += 1
+        payload = {"session_token": self.token, "player": self.player, "message": f"mensagem {self.counter}"}
+        response = self.call("send", "POST", "/api/messages", json=payload)
+        self._track_conversation(response)
+
+    def history(self) -> None:
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        params = {"session_token": self.token}
+        if self.last_id:
+            params["after_id"] = self.last_id
+        response = self.call("history", "GET", "/api/messages", params=params, headers=headers)
+        if response is None or response.status_code != 200:
+            return
+        self.etag = response.headers.get("ETag")
+        data = response.json()
+        ids = [message["id"] for message in data.get("messages", []) if message.get("id")]
+        if ids:
+            self.last_id = max(self.last_id, *ids)
+        if not data.get("is_active", True):
+            self.token = None
+
+    def webhook(self) -> None:
+        payload = {"sessao": self.token, "player": self.player, "mensagem": "mensagem do backend"}
+        response = self.call("webhook", "POST", "/webhook/vale", json=payload, headers={"X-API-Key": self.api_key})
+        self._track_conversation(response)
+
+    def _track_conversation(self, response: requests.Response | None) -> None:
+        if response is None:
+            return
+        if response.status_code in CONVERSATION_OVER:
+            self.token = None
+        elif response.status_code in (200, 201) and response.json().get("ended"):
+            self.token = None
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of already sorted ``values``."""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(fraction * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def summarise(players: list[VirtualPlayer], measured_seconds: float) -> dict[str, dict[str, float]]:
+    results: dict[str, dict[str, float]] = {}
+    everything: list[float] = []
+    total_errors = total_throttled = 0
+    for operation in OPERATIONS:
+        latencies = sorted(value for player in players for value in player.latencies.get(operation, []))
+        errors = sum(player.errors.get(operation, 0) for player in players)
+        throttled = sum(player.throttled.get(operation, 0) for player in players)
+        if not latencies and not errors and not throttled:
+            continue
+        everything.extend(latencies)
+        total_errors += errors
+        total_throttled += throttled
+        results[operation] = _stats(latencies, errors, throttled, measured_seconds)
+    results["total"] = _stats(sorted(everything), total_errors, total_throttled, measured_seconds)
+    return results
+
+
+def _stats(latencies: list[float], errors: int, throttled: int, seconds: float) -> dict[str, float]:
+    return {
+        "requests": len(latencies) + errors + throttled,
+        "errors": errors,
+        "throttled": throttled,
+        "rps": round(len(latencies) / seconds, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def print_report(results: dict[str, dict[str, float]]) -> None:
+    print(f"{'operacao':<10}{'reqs':>8}{'erros':>7}{'429':>7}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for operation, stats in results.items():
+        print(
+            f"{operation:<10}{stats['requests']:>8}{stats['errors']:>7}{stats.get('throttled', 0):>7}{stats['rps']:>9}"
+            f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}"
+        )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Regressions of p95 (slower) or req/s (lower) beyond ``tolerance``."""
+    regressions = []
+    for operation, stats in results.items():
+        reference = baseline.get("results", {}).get(operation)
+        if not reference:
+            continue
+        if reference["p95_ms"] and stats["p95_ms"] > reference["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{operation}: p95 {stats['p95_ms']}ms > baseline {reference['p95_ms']}ms")
+        if reference["rps"] and stats["rps"] < reference["rps"] * (1 - tolerance):
+            regressions.append(f"{operation}: {stats['rps']} req/s < baseline {reference['rps']} req/s")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mix", choices=sorted(MIXES), default="chat")
+    parser.add_argument("--users", type=int, default=20, help="players simultaneos")
+    parser.add_argument("--duration", type=float, default=30.0, help="segundos medidos")
+    parser.add_argument("--warmup", type=float, default=5.0, help="segundos iniciais descartados")
+    parser.add_argument("--workers", type=int, help="workers do gunicorn (padrao: gunicorn.conf.py)")
+    parser.add_argument("--url", help="usar uma aplicacao ja em execucao")
+    parser.add_argument("--api-key", default=os.environ.get("VALEZAP_WEBHOOK_API_KEY", "apikey"))
+    parser.add_argument("--backend-latency-ms", type=float, default=100.0)
+    parser.add_argument("--backend-jitter-ms", type=float, default=20.0)
+    parser.add_argument("--backend-error-rate", type=float, default=0.0)
+    parser.add_argument("--backend-end-rate", type=float, default=0.05)
+    parser.add_argument("--save-baseline", metavar="NOME", help="grava o resultado em benchmarks/baselines/NOME.json")
+    parser.add_argument("--baseline", metavar="NOME", help="compara com benchmarks/baselines/NOME.json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="piora aceita frente ao baseline (0.2 = 20%%)")
+    parser.add_argument("--quiet", action="store_true", help="oculta a saida do gunicorn")
+    args = parser.parse_args()
+
+    processes: list[subprocess.Popen] = []
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        base_url, processes = start_processes(args)
+
+    try:
+        start_at = time.monotonic() + args.warmup
+        stop_at = start_at + args.duration
+        players = [
+            VirtualPlayer(base_url, MIXES[args.mix], args.api_key, start_at, stop_at) for _ in range(args.users)
+        ]
+        for player in players:
+            player.start()
+        for player in players:
+            player.join(timeout=max(0.0, stop_at - time.monotonic()) + 35)
+    finally:
+        stop_processes(processes)
+
+    results = summarise(players, args.duration)
+    print(f"mix={args.mix} users={args.users} duration={args.duration:.0f}s")
+    print_report(results)
+
+    run = {
+        "mix": args.mix,
+        "users": args.users,
+        "duration": args.duration,
+        "workers": args.workers,
+        "backend_latency_ms": args.backend_latency_ms,
+        "results": results,
+    }
+    if args.save_baseline:
+        BASELINES_DIR.mkdir(parents=True, exist_ok=True)
+        path = BASELINES_DIR / f"{args.save_baseline}.json"
+        path.write_text(json.dumps(run, indent=2) + "\n", encoding="utf-8")
+        print(f"Baseline gravado em {path.relative_to(ROOT)}")
+    if args.baseline:
+        baseline = json.loads((BASELINES_DIR / f"{args.baseline}.json").read_text(encoding="utf-8"))
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressoes frente ao baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"Sem regressoes frente ao baseline {args.baseline} (tolerancia {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
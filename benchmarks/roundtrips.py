@@ -0,0 +1,271 @@
+﻿"""Count database round trips per API request.
+
+Runs the real Flask app against ``DATABASE_URL`` with the backend call
+stubbed out. The app connects through a small TCP proxy that sits between
+the driver and Postgres and counts, per request, every time the client
+sends something and waits for the answer. Whatever issues it (psycopg's
+lazy BEGIN, the ``set_config`` sent with it below SQLAlchemy, the pool's
+pre-ping, prepared statements) shows up, and each round trip is labelled by
+its first message: begin, commit/rollback, the pre-ping or statement.
+
+    DATABASE_URL=postgresql+psycopg://... python benchmarks/roundtrips.py --requests 50
+
+``--baseline REV`` first measures the app as of git revision ``REV``
+(checked out in a temporary worktree) with this same script, then the
+current tree, so before/after numbers come from one command. The database
+must have the migrations of the newer tree; older code ignores the extra
+columns. The proxy talks plain TCP (``sslmode=disable``) to the driver and
+forwards raw bytes, so point it at a local or development database.
+
+    python benchmarks/roundtrips.py --requests 50 --baseline 45acfa4^
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import Counter
+from unittest import mock
+
+from sqlalchemy.engine import make_url
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLAYER = "5511988887777"
+KINDS = ("statement", "begin", "commit", "rollback", "ping", "connect")
+# Startup packets carry no type byte; these request codes precede the real startup message.
+_PRE_STARTUP_CODES = {80877103, 80877104}  # SSLRequest, GSSENCRequest
+
+
+def classify(sql: str) -> str:
+    command = sql.strip().upper()
+    if command.startswith(("BEGIN", "START TRANSACTION")):
+        return "begin"
+    if command.startswith(("COMMIT", "END")):
+        return "commit"
+    if command.startswith(("ROLLBACK", "ABORT")):
+        return "rollback"
+    if command in ("SELECT 1", ";", ""):
+        # pool_pre_ping: SQLAlchemy's psycopg dialect pings with an empty statement.
+        return "ping"
+    return "statement"
+
+
+class _ClientStream:
+    """Frontend messages of one connection, parsed just enough to label round trips."""
+
+    def __init__(self, counts: Counter[str], lock: threading.Lock) -> None:
+        self.counts = counts
+        self.lock = lock
+        self.buffer = bytearray()
+        self.started = False
+        self.statements: dict[bytes, str] = {}
+        self.waiting = False
+        self.unlabelled = False
+
+    def client_sent(self, data: bytes) -> None:
+        if not self.waiting:
+            # The server answered since the client last spoke: this is a new round trip.
+            self.waiting = True
+            self.unlabelled = True
+        self.buffer += data
+        for kind in self._messages():
+            if self.unlabelled and kind is not None:
+                self.unlabelled = False
+                with self.lock:
+                    self.counts[kind] += 1
+
+    def server_sent(self, data: bytes) -> None:
+        self.waiting = False
+
+    def _messages(self):
+        while True:
+            if not self.started:
+                if len(self.buffer) < 8:
+                    return
+                length, code = struct.unpack("!II", self.buffer[:8])
+                if len(self.buffer) < length:
+                    return
+                del self.buffer[:length]
+                self.started = code not in _PRE_STARTUP_CODES
+                yield "connect"
+                continue
+            if len(self.buffer) < 5:
+                return
+            tag, length = self.buffer[:1], struct.unpack("!I", self.buffer[1:5])[0]
+            if len(self.buffer) < length + 1:
+                return
+            body = bytes(self.buffer[5 : length + 1])
+            del self.buffer[: length + 1]
+            yield self._kind(tag, body)
+
+    def _kind(self, tag: bytes, body: bytes) -> str | None:
+        if tag == b"Q":
+            return classify(body.rstrip(b"\0").decode(errors="replace"))
+        if tag == b"P":
+            name, query = body.split(b"\0")[:2]
+            sql = query.decode(errors="replace")
+            if name:
+                self.statements[name] = sql
+            return classify(sql)
+        if tag == b"B":
+            return classify(self.statements.get(body.split(b"\0")[1], ""))
+        if tag == b"p":
+            return "connect"
+        if tag == b"X":
+            # Terminate: nothing comes back.
+            self.unlabelled = False
+            return None
+        return "statement"
+
+
+class RoundTripProxy:
+    """Forward TCP connections to Postgres, counting round trips by kind."""
+
+    def __init__(self, upstream) -> None:
+        self.upstream = upstream
+        self.counts: Counter[str] = Counter()
+        self.lock = threading.Lock()
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def reset(self) -> Counter[str]:
+        with self.lock:
+            counts = Counter(self.counts)
+            self.counts.clear()
+        return counts
+
+    def _connect_upstream(self) -> socket.socket:
+        if isinstance(self.upstream, str):
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.connect(self.upstream)
+            return server
+        return socket.create_connection(self.upstream)
+
+    def _accept(self) -> None:
+        while True:
+            client, _ = self.listener.accept()
+            server = self._connect_upstream()
+            for sock in (client, server):
+                if sock.family != socket.AF_UNIX:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            stream = _ClientStream(self.counts, self.lock)
+            threading.Thread(target=self._pump, args=(client, server, stream.client_sent), daemon=True).start()
+            threading.Thread(target=self._pump, args=(server, client, stream.server_sent), daemon=True).start()
+
+    @staticmethod
+    def _pump(source: socket.socket, target: socket.socket, observe) -> None:
+        try:
+            while data := source.recv(65536):
+                # Observed before forwarding, so a request's count is complete when its reply arrives.
+                observe(data)
+                target.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, target):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def start_proxy(database_url: str) -> tuple[RoundTripProxy, str]:
+    """Start a proxy in front of ``database_url``; returns it and the URL the app must use."""
+    url = make_url(database_url)
+    host = url.host or url.query.get("host") or "localhost"
+    port = url.port or int(url.query.get("port") or 5432)
+    upstream = os.path.join(host, f".s.PGSQL.{port}") if host.startswith("/") else (host, port)
+    proxy = RoundTripProxy(upstream)
+    proxied = (
+        url.set(host="127.0.0.1", port=proxy.port)
+        .difference_update_query(["host", "port"])
+        .update_query_dict({"sslmode": "disable"})
+    )
+    return proxy, proxied.render_as_string(hide_password=False)
+
+
+def fake_backend(session_token: str, player_id: str, message: str) -> dict:
+    return {"mensagem": f"eco: {message}"}
+
+
+def measure(tree: str, requests: int) -> None:
+    proxy, proxied_url = start_proxy(os.environ["DATABASE_URL"])
+    os.environ["DATABASE_URL"] = proxied_url
+    # Only the primary goes through the proxy.
+    os.environ.pop("VALEZAP_DATABASE_REPLICA_URLS", None)
+    # One player sends every message: the rate limiter would answer 429 long before the end.
+    os.environ.setdefault("VALEZAP_RATE_LIMIT_PLAYER_PER_MINUTE", "0")
+    os.environ.setdefault("VALEZAP_RATE_LIMIT_SESSION_PER_MINUTE", "0")
+    sys.path.insert(0, tree)
+    from app import create_app  # the tree being measured, hence the late import
+
+    app = create_app()
+    client = app.test_client()
+    totals: dict[str, list[Counter[str]]] = {}
+
+    def request(label: str, call, record: bool):
+        proxy.reset()
+        response = call()
+        assert response.status_code < 400, (label, response.status_code, response.get_data(as_text=True))
+        counts = proxy.reset()
+        if record:
+            totals.setdefault(label, []).append(counts)
+        return response
+
+    with mock.patch("app.api.dispatch_to_backend", side_effect=fake_backend):
+        # The first pass opens the pooled connection; its handshake is not a per-request cost.
+        for iteration in range(requests + 1):
+            record = iteration > 0
+            session = request("POST /api/session", lambda: client.post("/api/session", json={"player": PLAYER}), record)
+            token = session.get_json()["session_token"]
+            request(
+                "POST /api/messages",
+                lambda: client.post("/api/messages", json={"session_token": token, "player": PLAYER, "message": "ola"}),
+                record,
+            )
+            request("GET /api/messages", lambda: client.get("/api/messages", query_string={"session_token": token}), record)
+
+    print(f"{'request':<22}{'round trips':>12}" + "".join(f"{kind:>11}" for kind in KINDS))
+    for label, samples in totals.items():
+        n = len(samples)
+        merged = sum(samples, Counter())
+        print(
+            f"{label:<22}{sum(merged.values()) / n:>12.2f}" + "".join(f"{merged[kind] / n:>11.2f}" for kind in KINDS)
+        )
+
+
+def measure_revision(revision: str, requests: int) -> None:
+    """Run this script against the tree at ``revision``, in a throwaway worktree."""
+    with tempfile.TemporaryDirectory(prefix="valezap-baseline-") as parent:
+        worktree = os.path.join(parent, "tree")
+        subprocess.run(["git", "-C", ROOT, "worktree", "add", "--detach", "--quiet", worktree, revision], check=True)
+        try:
+            print(f"== {revision}", flush=True)
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--requests", str(requests), "--tree", worktree], check=True
+            )
+        finally:
+            subprocess.run(["git", "-C", ROOT, "worktree", "remove", "--force", worktree], check=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20, help="mensagens enviadas por cenario")
+    parser.add_argument("--baseline", metavar="REV", help="mede antes a revisao git REV, para comparar")
+    parser.add_argument("--tree", default=ROOT, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.baseline:
+        measure_revision(args.baseline, args.requests)
+        print("== working tree", flush=True)
+    measure(args.tree, args.requests)
+
+
+if __name__ == "__main__":
+    main()
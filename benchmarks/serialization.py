@@ -0,0 +1,125 @@
+﻿"""Rows/sec of the GET /api/messages read path: ORM + stdlib JSON vs columns + fast provider.
+
+Loads one long conversation into an in-memory SQLite database (no Postgres
+needed; the driver cost is the same for both variants) and times, per
+variant, fetching the page and encoding the response body:
+
+- ``before``: ``select(Message)`` ORM objects, dicts with ``isoformat()``
+  and ``sender.value``, Flask's default JSON provider.
+- ``after``: ``select(Message.id, ...)`` column rows handed as-is to the
+  app's JSON provider (orjson when installed, see ``app/json_provider.py``).
+
+    python benchmarks/serialization.py --rows 5000 --repeat 20
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.api import _serialize_message  # noqa: E402
+from app.json_provider import JSON_PROVIDERS, init_json_provider  # noqa: E402
+from app.models import Base, ChatSession, Message, Sender  # noqa: E402
+
+TOKEN = "bench"
+
+
+def load(engine, rows: int) -> None:
+    Base.metadata.create_all(engine, tables=[ChatSession.__table__, Message.__table__])
+    start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    with engine.begin() as conn:
+        conn.execute(insert(ChatSession.__table__).values(id=1, session_token=TOKEN, player_id="5511999999999"))
+        conn.execute(
+            insert(Message.__table__),
+            [
+                {
+                    "id": index + 1,
+                    "session_token": TOKEN,
+                    "sender": Sender.PLAYER if index % 2 == 0 else Sender.VALEZAP,
+                    "content": f"mensagem {index} com um texto de tamanho parecido com o real",
+                    "created_at": start + timedelta(seconds=index),
+                }
+                for index in range(rows)
+            ],
+        )
+
+
+def before(engine, provider) -> tuple[float, float]:
+    started = time.perf_counter()
+    with Session(engine) as db:
+        stmt = select(Message).where(Message.session_token == TOKEN).order_by(Message.created_at, Message.id)
+        rows = db.execute(stmt).scalars().all()
+        fetched = time.perf_counter()
+        payload = [
+            {
+                "id": message.id,
+                "sender": message.sender.value,
+                "content": message.content,
+                "created_at": message.created_at.isoformat() if message.created_at else None,
+            }
+            for message in rows
+        ]
+        provider.dumps({"messages": payload})
+    return fetched - started, time.perf_counter() - fetched
+
+
+def after(engine, provider) -> tuple[float, float]:
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        stmt = (
+            select(Message.id, Message.sender, Message.content, Message.created_at)
+            .where(Message.session_token == TOKEN)
+            .order_by(Message.created_at, Message.id)
+        )
+        rows = conn.execute(stmt).all()
+        fetched = time.perf_counter()
+        provider.dumps({"messages": [_serialize_message(row) for row in rows]})
+    return fetched - started, time.perf_counter() - fetched
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000, help="mensagens na conversa")
+    parser.add_argument("--repeat", type=int, default=20, help="repeticoes por variante")
+    parser.add_argument("--provider", choices=["auto", *JSON_PROVIDERS], default="auto")
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://", future=True)
+    load(engine, args.rows)
+
+    flask_app = Flask(__name__)
+    flask_app.config["JSON_PROVIDER"] = args.provider
+    default_provider = DefaultJSONProvider(flask_app)
+    init_json_provider(flask_app)
+
+    variants = {
+        "before (ORM + stdlib)": lambda: before(engine, default_provider),
+        f"after (Core + {type(flask_app.json).__name__})": lambda: after(engine, flask_app.json),
+    }
+
+    print(f"{'variant':<36}{'fetch rows/s':>14}{'encode rows/s':>15}{'total rows/s':>14}")
+    for label, run in variants.items():
+        run()  # warm-up
+        fetch = encode = 0.0
+        for _ in range(args.repeat):
+            fetch_time, encode_time = run()
+            fetch += fetch_time
+            encode += encode_time
+        total_rows = args.rows * args.repeat
+        print(
+            f"{label:<36}{total_rows / fetch:>14,.0f}{total_rows / encode:>15,.0f}"
+            f"{total_rows / (fetch + encode):>14,.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
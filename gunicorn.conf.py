@@ -1,6 +1,60 @@
-﻿bind = "0.0.0.0:8000"
-workers = 3
+﻿import os
+import shutil
+import time
+
+_boot_started = time.monotonic()
+
+# The app sizes each worker's connection pool from this (app/database.py:pool_options),
+# so set threads here rather than with --threads.
+threads = int(os.environ.setdefault("VALEZAP_WORKER_THREADS", "2"))
+workers = int(os.environ.get("WEB_CONCURRENCY", "3"))
+
+# Metrics from every worker are written here and merged on /metrics; the
+# directory must start empty so samples from a previous run do not leak in.
+# Each gunicorn on a host needs its own directory and admission file (see the
+# `stream` process in the Procfile): both are wiped here on start.
+_metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/valezap-metrics")
+shutil.rmtree(_metrics_dir, ignore_errors=True)
+os.makedirs(_metrics_dir, exist_ok=True)
+
+# Token buckets and dispatch slots shared by the workers (app/admission.py).
+_admission_file = os.environ.setdefault(
+    "VALEZAP_ADMISSION_STATE_FILE", os.path.join(os.path.dirname(_metrics_dir), "valezap-admission")
+)
+if os.path.exists(_admission_file):
+    os.remove(_admission_file)
+
+# prometheus_client picks its storage when first imported: only after the env var.
+from prometheus_client import multiprocess  # noqa: E402
+
+bind = "0.0.0.0:8000"
 worker_class = "gthread"
-threads = 2
 preload_app = True
 timeout = 30
+
+
+def when_ready(server):
+    from app.lifecycle import connection_budget
+
+    server.log.info("Master pronto em %.0f ms", (time.monotonic() - _boot_started) * 1000)
+    connection_budget(server.app.wsgi(), server.cfg.workers)
+
+
+def post_fork(server, worker):
+    # The preloaded app's pools hold the master's sockets; the worker starts with empty ones.
+    worker.forked_at = time.monotonic()
+    from app.lifecycle import after_fork
+
+    after_fork()
+
+
+def post_worker_init(worker):
+    # Runs before the worker's accept loop: it takes traffic only with warm connections.
+    from app.lifecycle import warm_up_worker
+
+    warm_up_worker(worker.wsgi, getattr(worker, "forked_at", None))
+
+
+def child_exit(server, worker):
+    # Drops the dead worker's live gauges (pool, open streams) from the totals.
+    multiprocess.mark_process_dead(worker.pid)
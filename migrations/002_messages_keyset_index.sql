@@ -0,0 +1,8 @@
+﻿-- Composite index backing keyset pagination of GET /api/messages.
+-- It also covers lookups by session_token alone, so the single-column
+-- index from 001_init.sql becomes redundant. Run outside a transaction
+-- (plain psql, no BEGIN) because of CONCURRENTLY.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_session_created_id
+    ON messages (session_token, created_at, id);
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_messages_session_token;
@@ -0,0 +1,31 @@
+﻿-- Durable outbox for the asynchronous dispatch mode (VALEZAP_ASYNC_DISPATCH).
+-- The player message and its outbox row are written in the same transaction;
+-- `flask dispatch-outbox` drains the table and stores the backend replies.
+--
+-- Status values follow the SQLAlchemy Enum mapping (member names).
+-- The table is internal to the dispatcher, which claims rows across all
+-- sessions, so it is intentionally not covered by the session RLS policies.
+CREATE TABLE IF NOT EXISTS backend_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    session_token TEXT NOT NULL REFERENCES chat_sessions (session_token) ON DELETE CASCADE,
+    player_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'PENDING'
+        CHECK (status IN ('PENDING', 'PROCESSING', 'DONE', 'FAILED')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    locked_until TIMESTAMPTZ,
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    processed_at TIMESTAMPTZ
+);
+
+-- Only unfinished rows are ever scanned by the dispatcher.
+CREATE INDEX IF NOT EXISTS idx_backend_outbox_open
+    ON backend_outbox (id)
+    WHERE status IN ('PENDING', 'PROCESSING');
+
+-- Per-session ordering check: "is there an older unfinished row for this session?"
+CREATE INDEX IF NOT EXISTS idx_backend_outbox_session_open
+    ON backend_outbox (session_token, id)
+    WHERE status IN ('PENDING', 'PROCESSING');
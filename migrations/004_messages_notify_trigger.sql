@@ -0,0 +1,19 @@
+﻿-- Publish new messages on the `valezap_messages` channel from the database
+-- itself, so writers no longer send a separate `SELECT pg_notify(...)`.
+-- NOTIFY is transactional: listeners only see it after COMMIT, and duplicate
+-- payloads inside one transaction are delivered once.
+CREATE OR REPLACE FUNCTION notify_message_inserted() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify(
+        'valezap_messages',
+        json_build_object('session_token', NEW.session_token)::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS messages_notify ON messages;
+CREATE TRIGGER messages_notify
+    AFTER INSERT ON messages
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_message_inserted();
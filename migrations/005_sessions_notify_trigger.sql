@@ -0,0 +1,18 @@
+﻿-- Announce ended sessions on `valezap_sessions` so every worker drops the
+-- session from its in-process state cache (app/session_state.py).
+CREATE OR REPLACE FUNCTION notify_session_ended() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify(
+        'valezap_sessions',
+        json_build_object('session_token', NEW.session_token)::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sessions_notify ON chat_sessions;
+CREATE TRIGGER sessions_notify
+    AFTER UPDATE OF is_active ON chat_sessions
+    FOR EACH ROW
+    WHEN (OLD.is_active AND NOT NEW.is_active)
+    EXECUTE FUNCTION notify_session_ended();
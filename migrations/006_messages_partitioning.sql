@@ -0,0 +1,133 @@
+﻿-- Range-partition `messages` by month of `created_at` (UTC) and add the
+-- compressed archive used by `flask archive-messages`.
+--
+-- The existing heap is not copied: it is renamed to `messages_legacy` and
+-- attached as the partition holding everything up to the end of the current
+-- month. New months get their own `messages_pYYYYMM` partition, created ahead
+-- of time by `ensure_messages_partition` (the maintenance command calls it);
+-- `messages_default` only catches rows outside every range.
+-- The new primary key index and the bound check each scan the legacy rows
+-- while holding their lock: run it in a quiet window.
+BEGIN;
+
+CREATE OR REPLACE FUNCTION ensure_messages_partition(at TIMESTAMPTZ) RETURNS TEXT AS $$
+DECLARE
+    month_start TIMESTAMPTZ := date_trunc('month', at AT TIME ZONE 'UTC') AT TIME ZONE 'UTC';
+    partition_name TEXT := 'messages_p' || to_char(month_start AT TIME ZONE 'UTC', 'YYYYMM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+    -- Skip months already covered by another partition (e.g. messages_legacy).
+    IF EXISTS (
+        SELECT 1
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+          AND c.relname <> 'messages_default'
+          AND (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''(.*)''\)'))[1]::timestamptz > month_start
+          AND coalesce(
+                (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'FROM \(''(.*)''\) TO'))[1]::timestamptz,
+                '-infinity'
+              ) <= month_start
+    ) THEN
+        RETURN NULL;
+    END IF;
+
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+        partition_name,
+        month_start,
+        month_start + INTERVAL '1 month'
+    );
+    -- Partitions are never queried directly; without policies this denies direct access.
+    EXECUTE format('ALTER TABLE %I ENABLE ROW LEVEL SECURITY', partition_name);
+    EXECUTE format('ALTER TABLE %I FORCE ROW LEVEL SECURITY', partition_name);
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    legacy_end TIMESTAMPTZ := (date_trunc('month', now() AT TIME ZONE 'UTC') + INTERVAL '1 month') AT TIME ZONE 'UTC';
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass) = 'p' THEN
+        RETURN;
+    END IF;
+
+    DROP TRIGGER IF EXISTS messages_notify ON messages;
+    ALTER TABLE messages RENAME TO messages_legacy;
+    -- Partition keys must be part of the primary key.
+    ALTER TABLE messages_legacy DROP CONSTRAINT messages_pkey;
+    ALTER TABLE messages_legacy ADD CONSTRAINT messages_legacy_pkey PRIMARY KEY (id, created_at);
+    ALTER INDEX IF EXISTS idx_messages_session_created_id RENAME TO idx_messages_legacy_session_created_id;
+    DROP INDEX IF EXISTS idx_messages_created_at;
+    DROP INDEX IF EXISTS idx_messages_session_token;
+
+    CREATE TABLE messages (
+        id BIGINT NOT NULL DEFAULT nextval('messages_id_seq'),
+        session_token TEXT NOT NULL REFERENCES chat_sessions (session_token) ON DELETE CASCADE,
+        sender TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+
+    ALTER TABLE messages_legacy ALTER COLUMN id DROP DEFAULT;
+    ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+    CREATE INDEX idx_messages_session_created_id ON messages (session_token, created_at, id);
+
+    EXECUTE format(
+        'ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        legacy_end
+    );
+    CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+    ALTER TABLE messages_default ENABLE ROW LEVEL SECURITY;
+    ALTER TABLE messages_default FORCE ROW LEVEL SECURITY;
+
+    PERFORM ensure_messages_partition(legacy_end);
+    PERFORM ensure_messages_partition(legacy_end + INTERVAL '1 month');
+END
+$$;
+
+ALTER TABLE messages ENABLE ROW LEVEL SECURITY;
+ALTER TABLE messages FORCE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS messages_owner ON messages;
+CREATE POLICY messages_owner ON messages
+    USING (session_token = current_setting('app.current_session_id', true));
+
+DROP POLICY IF EXISTS messages_insert ON messages;
+CREATE POLICY messages_insert ON messages
+    FOR INSERT
+    WITH CHECK (session_token = current_setting('app.current_session_id', true));
+
+DROP TRIGGER IF EXISTS messages_notify ON messages;
+CREATE TRIGGER messages_notify
+    AFTER INSERT ON messages
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_message_inserted();
+
+-- One row per archived session: gzip-compressed JSON of its messages
+-- ([id, sender, content, created_at] entries, oldest first).
+CREATE TABLE IF NOT EXISTS messages_archive (
+    session_token TEXT PRIMARY KEY REFERENCES chat_sessions (session_token) ON DELETE CASCADE,
+    message_count INTEGER NOT NULL,
+    first_message_at TIMESTAMPTZ NOT NULL,
+    last_message_at TIMESTAMPTZ NOT NULL,
+    payload BYTEA NOT NULL,
+    archived_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- The payload is already compressed; keep TOAST from trying again.
+ALTER TABLE messages_archive ALTER COLUMN payload SET STORAGE EXTERNAL;
+
+ALTER TABLE messages_archive ENABLE ROW LEVEL SECURITY;
+ALTER TABLE messages_archive FORCE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS messages_archive_owner ON messages_archive;
+CREATE POLICY messages_archive_owner ON messages_archive
+    USING (session_token = current_setting('app.current_session_id', true));
+
+COMMIT;
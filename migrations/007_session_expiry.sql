@@ -0,0 +1,28 @@
+﻿-- Persist session expiry and index the sessions the sweeper has to close.
+-- The index is built after the transaction because of CONCURRENTLY.
+--
+-- Adding a nullable column is metadata-only. Sessions that are still active
+-- get `created_at + 2 hours` (the VALEZAP_SESSION_HOURS default); adjust the
+-- interval if the deployment uses another TTL. Ended sessions keep NULL.
+BEGIN;
+
+ALTER TABLE chat_sessions ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ;
+
+-- FORCE would apply the session policy to the owner running the migration
+-- and hide every row from the backfill.
+ALTER TABLE chat_sessions NO FORCE ROW LEVEL SECURITY;
+
+UPDATE chat_sessions
+SET expires_at = created_at + INTERVAL '2 hours'
+WHERE is_active AND expires_at IS NULL;
+
+ALTER TABLE chat_sessions FORCE ROW LEVEL SECURITY;
+
+COMMIT;
+
+-- Only active sessions are indexed, so the index stays as small as the
+-- active set: the sweeper range-scans `expires_at <= now()` and counting
+-- live sessions scans `expires_at > now()`.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_sessions_active_expires
+    ON chat_sessions (expires_at)
+    WHERE is_active;
@@ -0,0 +1,27 @@
+﻿-- Outcomes of `POST /api/messages` requests sent with an `Idempotency-Key`
+-- header, shared by every worker. A row without `completed_at` is a request
+-- still in flight; its duplicates wait for it instead of dispatching again.
+-- Rows older than VALEZAP_IDEMPOTENCY_TTL are deleted by `flask sweep-sessions`.
+--
+-- There is no foreign key to chat_sessions: a key is claimed before the
+-- session is validated and released again when the request fails.
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    session_token TEXT NOT NULL,
+    key TEXT NOT NULL,
+    request_hash TEXT NOT NULL,
+    status_code INTEGER,
+    response_body TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMPTZ,
+    PRIMARY KEY (session_token, key)
+);
+
+-- Retention sweep: oldest rows first.
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at);
+
+ALTER TABLE idempotency_keys ENABLE ROW LEVEL SECURITY;
+ALTER TABLE idempotency_keys FORCE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS idempotency_keys_owner ON idempotency_keys;
+CREATE POLICY idempotency_keys_owner ON idempotency_keys
+    USING (session_token = current_setting('app.current_session_id', true));
@@ -0,0 +1,18 @@
+﻿-- Read-only role for the analytics export (`flask export-sessions` and
+-- `GET /api/admin/export`). BYPASSRLS lets it read every session; only a
+-- superuser can grant it, so run this script as one. The role is created
+-- without login: give it one and point VALEZAP_EXPORT_DATABASE_URL at it.
+--
+--   ALTER ROLE valezap_export WITH LOGIN PASSWORD '...';
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'valezap_export') THEN
+        CREATE ROLE valezap_export NOLOGIN BYPASSRLS;
+    END IF;
+END
+$$;
+
+ALTER ROLE valezap_export SET default_transaction_read_only = on;
+
+GRANT USAGE ON SCHEMA public TO valezap_export;
+GRANT SELECT ON chat_sessions, messages, messages_archive TO valezap_export;
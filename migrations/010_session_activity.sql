@@ -0,0 +1,43 @@
+﻿-- Per-session activity kept on chat_sessions, so "how many sessions are
+-- active, how busy is each one, when did it last speak" never scans
+-- `messages`. The statement inserting messages also updates these columns
+-- (app/conversation.py).
+--
+-- Nothing here rewrites or scans the table under ACCESS EXCLUSIVE: the
+-- columns have a constant default (a catalog change), the CHECK is added
+-- NOT VALID and validated afterwards under SHARE UPDATE EXCLUSIVE, and the
+-- index is built CONCURRENTLY. Existing sessions are filled afterwards by
+-- `flask backfill-activity`, in short batches. Sender values follow the
+-- SQLAlchemy Enum mapping (member names).
+BEGIN;
+
+-- Give up instead of queueing every query behind a long transaction.
+SET LOCAL lock_timeout = '5s';
+
+ALTER TABLE chat_sessions
+    ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS last_sender TEXT;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'chat_sessions'::regclass AND conname = 'chat_sessions_last_sender_check'
+    ) THEN
+        ALTER TABLE chat_sessions
+            ADD CONSTRAINT chat_sessions_last_sender_check
+            CHECK (last_sender IN ('PLAYER', 'VALEZAP')) NOT VALID;
+    END IF;
+END
+$$;
+
+COMMIT;
+
+ALTER TABLE chat_sessions VALIDATE CONSTRAINT chat_sessions_last_sender_check;
+
+-- Active sessions by last activity (sessions that never spoke sort by
+-- created_at), newest first: the admin listing reads it as a keyset range.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_sessions_active_activity
+    ON chat_sessions (COALESCE(last_message_at, created_at) DESC, id DESC)
+    WHERE is_active;
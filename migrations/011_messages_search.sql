@@ -0,0 +1,32 @@
+﻿-- Full-text search over message content (Portuguese configuration).
+--
+-- A STORED generated column would rewrite every partition of `messages`
+-- under an exclusive lock. Instead `content_tsv` is a plain nullable column
+-- (adding it only touches the catalog) that a trigger fills on insert.
+-- Existing rows and the per-partition GIN indexes are built afterwards by
+-- `flask backfill-search`, in short batches and with CREATE INDEX
+-- CONCURRENTLY, while the application keeps writing.
+--
+-- The parent index is created ON ONLY `messages`: it stays invalid, and
+-- costs nothing, until the command has attached an index for every
+-- partition. Partitions created later get theirs automatically.
+BEGIN;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_tsv TSVECTOR;
+
+CREATE OR REPLACE FUNCTION messages_content_tsv() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.content_tsv := to_tsvector('portuguese', NEW.content);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS messages_content_tsv ON messages;
+CREATE TRIGGER messages_content_tsv
+    BEFORE INSERT OR UPDATE OF content ON messages
+    FOR EACH ROW
+    EXECUTE FUNCTION messages_content_tsv();
+
+CREATE INDEX IF NOT EXISTS idx_messages_content_tsv ON ONLY messages USING GIN (content_tsv);
+
+COMMIT;
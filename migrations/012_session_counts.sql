@@ -0,0 +1,24 @@
+﻿-- Session counts for the /metrics gauges (`valezap_active_sessions`,
+-- `valezap_expired_open_sessions`).
+--
+-- Under FORCE ROW LEVEL SECURITY the application role only sees the session
+-- of the current request, so it cannot count them itself. This function
+-- runs as `valezap_export` (BYPASSRLS, `009_export_role.sql`) and only
+-- returns the two totals, never a row. Run this script as a superuser.
+CREATE OR REPLACE FUNCTION valezap_session_counts(OUT active BIGINT, OUT awaiting_sweep BIGINT)
+    LANGUAGE sql
+    STABLE
+    SECURITY DEFINER
+    SET search_path = pg_catalog, public
+AS $$
+    SELECT count(*) FILTER (WHERE expires_at IS NULL OR expires_at > now()),
+           count(*) FILTER (WHERE expires_at <= now())
+    FROM public.chat_sessions
+    WHERE is_active
+$$;
+
+ALTER FUNCTION valezap_session_counts() OWNER TO valezap_export;
+
+-- Callable by any role, as it only exposes two numbers. To restrict it:
+--   REVOKE EXECUTE ON FUNCTION valezap_session_counts() FROM PUBLIC;
+--   GRANT EXECUTE ON FUNCTION valezap_session_counts() TO <papel da aplicacao>;
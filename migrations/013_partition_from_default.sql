@@ -0,0 +1,65 @@
+﻿-- `ensure_messages_partition` (006) could only create a month nobody had
+-- written to yet. When `flask archive-messages` had not run before a month
+-- began, that month's rows landed in `messages_default`, and
+-- `CREATE TABLE ... PARTITION OF` for it then failed on them.
+--
+-- The new partition is now built detached: the month's rows are moved out
+-- of `messages_default` into it, then it is attached, all in the caller's
+-- transaction. `messages_default` stays locked while that happens, which
+-- only matters when it actually holds rows for the month.
+CREATE OR REPLACE FUNCTION ensure_messages_partition(at TIMESTAMPTZ) RETURNS TEXT AS $$
+DECLARE
+    month_start TIMESTAMPTZ := date_trunc('month', at AT TIME ZONE 'UTC') AT TIME ZONE 'UTC';
+    month_end TIMESTAMPTZ := month_start + INTERVAL '1 month';
+    partition_name TEXT := 'messages_p' || to_char(month_start AT TIME ZONE 'UTC', 'YYYYMM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+    -- Skip months already covered by another partition (e.g. messages_legacy).
+    IF EXISTS (
+        SELECT 1
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+          AND c.relname <> 'messages_default'
+          AND (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''(.*)''\)'))[1]::timestamptz > month_start
+          AND coalesce(
+                (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'FROM \(''(.*)''\) TO'))[1]::timestamptz,
+                '-infinity'
+              ) <= month_start
+    ) THEN
+        RETURN NULL;
+    END IF;
+
+    LOCK TABLE messages_default IN SHARE ROW EXCLUSIVE MODE;
+    IF EXISTS (SELECT 1 FROM messages_default WHERE created_at >= month_start AND created_at < month_end) THEN
+        EXECUTE format('CREATE TABLE %I (LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM messages_default WHERE created_at >= %L AND created_at < %L RETURNING *) '
+            'INSERT INTO %I SELECT * FROM moved',
+            month_start,
+            month_end,
+            partition_name
+        );
+        -- Attaching builds the partition's indexes and clones the parent's triggers.
+        EXECUTE format(
+            'ALTER TABLE messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+            partition_name,
+            month_start,
+            month_end
+        );
+    ELSE
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+            partition_name,
+            month_start,
+            month_end
+        );
+    END IF;
+    -- Partitions are never queried directly; without policies this denies direct access.
+    EXECUTE format('ALTER TABLE %I ENABLE ROW LEVEL SECURITY', partition_name);
+    EXECUTE format('ALTER TABLE %I FORCE ROW LEVEL SECURITY', partition_name);
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
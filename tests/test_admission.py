@@ -0,0 +1,147 @@
+﻿import os
+import threading
+
+import pytest
+from flask import Flask
+
+from app import admission
+from app.admission import SharedLimits, check_rate_limits
+
+
+def test_token_bucket_allows_burst_then_refills():
+    limits = SharedLimits(None, bucket_count=64, dispatch_slots=0, queue_slots=0)
+    bucket = [("player:1", 1.0, 3)]
+
+    assert [limits.take(bucket, now=100.0) for _ in range(3)] == [0, 0, 0]
+    assert limits.take(bucket, now=100.0) == pytest.approx(1.0)
+    assert limits.take(bucket, now=101.0) == 0
+
+
+def test_all_buckets_must_have_a_token():
+    limits = SharedLimits(None, bucket_count=64, dispatch_slots=0, queue_slots=0)
+    limits.take([("session:a", 1.0, 1)], now=0.0)
+
+    # The session is empty, so the player's token must not be spent either.
+    assert limits.take([("player:1", 1.0, 1), ("session:a", 1.0, 1)], now=0.0) > 0
+    assert limits.take([("player:1", 1.0, 1)], now=0.0) == 0
+
+
+def test_state_file_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "admission")
+    first = SharedLimits(path, bucket_count=64, dispatch_slots=1, queue_slots=0)
+    second = SharedLimits(path, bucket_count=64, dispatch_slots=1, queue_slots=0)
+
+    assert first.take([("player:1", 1.0, 1)], now=5.0) == 0
+    assert second.take([("player:1", 1.0, 1)], now=5.0) > 0
+
+    slot = first.acquire_dispatch(timeout=0)
+    assert slot is not None
+    assert second.acquire_dispatch(timeout=0) is None  # no queue slots: shed at once
+    first.release_dispatch(slot)
+    assert second.acquire_dispatch(timeout=0) == slot
+
+
+def test_slot_of_dead_process_is_reclaimed():
+    limits = SharedLimits(None, bucket_count=4, dispatch_slots=1, queue_slots=1)
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover - child exits immediately
+        os._exit(0)
+    os.waitpid(pid, 0)
+    with limits._locked() as buffer:
+        admission._SLOT.pack_into(buffer, limits._dispatch_offset, pid, 0.0)
+
+    assert limits.acquire_dispatch(timeout=0) == 0
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config.update(
+        RATE_LIMIT_PLAYER_PER_MINUTE=60,
+        RATE_LIMIT_PLAYER_BURST=1,
+        RATE_LIMIT_SESSION_PER_MINUTE=0,
+        RATE_LIMIT_SESSION_BURST=1,
+        RATE_LIMIT_BUCKETS=64,
+        DISPATCH_CONCURRENCY=1,
+        DISPATCH_QUEUE_SIZE=0,
+        DISPATCH_QUEUE_TIMEOUT=0.05,
+    )
+    admission.init_admission(app)
+
+    @app.post("/send/<player>")
+    def send(player):
+        check_rate_limits(player, "sessao")
+        admission.reserve_dispatch_slot()
+        return {"ok": True}
+
+    return app
+
+
+def test_rate_limited_request_gets_429_with_retry_after(app):
+    client = app.test_client()
+
+    assert client.post("/send/a").status_code == 200
+    response = client.post("/send/a")
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert response.get_json()["error"] == "Too Many Requests"
+    assert client.post("/send/b").status_code == 200
+
+
+def test_saturated_dispatch_is_shed_with_503(app):
+    slot = admission.get_limits().acquire_dispatch(timeout=0)
+    try:
+        response = app.test_client().post("/send/c")
+    finally:
+        admission.get_limits().release_dispatch(slot)
+
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    # The slot held by the request itself was released at teardown.
+    assert admission.get_limits().dispatches_in_flight() == 0
+
+
+def test_streams_beyond_worker_capacity_get_503():
+    app = Flask(__name__)
+    app.config.update(STREAM_MAX_OPEN=1, STREAM_HEARTBEAT_SECONDS=15)
+    releases = []
+
+    @app.get("/stream")
+    def stream():
+        releases.append(admission.reserve_stream_slot())
+        return {"ok": True}
+
+    client = app.test_client()
+    assert client.get("/stream").status_code == 200
+    refused = client.get("/stream")
+    assert refused.status_code == 503
+    assert refused.headers["Retry-After"] == "15"
+
+    releases[0]()
+    releases[0]()  # releasing twice frees one slot only
+    assert client.get("/stream").status_code == 200
+    releases[1]()
+
+
+def test_stream_capacity_defaults_to_half_the_threads():
+    assert admission.stream_capacity({"STREAM_MAX_OPEN": -1, "WORKER_THREADS": 8}) == 4
+    assert admission.stream_capacity({"STREAM_MAX_OPEN": 0, "WORKER_THREADS": 8}) == 0
+
+
+def test_background_dispatch_waits_for_a_slot(app):
+    limits = admission.get_limits()
+    held = limits.acquire_dispatch(timeout=0)
+    entered = threading.Event()
+
+    def dispatch():
+        with app.app_context(), admission.dispatch_slot():
+            entered.set()
+
+    worker = threading.Thread(target=dispatch)
+    worker.start()
+    assert not entered.wait(0.2)
+    limits.release_dispatch(held)
+    assert entered.wait(2)
+    worker.join()
+    assert limits.dispatches_in_flight() == 0
@@ -0,0 +1,145 @@
+﻿"""Archive payloads; the archiving, partition and history tests need ``VALEZAP_TEST_DATABASE_URL`` (superuser or BYPASSRLS)."""
+import os
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import pytest
+from flask import Flask
+from sqlalchemy import select, text
+
+from app import admission, database, events, session_state, write_buffer
+from app.api import api_bp
+from app.archive import archive_ended_sessions, pack_messages, select_after, unpack_messages
+from app.events import LocalBroker
+from app.json_provider import init_json_provider
+from app.models import ChatSession, Message, MessageArchive, Sender
+from app.session_state import SessionStateCache
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+
+T0 = datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+
+MESSAGES = [
+    (10, Sender.PLAYER, "olá", T0),
+    (11, Sender.VALEZAP, "eco: olá", T0 + timedelta(seconds=1)),
+    (12, Sender.PLAYER, "tchau", T0 + timedelta(seconds=1)),
+]
+
+
+def test_pack_round_trip_keeps_order_and_types():
+    payload = pack_messages(MESSAGES)
+    assert payload[:2] == b"\x1f\x8b"
+    assert unpack_messages(payload) == MESSAGES
+
+
+def test_select_after_matches_keyset_semantics():
+    assert [message[0] for message in select_after(MESSAGES, anchor=(T0 + timedelta(seconds=1), 11))] == [12]
+    assert [message[0] for message in select_after(MESSAGES, since=T0)] == [11, 12]
+    assert select_after(MESSAGES) == MESSAGES
+
+
+@pytest.fixture
+def db_app(monkeypatch):
+    if not DATABASE_URL:
+        pytest.skip("VALEZAP_TEST_DATABASE_URL nao definido")
+    monkeypatch.setattr(events, "_broker", LocalBroker(None))
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    monkeypatch.setattr(session_state, "_cache", SessionStateCache(maxsize=16, ttl=60))
+    monkeypatch.setattr(write_buffer, "_buffer", None)
+    monkeypatch.setattr(admission, "_limits", None)
+    app = Flask(__name__)
+    app.config.update(DATABASE_URL=DATABASE_URL, MESSAGES_PAGE_SIZE=2, MESSAGES_PAGE_MAX=10)
+    init_json_provider(app)
+    app.register_blueprint(api_bp, url_prefix="/api")
+    database.init_engine(app)
+    tokens = []
+    yield app, tokens
+    with database.session_scope() as db:
+        db.execute(text("DELETE FROM chat_sessions WHERE session_token = ANY(:t)"), {"t": tokens})
+    database.get_engine().dispose()
+
+
+# Older than any real session, so ``archive_ended_sessions(..., limit=1)`` picks the test's one.
+ENDED_AT = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+def ended_session(tokens, contents):
+    token = uuid4().hex
+    with database.session_scope() as db:
+        db.add(ChatSession(session_token=token, player_id="5511999999999", is_active=False, ended_at=ENDED_AT))
+    tokens.append(token)
+    for offset, (sender, content) in enumerate(contents):
+        add_message(token, sender, content, T0 + timedelta(seconds=2 * offset))
+    return token
+
+
+def add_message(token, sender, content, created_at):
+    with database.session_scope() as db:
+        db.execute(
+            text("INSERT INTO messages (session_token, sender, content, created_at) VALUES (:t, :sender, :c, :at)"),
+            {"t": token, "sender": sender.name, "c": content, "at": created_at},
+        )
+
+
+def archive_one():
+    with database.session_scope() as db:
+        return archive_ended_sessions(db, datetime.now(timezone.utc), limit=1)
+
+
+def stored(token):
+    with database.session_scope() as db:
+        live = db.execute(select(Message.content).where(Message.session_token == token)).scalars().all()
+        payload = db.execute(
+            select(MessageArchive.payload).where(MessageArchive.session_token == token)
+        ).scalar_one_or_none()
+    return live, [message.content for message in unpack_messages(payload)] if payload is not None else None
+
+
+def test_archive_moves_ended_sessions_and_merges_late_messages(db_app):
+    _, tokens = db_app
+    token = ended_session(tokens, [(Sender.PLAYER, "oi"), (Sender.VALEZAP, "fim da interacao")])
+
+    assert archive_one() == (1, 2)
+    assert stored(token) == ([], ["oi", "fim da interacao"])
+
+    # Stored after archiving, with a timestamp between the archived ones.
+    add_message(token, Sender.PLAYER, "atrasada", T0 + timedelta(seconds=1))
+    assert archive_one() == (1, 1)
+    assert stored(token) == ([], ["oi", "atrasada", "fim da interacao"])
+
+
+def test_history_of_an_archived_session_merges_live_messages(db_app):
+    app, tokens = db_app
+    token = ended_session(tokens, [(Sender.PLAYER, "oi"), (Sender.VALEZAP, "fim da interacao")])
+    archive_one()
+    add_message(token, Sender.PLAYER, "atrasada", T0 + timedelta(seconds=1))
+    client = app.test_client()
+
+    first = client.get("/api/messages", query_string={"session_token": token}).get_json()
+    second = client.get("/api/messages", query_string={"session_token": token, "cursor": first["next_cursor"]}).get_json()
+
+    assert [message["content"] for message in first["messages"]] == ["oi", "atrasada"]
+    assert first["has_more"] and not first["is_active"]
+    assert [message["content"] for message in second["messages"]] == ["fim da interacao"]
+    assert not second["has_more"]
+
+
+def test_partition_is_created_for_a_month_already_in_the_default_partition(db_app):
+    token = uuid4().hex
+    month = datetime(2099, 1, 15, tzinfo=timezone.utc)
+    with database.get_engine().connect() as conn:
+        # Rolled back at the end: nothing, not even the partition, outlives the test.
+        conn.execute(text("INSERT INTO chat_sessions (session_token, player_id) VALUES (:t, 'p')"), {"t": token})
+        conn.execute(
+            text("INSERT INTO messages (session_token, sender, content, created_at) VALUES (:t, 'PLAYER', 'oi', :at)"),
+            {"t": token, "at": month},
+        )
+        placed = text("SELECT tableoid::regclass::text FROM messages WHERE session_token = :t")
+        assert conn.execute(placed, {"t": token}).scalar_one() == "messages_default"
+
+        created = conn.execute(text("SELECT ensure_messages_partition(:at)"), {"at": month}).scalar_one()
+
+        assert created == "messages_p209901"
+        assert conn.execute(placed, {"t": token}).scalar_one() == "messages_p209901"
+        conn.rollback()
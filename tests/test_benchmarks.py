@@ -0,0 +1,68 @@
+﻿"""Smoke runs of the benchmark scripts that need no Postgres, so they keep working as the app changes."""
+import runpy
+import struct
+import sys
+import threading
+from collections import Counter
+from pathlib import Path
+
+BENCHMARKS = Path(__file__).resolve().parent.parent / "benchmarks"
+
+
+def run_script(monkeypatch, name, *args):
+    monkeypatch.setattr(sys, "argv", [name, *args])
+    runpy.run_path(str(BENCHMARKS / name), run_name="__main__")
+
+
+def test_serialization_benchmark_runs_on_sqlite(monkeypatch, capsys):
+    run_script(monkeypatch, "serialization.py", "--rows", "20", "--repeat", "1")
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith("variant")
+    assert len(lines) == 3
+
+
+def message(tag, body):
+    return tag + struct.pack("!I", len(body) + 4) + body
+
+
+def test_roundtrip_proxy_labels_each_wait_for_the_server():
+    roundtrips = runpy.run_path(str(BENCHMARKS / "roundtrips.py"))
+    counts = Counter()
+    stream = roundtrips["_ClientStream"](counts, threading.Lock())
+
+    stream.client_sent(struct.pack("!II", 8, 80877103))  # SSLRequest
+    stream.server_sent(b"N")
+    startup = struct.pack("!I", 196608) + b"user\0app\0\0"
+    stream.client_sent(struct.pack("!I", len(startup) + 4) + startup)
+    stream.server_sent(b"R")
+    stream.client_sent(message(b"Q", b";\0"))
+    stream.server_sent(b"I")
+    # BEGIN and set_config in one message, as the RLS context is sent.
+    stream.client_sent(message(b"Q", b"BEGIN; SELECT set_config('app.current_session_id', 'x', true)\0"))
+    stream.server_sent(b"C")
+    parse = message(b"P", b"_pg3_0\0INSERT INTO messages VALUES (1)\0\0\0")
+    stream.client_sent(parse[:7])
+    stream.client_sent(parse[7:] + message(b"S", b""))
+    stream.server_sent(b"1")
+    stream.client_sent(message(b"B", b"\0_pg3_0\0\0\0\0\0\0\0") + message(b"E", b"\0\0\0\0\0") + message(b"S", b""))
+    stream.server_sent(b"2")
+    stream.client_sent(message(b"Q", b"COMMIT\0"))
+    stream.server_sent(b"C")
+    stream.client_sent(message(b"X", b""))
+
+    assert counts == Counter(connect=2, ping=1, begin=1, statement=2, commit=1)
+
+
+def test_loadtest_reports_rate_limited_requests_apart_from_errors():
+    loadtest = runpy.run_path(str(BENCHMARKS / "loadtest.py"))
+
+    class Player:
+        latencies = {"send": [0.1, 0.2]}
+        errors = {"send": 1}
+        throttled = {"send": 3}
+
+    results = loadtest["summarise"]([Player()], 1.0)
+
+    assert results["send"]["requests"] == 6
+    assert results["send"]["errors"] == 1 and results["send"]["throttled"] == 3
+    assert results["send"]["rps"] == 2.0
@@ -0,0 +1,53 @@
+﻿import gzip
+
+import pytest
+from flask import Flask, Response, jsonify, request
+
+from app import compression
+from app.compression import compress_response
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+    app = Flask(__name__)
+
+    @app.get("/big")
+    def big():
+        response = jsonify({"messages": ["ola"] * 500})
+        response.set_etag("v1")
+        return response
+
+    @app.get("/small")
+    def small():
+        return jsonify({"ok": True})
+
+    @app.get("/stream")
+    def stream():
+        return Response((chunk for chunk in ["data: x\n\n"] * 500), mimetype="text/event-stream")
+
+    @app.after_request
+    def compress(response):
+        return compress_response(response, request, min_size=1024, level=6)
+
+    return app.test_client()
+
+
+def test_large_json_is_gzipped_and_etag_weakened(client):
+    response = client.get("/big", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert response.headers["ETag"] == 'W/"v1"'
+    assert gzip.decompress(response.data).startswith(b'{"messages"')
+
+
+def test_small_and_refused_bodies_stay_plain(client):
+    assert "Content-Encoding" not in client.get("/small", headers={"Accept-Encoding": "gzip"}).headers
+    assert "Content-Encoding" not in client.get("/big", headers={"Accept-Encoding": "gzip;q=0"}).headers
+    assert "Content-Encoding" not in client.get("/big").headers
+
+
+def test_streams_are_never_buffered_for_compression(client):
+    response = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
@@ -0,0 +1,149 @@
+﻿"""Admin export; streaming real rows needs ``VALEZAP_TEST_DATABASE_URL`` with a superuser or BYPASSRLS role."""
+import gzip
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine, text
+
+from app import export
+from app.admin import admin_bp
+from app.archive import pack_messages
+from app.export import _buffered, _gzip, parse_filters
+from app.json_provider import init_json_provider
+from app.models import Sender
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+
+
+def test_parse_filters():
+    filters = parse_filters("2026-01-01T00:00:00", "2026-02-01T00:00:00-03:00", "false")
+
+    assert filters.created_from == datetime(2026, 1, 1, tzinfo=timezone.utc)
+    assert filters.created_to.utcoffset().total_seconds() == -3 * 3600
+    assert filters.is_active is False
+    assert parse_filters(None, None, None).is_active is None
+    with pytest.raises(ValueError):
+        parse_filters("ontem", None, None)
+    with pytest.raises(ValueError):
+        parse_filters(None, None, "talvez")
+
+
+def test_chunks_are_buffered_and_gzipped():
+    lines = [b'{"n": %d}\n' % n for n in range(100)]
+
+    chunks = list(_buffered(lines, size=64))
+
+    assert all(len(chunk) >= 64 for chunk in chunks[:-1])
+    assert gzip.decompress(b"".join(_gzip(chunks, 6))) == b"".join(lines)
+
+
+@pytest.fixture
+def admin_app(monkeypatch):
+    monkeypatch.setattr(export, "_engine", None)
+    app = Flask(__name__)
+    app.config.update(ADMIN_TOKEN="segredo", EXPORT_DATABASE_URL=DATABASE_URL, EXPORT_BATCH_SIZE=2, COMPRESS_LEVEL=6)
+    init_json_provider(app)
+    app.register_blueprint(admin_bp, url_prefix="/api/admin")
+    yield app
+    if export._engine is not None:
+        export._engine.dispose()
+
+
+def test_admin_api_requires_token(admin_app):
+    client = admin_app.test_client()
+
+    assert client.get("/api/admin/export").status_code == 401
+    assert client.get("/api/admin/export", headers={"Authorization": "Bearer errado"}).status_code == 401
+    admin_app.config["ADMIN_TOKEN"] = None
+    assert client.get("/api/admin/export", headers={"Authorization": "Bearer segredo"}).status_code == 404
+
+
+def test_export_rejects_bad_filters_and_missing_role(admin_app):
+    client = admin_app.test_client()
+    headers = {"Authorization": "Bearer segredo"}
+
+    assert client.get("/api/admin/export?created_from=ontem", headers=headers).status_code == 400
+    admin_app.config["EXPORT_DATABASE_URL"] = None
+    assert client.get("/api/admin/export", headers=headers).status_code == 503
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="VALEZAP_TEST_DATABASE_URL nao definido")
+def test_export_streams_sessions_with_messages(admin_app):
+    engine = create_engine(DATABASE_URL)
+    tokens = [uuid4().hex for _ in range(3)]
+    with engine.begin() as conn:
+        started = conn.execute(text("SELECT now()")).scalar_one()
+        for index, token in enumerate(tokens):
+            conn.execute(
+                text("INSERT INTO chat_sessions (session_token, player_id, is_active) VALUES (:t, 'p', :active)"),
+                {"t": token, "active": index != 1},
+            )
+            for n in range(index):
+                conn.execute(
+                    text("INSERT INTO messages (session_token, sender, content) VALUES (:t, 'PLAYER', :c)"),
+                    {"t": token, "c": f"msg {n}"},
+                )
+
+    try:
+        response = admin_app.test_client().get(
+            f"/api/admin/export?created_from={started.isoformat().replace('+', '%2B')}&is_active=true",
+            headers={"Authorization": "Bearer segredo", "Accept-Encoding": "gzip"},
+        )
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        lines = gzip.decompress(response.get_data()).decode("utf-8").splitlines()
+        records = {record["session_token"]: record for record in map(json.loads, lines)}
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM chat_sessions WHERE session_token = ANY(:t)"), {"t": tokens})
+        engine.dispose()
+
+    assert tokens[1] not in records
+    assert records[tokens[0]]["messages"] == []
+    assert [message["content"] for message in records[tokens[2]]["messages"]] == ["msg 0", "msg 1"]
+    assert records[tokens[2]]["messages"][0]["sender"] == "player"
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="VALEZAP_TEST_DATABASE_URL nao definido")
+def test_export_merges_late_live_messages_into_the_archive(admin_app):
+    engine = create_engine(DATABASE_URL)
+    token = uuid4().hex
+    with engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO chat_sessions (session_token, player_id, is_active, ended_at) VALUES (:t, 'p', false, now())"),
+            {"t": token},
+        )
+        at = conn.execute(text("SELECT now()")).scalar_one()
+        archived = [(1, Sender.PLAYER, "oi", at), (2, Sender.VALEZAP, "fim da interacao", at + timedelta(seconds=2))]
+        conn.execute(
+            text(
+                "INSERT INTO messages_archive (session_token, message_count, first_message_at, last_message_at, payload) "
+                "VALUES (:t, 2, :first, :last, :payload)"
+            ),
+            {"t": token, "first": at, "last": at + timedelta(seconds=2), "payload": pack_messages(archived)},
+        )
+        # Arrived after the session was archived, between the two archived ones.
+        conn.execute(
+            text("INSERT INTO messages (session_token, sender, content, created_at) VALUES (:t, 'PLAYER', 'atrasada', :at)"),
+            {"t": token, "at": at + timedelta(seconds=1)},
+        )
+
+    try:
+        response = admin_app.test_client().get(
+            f"/api/admin/export?created_from={at.isoformat().replace('+', '%2B')}",
+            headers={"Authorization": "Bearer segredo"},
+        )
+        records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM chat_sessions WHERE session_token = :t"), {"t": token})
+        engine.dispose()
+
+    record = next(record for record in records if record["session_token"] == token)
+    assert record["archived"]
+    assert [message["content"] for message in record["messages"]] == ["oi", "atrasada", "fim da interacao"]
+    assert [message["sender"] for message in record["messages"]] == ["player", "player", "valezap"]
@@ -0,0 +1,211 @@
+﻿import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from flask import Flask
+
+from app.external import BackendClient, CircuitBreaker, WebhookError, extract_reply
+
+
+def test_extract_reply_strips_message():
+    assert extract_reply({"mensagem": "  ola  "}) == "ola"
+
+
+@pytest.mark.parametrize("payload", [{}, {"mensagem": 10}, {"mensagem": "   "}])
+def test_extract_reply_rejects_invalid_payload(payload):
+    with pytest.raises(WebhookError):
+        extract_reply(payload)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_circuit_breaker_opens_after_threshold_and_probes_after_reset():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+
+    assert breaker.allow()
+    assert not breaker.record_failure()
+    assert breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    clock.now = 10
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()  # only one probe at a time
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.times_opened == 1
+
+
+def test_circuit_breaker_reopens_when_probe_fails():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5, clock=clock)
+    breaker.record_failure()
+
+    clock.now = 5
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 2
+
+
+def build_client_config(**overrides):
+    config = {
+        "REMOTE_WEBHOOK_POOL_SIZE": 2,
+        "REMOTE_WEBHOOK_CONNECT_TIMEOUT": 1,
+        "REMOTE_WEBHOOK_TIMEOUT": 2,
+        "REMOTE_WEBHOOK_RETRIES": 2,
+        "REMOTE_WEBHOOK_RETRY_BACKOFF": 0,
+        "REMOTE_WEBHOOK_RETRY_STATUSES": (503,),
+        "REMOTE_WEBHOOK_BREAKER_THRESHOLD": 1,
+        "REMOTE_WEBHOOK_BREAKER_RESET": 60,
+    }
+    config.update(overrides)
+    return config
+
+
+@pytest.fixture
+def upstream():
+    statuses = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            status = statuses.pop(0) if statuses else 200
+            body = b'{"mensagem": "ok"}'
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/webhook", statuses
+    server.shutdown()
+    server.server_close()
+
+
+def test_backend_client_retries_and_reuses_connection(upstream):
+    url, statuses = upstream
+    statuses.extend([503, 503])
+    app = Flask(__name__)
+    with app.app_context():
+        client = BackendClient(build_client_config())
+        response = client.post(url, json={})
+        assert response.status_code == 200
+        client.post(url, json={})
+        stats = client.stats()
+        client.close()
+
+    assert stats["retries_total"] == 2
+    assert stats["requests_total"] == 4
+    assert stats["connections_opened_total"] == 1
+    assert stats["connections_reused_total"] == 3
+    assert stats["breaker_state"] == CircuitBreaker.CLOSED
+
+
+def test_backend_client_fails_fast_when_breaker_open(upstream):
+    url, statuses = upstream
+    statuses.append(500)
+    app = Flask(__name__)
+    with app.app_context():
+        client = BackendClient(build_client_config())
+        assert client.post(url, json={}).status_code == 500
+        with pytest.raises(WebhookError) as excinfo:
+            client.post(url, json={})
+        client.close()
+
+    assert excinfo.value.cause == "circuit_open"
+
+
+def test_backend_client_warm_up_connection_is_reused(upstream):
+    url, _ = upstream
+    app = Flask(__name__)
+    with app.app_context():
+        client = BackendClient(build_client_config())
+        assert client.warm_up(url)
+        assert client.stats()["requests_total"] == 0
+        client.post(url, json={})
+        stats = client.stats()
+        assert not client.warm_up("http://127.0.0.1:1/webhook")
+        client.close()
+
+    assert stats["connections_opened_total"] == 1
+    assert stats["requests_total"] == 1
+
+
+def test_backend_client_retries_only_connections_never_opened():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    app = Flask(__name__)
+    with app.app_context():
+        client = BackendClient(build_client_config(REMOTE_WEBHOOK_BREAKER_THRESHOLD=5))
+        with pytest.raises(requests.ConnectionError):
+            client.post(f"http://127.0.0.1:{port}/webhook", json={})
+        assert client.retries == 2
+        client.close()
+
+
+def test_backend_client_does_not_resend_after_connection_drop():
+    received = []
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+
+    def accept_and_drop():
+        connection, _ = server.accept()
+        received.append(connection.recv(65536))
+        connection.close()
+
+    thread = threading.Thread(target=accept_and_drop, daemon=True)
+    thread.start()
+    app = Flask(__name__)
+    with app.app_context():
+        client = BackendClient(build_client_config(REMOTE_WEBHOOK_BREAKER_THRESHOLD=5))
+        with pytest.raises(requests.ConnectionError):
+            client.post(f"http://127.0.0.1:{server.getsockname()[1]}/webhook", json={})
+        client.close()
+    thread.join(2)
+    server.close()
+
+    assert len(received) == 1
+    assert client.retries == 0
+
+
+def test_half_open_probe_is_released_when_it_raises(upstream, monkeypatch):
+    url, statuses = upstream
+    statuses.append(500)
+    app = Flask(__name__)
+    with app.app_context():
+        client = BackendClient(build_client_config(REMOTE_WEBHOOK_BREAKER_RESET=0))
+        assert client.post(url, json={}).status_code == 500
+
+        def broken_post(*args, **kwargs):
+            raise RuntimeError("bug")
+
+        original = client.session.post
+        monkeypatch.setattr(client.session, "post", broken_post)
+        with pytest.raises(RuntimeError):
+            client.post(url, json={})
+        monkeypatch.setattr(client.session, "post", original)
+        # Without releasing the probe every later call would fail with circuit_open.
+        assert client.post(url, json={}).status_code == 200
+        client.close()
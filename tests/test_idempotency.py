@@ -0,0 +1,171 @@
+﻿"""Idempotency key store; the claim/complete cycle and the endpoint need ``VALEZAP_TEST_DATABASE_URL``."""
+import os
+import threading
+from uuid import uuid4
+
+import pytest
+from flask import Flask
+from sqlalchemy import select, text
+
+from app import admission, database, events, session_state, write_buffer
+from app.api import api_bp
+from app.events import LocalBroker
+from app.idempotency import claim_key, complete_key, load_key, release_key, request_fingerprint
+from app.models import ChatSession, Message
+from app.session_state import SessionStateCache
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+
+
+def test_fingerprint_depends_on_message_content():
+    base = {"session_token": "abc", "player": "5511999999999", "message": "oi"}
+
+    assert request_fingerprint(base) == request_fingerprint(dict(base))
+    assert request_fingerprint(base) != request_fingerprint(dict(base, message="oi!"))
+
+
+@pytest.fixture
+def db_app(monkeypatch):
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    app = Flask(__name__)
+    app.config["DATABASE_URL"] = DATABASE_URL
+    database.init_engine(app)
+    yield app
+    database.get_engine().dispose()
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="VALEZAP_TEST_DATABASE_URL nao definido")
+def test_claim_complete_and_release_cycle(db_app):
+    token = uuid4().hex
+
+    def claim(lease=60):
+        with database.session_scope(session_identifier=token) as db:
+            return claim_key(db, token, "k", "h1", lease, 3600)
+
+    assert claim() is True
+    assert claim() is False  # in flight, lease not over
+    assert claim(lease=0) is True  # owner presumed dead: taken over
+
+    with database.session_scope(session_identifier=token) as db:
+        release_key(db, token, "k")
+    assert claim() is True  # released by a failure: the retry runs
+
+    with database.session_scope(session_identifier=token) as db:
+        complete_key(db, token, "k", 201, '{"ok": true}')
+    assert claim(lease=0) is False  # completed keys only expire with the TTL
+    with database.session_scope(session_identifier=token) as db:
+        stored = load_key(db, token, "k")
+        release_key(db, token, "k")  # no-op once completed
+        assert load_key(db, token, "k") == stored
+
+    assert stored.completed and stored.status_code == 201 and stored.body == '{"ok": true}'
+
+    with database.session_scope() as db:
+        db.execute(text("DELETE FROM idempotency_keys WHERE session_token = :token"), {"token": token})
+
+
+PLAYER = "5511999999999"
+
+
+@pytest.fixture
+def api_app(db_app, monkeypatch):
+    monkeypatch.setattr(events, "_broker", LocalBroker(None))
+    monkeypatch.setattr(session_state, "_cache", SessionStateCache(maxsize=16, ttl=60))
+    monkeypatch.setattr(write_buffer, "_buffer", None)
+    monkeypatch.setattr(admission, "_limits", None)
+    db_app.config.update(
+        ASYNC_DISPATCH=True,
+        COALESCE_WINDOW_SECONDS=0,
+        RATE_LIMIT_PLAYER_PER_MINUTE=0,
+        RATE_LIMIT_SESSION_PER_MINUTE=0,
+        IDEMPOTENCY_TTL_SECONDS=3600,
+        IDEMPOTENCY_LEASE_SECONDS=60,
+        IDEMPOTENCY_WAIT_SECONDS=2,
+        IDEMPOTENCY_POLL_SECONDS=0.05,
+    )
+    db_app.register_blueprint(api_bp, url_prefix="/api")
+    token = uuid4().hex
+    with database.session_scope() as db:
+        db.add(ChatSession(session_token=token, player_id=PLAYER))
+    yield db_app, token
+    with database.session_scope() as db:
+        db.execute(text("DELETE FROM idempotency_keys WHERE session_token = :t"), {"t": token})
+        db.execute(text("DELETE FROM backend_outbox WHERE session_token = :t"), {"t": token})
+        db.execute(text("DELETE FROM chat_sessions WHERE session_token = :t"), {"t": token})
+
+
+def send(app, token, message="oi", key="k1"):
+    payload = {"session_token": token, "player": PLAYER, "message": message}
+    return app.test_client().post("/api/messages", json=payload, headers={"Idempotency-Key": key})
+
+
+def stored_messages(token):
+    with database.session_scope(session_identifier=token) as db:
+        return db.execute(select(Message.content).where(Message.session_token == token)).scalars().all()
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="VALEZAP_TEST_DATABASE_URL nao definido")
+def test_replay_returns_the_stored_response(api_app):
+    app, token = api_app
+
+    first = send(app, token)
+    replay = send(app, token)
+
+    assert first.status_code == 202 and "Idempotent-Replayed" not in first.headers
+    assert replay.status_code == 202
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert replay.get_json() == first.get_json()
+    assert stored_messages(token) == ["oi"]
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="VALEZAP_TEST_DATABASE_URL nao definido")
+def test_same_key_with_another_body_is_rejected(api_app):
+    app, token = api_app
+    send(app, token)
+
+    response = send(app, token, message="outra coisa")
+
+    assert response.status_code == 422
+    assert stored_messages(token) == ["oi"]
+
+
+def hold_key(token, message="oi", key="k1"):
+    fingerprint = request_fingerprint({"session_token": token, "player": PLAYER, "message": message})
+    with database.session_scope(session_identifier=token) as db:
+        assert claim_key(db, token, key, fingerprint, 60, 3600)
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="VALEZAP_TEST_DATABASE_URL nao definido")
+def test_waiter_receives_the_owner_response(api_app):
+    app, token = api_app
+    hold_key(token)
+
+    def finish():
+        with database.session_scope(session_identifier=token) as db:
+            complete_key(db, token, "k1", 201, '{"status": "do dono"}')
+
+    owner = threading.Timer(0.2, finish)
+    owner.start()
+    try:
+        response = send(app, token)
+    finally:
+        owner.join()
+
+    assert response.status_code == 201
+    assert response.get_json() == {"status": "do dono"}
+    assert response.headers["Idempotent-Replayed"] == "true"
+    assert stored_messages(token) == []
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="VALEZAP_TEST_DATABASE_URL nao definido")
+def test_waiter_gives_up_with_409_after_the_wait_cap(api_app):
+    app, token = api_app
+    app.config["IDEMPOTENCY_WAIT_SECONDS"] = 0.2
+    hold_key(token)
+
+    response = send(app, token)
+
+    assert response.status_code == 409
+    assert response.headers["Retry-After"] == "1"
+    assert stored_messages(token) == []
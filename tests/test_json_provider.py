@@ -0,0 +1,45 @@
+﻿import json
+from datetime import datetime, timezone
+
+import pytest
+from flask import Flask
+
+from app import json_provider
+from app.json_provider import init_json_provider
+from app.models import Sender
+
+PAYLOAD = {"sender": Sender.VALEZAP, "created_at": datetime(2024, 5, 1, 12, 0, 0, 123456, tzinfo=timezone.utc)}
+EXPECTED = {"sender": "valezap", "created_at": "2024-05-01T12:00:00.123456+00:00"}
+
+
+def make_app(name):
+    app = Flask(__name__)
+    app.config["JSON_PROVIDER"] = name
+    init_json_provider(app)
+    return app
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "stdlib",
+        pytest.param("orjson", marks=pytest.mark.skipif(json_provider.orjson is None, reason="orjson ausente")),
+    ],
+)
+def test_providers_encode_datetime_and_sender_natively(name):
+    app = make_app(name)
+    assert json.loads(app.json.dumps(PAYLOAD)) == EXPECTED
+    with app.app_context():
+        response = app.json.response(PAYLOAD)
+    assert response.mimetype == "application/json"
+    assert json.loads(response.get_data()) == EXPECTED
+    assert app.json.loads('{"a": 1}') == {"a": 1}
+
+
+def test_auto_falls_back_to_stdlib(monkeypatch):
+    monkeypatch.setattr(json_provider, "orjson", None)
+    assert type(make_app("auto").json).__name__ == "StdlibJSONProvider"
+    with pytest.raises(RuntimeError):
+        make_app("orjson")
+    with pytest.raises(RuntimeError):
+        make_app("ujson")
@@ -0,0 +1,87 @@
+﻿"""Worker startup; warming the pool needs ``VALEZAP_TEST_DATABASE_URL``."""
+import os
+import shlex
+from pathlib import Path
+
+import pytest
+from flask import Flask
+
+from app import database, events
+from app.config import load_config
+from app.database import pool_options, reset_pools_after_fork
+from app.events import LocalBroker
+from app.lifecycle import connection_budget, warm_up_worker
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+
+
+def test_pool_is_sized_from_worker_threads():
+    assert pool_options({"WORKER_THREADS": 4, "DB_MAX_OVERFLOW": 1})["pool_size"] == 5
+    assert pool_options({"WORKER_THREADS": 4, "DB_POOL_SIZE": 8})["pool_size"] == 8
+    assert pool_options({})["pool_size"] == 5
+
+
+def test_each_gunicorn_in_the_procfile_has_its_own_shared_state():
+    # gunicorn.conf.py wipes both on start: a shared path would reset the other process.
+    procfile = Path(__file__).resolve().parent.parent / "Procfile"
+    seen = {"PROMETHEUS_MULTIPROC_DIR": set(), "VALEZAP_ADMISSION_STATE_FILE": set()}
+    for line in procfile.read_text(encoding="utf-8-sig").splitlines():
+        words = shlex.split(line.partition(":")[2])
+        if "gunicorn" not in words:
+            continue
+        env = dict(word.split("=", 1) for word in words[: words.index("gunicorn")] if "=" in word)
+        for name, paths in seen.items():
+            path = env.get(name, "<gunicorn.conf.py>")
+            assert path not in paths, name
+            paths.add(path)
+    assert len(seen["PROMETHEUS_MULTIPROC_DIR"]) == 2
+
+
+def test_connection_budget_counts_every_worker():
+    app = Flask(__name__)
+    app.config.update(WORKER_THREADS=2, DB_MAX_OVERFLOW=2, EVENT_BROKER="postgres")
+
+    assert connection_budget(app, workers=3) == 3 * (3 + 2 + 1)
+
+
+@pytest.fixture
+def engine_app(monkeypatch):
+    monkeypatch.setattr(events, "_broker", LocalBroker(None))
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    monkeypatch.setattr(database, "_replicas", [])
+    app = Flask(__name__)
+    app.config.from_object(load_config())
+    app.config.update(
+        DATABASE_URL=DATABASE_URL or "postgresql+psycopg://postgres@127.0.0.1:1/valezap",
+        WORKER_THREADS=2,
+        DB_MAX_OVERFLOW=0,
+        WARMUP=True,
+        REMOTE_WEBHOOK_URL="http://127.0.0.1:1/webhook",
+    )
+    database.init_engine(app)
+    yield app
+    database.get_engine().dispose()
+
+
+def test_reset_after_fork_replaces_the_pool(engine_app):
+    inherited = database.get_engine().pool
+
+    reset_pools_after_fork()
+
+    assert database.get_engine().pool is not inherited
+    assert database.get_engine().pool.size() == inherited.size()
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="VALEZAP_TEST_DATABASE_URL nao definido")
+def test_warm_up_fills_the_pool(engine_app, monkeypatch):
+    from app import external
+
+    monkeypatch.setattr(external, "_client", None)
+    report = warm_up_worker(engine_app, forked_at=0.0)
+
+    pool = database.get_engine().pool
+    assert list(report["db_connections"].values()) == [3]
+    assert pool.checkedin() == 3 and pool.checkedout() == 0
+    assert report["backend_connected"] is False
+    assert report["startup_ms"] >= report["warmup_ms"]
@@ -0,0 +1,63 @@
+﻿import json
+import logging
+
+from app.logging_config import JsonFormatter, _ForkSafeQueueHandler
+
+
+def make_record(**extra):
+    record = logging.makeLogRecord({"name": "app", "levelname": "ERROR", "levelno": logging.ERROR, "msg": "falhou %s"})
+    record.args = ("agora",)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_keeps_extra_fields_and_truncates_payload():
+    formatter = JsonFormatter(max_chars=20)
+    record = make_record(event="backend.dispatch.status", status_code=500, body="x" * 25, payload={"ok": True})
+
+    entry = json.loads(formatter.format(record))
+
+    assert entry["message"] == "falhou agora"
+    assert entry["event"] == "backend.dispatch.status"
+    assert entry["status_code"] == 500
+    assert entry["body"] == "x" * 20 + "...<+5 caracteres>"
+    assert entry["payload"] == {"ok": True}
+
+
+def test_json_formatter_samples_out_bulky_fields():
+    formatter = JsonFormatter(sample_rate=0.0)
+
+    entry = json.loads(formatter.format(make_record(payload="abc")))
+
+    assert entry["payload"] == "<omitido: 3 caracteres>"
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+        self.setFormatter(JsonFormatter())
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def test_queue_handler_delivers_extra_and_traceback_through_listener():
+    target = ListHandler()
+    handler = _ForkSafeQueueHandler(target)
+    logger = logging.getLogger("valezap.test.queue")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        try:
+            raise ValueError("quebrou")
+        except ValueError:
+            logger.exception("Erro %s", "grave", extra={"event": "test.error"})
+    finally:
+        logger.removeHandler(handler)
+        handler.close()  # stops the listener after draining the queue
+
+    entry = json.loads(target.lines[0])
+    assert entry["message"] == "Erro grave"
+    assert entry["event"] == "test.error"
+    assert "ValueError: quebrou" in entry["exc_info"]
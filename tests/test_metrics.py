@@ -0,0 +1,84 @@
+﻿import os
+
+import pytest
+from flask import Flask
+from prometheus_client import REGISTRY
+
+from app import database, metrics
+from app.external import WebhookError, dispatch_to_backend
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(metrics, "record_pool_state", lambda: None)
+    monkeypatch.setattr(metrics.SessionCollector, "_query", lambda self: (3, 1))
+    app = Flask(__name__)
+    app.config["METRICS_TOKEN"] = None
+    app.config["METRICS_PUBLIC"] = True
+    app.config["METRICS_SESSIONS_TTL"] = 0
+
+    @app.get("/ping/<name>")
+    def ping(name):
+        return {"ok": name}
+
+    metrics.init_metrics(app)
+    return app
+
+
+def test_metrics_export_route_latency_and_sessions(app):
+    client = app.test_client()
+    client.get("/ping/ola")
+
+    body = client.get("/metrics").get_data(as_text=True)
+
+    assert 'valezap_http_request_duration_seconds_count{method="GET",route="/ping/<name>",status="200"}' in body
+    assert "valezap_active_sessions 3.0" in body
+    assert "valezap_expired_open_sessions 1.0" in body
+    assert "valezap_db_pool_checkout_wait_seconds_bucket" in body
+
+
+def test_metrics_token_is_required_when_configured(app):
+    app.config["METRICS_TOKEN"] = "segredo"
+    client = app.test_client()
+
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer errado"}).status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer segredo"}).status_code == 200
+
+
+def test_metrics_are_closed_without_a_token(app):
+    app.config["METRICS_PUBLIC"] = False
+
+    assert app.test_client().get("/metrics").status_code == 404
+
+
+def test_session_counts_come_from_the_definer_function(monkeypatch):
+    if not DATABASE_URL:
+        pytest.skip("VALEZAP_TEST_DATABASE_URL nao definido")
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    app = Flask(__name__)
+    app.config["DATABASE_URL"] = DATABASE_URL
+    database.init_engine(app)
+    try:
+        active, awaiting_sweep = metrics.SessionCollector(app, ttl=0)._query()
+    finally:
+        database.get_engine().dispose()
+
+    assert active >= 0 and awaiting_sweep >= 0
+
+
+def test_backend_errors_are_counted_by_cause(monkeypatch):
+    def fail(*args):
+        raise WebhookError("indisponivel", cause="timeout")
+
+    monkeypatch.setattr("app.external._dispatch", fail)
+    before = REGISTRY.get_sample_value("valezap_backend_dispatch_errors_total", {"cause": "timeout"}) or 0
+
+    with pytest.raises(WebhookError):
+        dispatch_to_backend("token", "player", "oi")
+
+    assert REGISTRY.get_sample_value("valezap_backend_dispatch_errors_total", {"cause": "timeout"}) == before + 1
+    assert REGISTRY.get_sample_value("valezap_backend_dispatch_duration_seconds_count", {"outcome": "error"}) >= 1
@@ -0,0 +1,150 @@
+﻿"""Outbox claims with coalescing; needs ``VALEZAP_TEST_DATABASE_URL`` (a superuser or BYPASSRLS role)."""
+import os
+from uuid import uuid4
+
+import pytest
+from flask import Flask, abort
+from sqlalchemy import text
+from werkzeug.exceptions import HTTPException
+
+from app import api, database
+from app.outbox import (
+    ClaimedEntry,
+    claim_batch,
+    claim_session,
+    enqueue_dispatch,
+    hand_over,
+    has_pending_before,
+    is_pending,
+    renew_lease,
+    still_owned,
+)
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+
+
+def test_entry_ids_default_to_the_single_row():
+    assert ClaimedEntry(7, "t", "p", "oi", 1).entry_ids == (7,)
+    assert ClaimedEntry(7, "t", "p", "oi\ntudo bem", 1, ids=(7, 9)).entry_ids == (7, 9)
+
+
+@pytest.fixture
+def session_token(monkeypatch):
+    if not DATABASE_URL:
+        pytest.skip("VALEZAP_TEST_DATABASE_URL nao definido")
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    app = Flask(__name__)
+    app.config["DATABASE_URL"] = DATABASE_URL
+    database.init_engine(app)
+    token = uuid4().hex
+    with database.session_scope() as db:
+        db.execute(text("INSERT INTO chat_sessions (session_token, player_id) VALUES (:t, 'p')"), {"t": token})
+    yield token
+    with database.session_scope() as db:
+        db.execute(text("DELETE FROM chat_sessions WHERE session_token = :t"), {"t": token})
+    database.get_engine().dispose()
+
+
+def enqueue(token, content, delay=60):
+    with database.session_scope() as db:
+        return enqueue_dispatch(db, token, "p", content, delay_seconds=delay)
+
+
+def test_claim_session_coalesces_pending_rows_in_order(session_token):
+    ids = [enqueue(session_token, content) for content in ("oi", "tudo bem?", "quero jogar")]
+    with database.session_scope() as db:
+        assert not has_pending_before(db, session_token, ids[0])
+        assert has_pending_before(db, session_token, ids[2])
+
+    with database.session_scope() as db:
+        entry = claim_session(db, session_token, lease_seconds=60, limit=2)
+    assert entry.entry_ids == tuple(ids[:2])
+    assert entry.content == "oi\ntudo bem?"
+
+    late = enqueue(session_token, "ola?")
+    with database.session_scope() as db:
+        # The first batch is still in flight: the rest waits for its reply.
+        assert claim_session(db, session_token, lease_seconds=60, limit=10) is None
+        assert is_pending(db, ids[2]) and not is_pending(db, ids[0])
+        assert not has_pending_before(db, session_token, ids[1])
+        db.execute(text("UPDATE backend_outbox SET status = 'DONE' WHERE id = ANY(:ids)"), {"ids": ids[:2]})
+
+    with database.session_scope() as db:
+        entry = claim_session(db, session_token, lease_seconds=60, limit=10)
+    assert entry.entry_ids == (ids[2], late)
+
+
+def test_orphaned_rows_do_not_hold_new_messages(session_token):
+    orphan = enqueue(session_token, "perdida", delay=0)
+    fresh = enqueue(session_token, "nova")
+
+    with database.session_scope() as db:
+        assert not has_pending_before(db, session_token, fresh)
+        entry = claim_session(db, session_token, lease_seconds=60, limit=10)
+    assert entry.entry_ids == (orphan, fresh)
+
+
+def test_dispatcher_claims_followers_with_their_head(session_token):
+    head = enqueue(session_token, "oi", delay=0)
+    follower = enqueue(session_token, "alguem ai?")
+
+    entries = [entry for entry in claim_batch(50, 60, coalesce_limit=5) if entry.session_token == session_token]
+
+    assert [entry.entry_ids for entry in entries] == [(head, follower)]
+
+
+def test_entry_claimed_again_elsewhere_is_not_sent_or_stored(session_token):
+    enqueue(session_token, "oi", delay=0)
+    (first,) = [entry for entry in claim_batch(50, 60) if entry.session_token == session_token]
+    assert renew_lease(first, 60)
+
+    # The lease ran out before this dispatcher got to the entry; another one claimed it.
+    with database.session_scope() as db:
+        db.execute(text("UPDATE backend_outbox SET locked_until = now() - interval '1 second' WHERE id = :id"), {"id": first.id})
+    (second,) = [entry for entry in claim_batch(50, 60) if entry.session_token == session_token]
+
+    assert second.attempts == first.attempts + 1
+    assert not renew_lease(first, 60)
+    with database.session_scope() as db:
+        assert not still_owned(db, first)
+        assert still_owned(db, second)
+
+
+def statuses(ids):
+    with database.session_scope() as db:
+        rows = db.execute(text("SELECT id, status FROM backend_outbox WHERE id = ANY(:ids)"), {"ids": list(ids)})
+        return dict(rows.all())
+
+
+def test_late_joiner_is_handed_to_the_dispatcher(session_token):
+    opener = enqueue(session_token, "oi")
+    with database.session_scope() as db:
+        entry = claim_session(db, session_token, lease_seconds=60, limit=10)
+    assert entry.entry_ids == (opener,)
+
+    # Joined the batch, but committed only after the opener claimed it.
+    with database.session_scope() as db:
+        joiner = enqueue_dispatch(db, session_token, "p", "tudo bem?", delay_seconds=60)
+        hand_over(db, joiner, 0)
+        db.execute(text("UPDATE backend_outbox SET status = 'DONE' WHERE id = :id"), {"id": opener})
+
+    entries = [entry for entry in claim_batch(50, 60) if entry.session_token == session_token]
+    assert [entry.entry_ids for entry in entries] == [(joiner,)]
+
+
+def test_failed_batch_only_fails_the_opener_row(session_token, monkeypatch):
+    opener = enqueue(session_token, "oi")
+    joiner = enqueue(session_token, "tudo bem?")
+    with database.session_scope() as db:
+        entry = claim_session(db, session_token, lease_seconds=60, limit=10)
+
+    monkeypatch.setattr(api, "_backend_reply", lambda *args: abort(502, "backend fora do ar"))
+    app = Flask(__name__)
+    app.config.update(OUTBOX_MAX_ATTEMPTS=5, OUTBOX_RETRY_BASE_SECONDS=0)
+    with app.test_request_context(), pytest.raises(HTTPException):
+        api._dispatch_claimed(entry, opener)
+
+    assert statuses(entry.entry_ids) == {opener: "FAILED", joiner: "PENDING"}
+    retried = [entry for entry in claim_batch(50, 60) if entry.session_token == session_token]
+    assert [entry.entry_ids for entry in retried] == [(joiner,)]
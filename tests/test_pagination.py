@@ -0,0 +1,52 @@
+﻿from datetime import datetime, timezone
+
+import pytest
+
+from app.pagination import (
+    decode_cursor,
+    decode_rank_cursor,
+    encode_cursor,
+    encode_rank_cursor,
+    parse_limit,
+    parse_message_id,
+    parse_timestamp,
+)
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    cursor = encode_cursor(created_at, 42)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (created_at, 42)
+
+
+def test_decode_cursor_rejects_garbage():
+    with pytest.raises(ValueError):
+        decode_cursor("nao-eh-cursor")
+
+
+def test_rank_cursor_round_trip():
+    cursor = encode_rank_cursor(0.0607927, 42)
+    assert decode_rank_cursor(cursor) == (0.0607927, 42)
+    with pytest.raises(ValueError):
+        decode_rank_cursor(encode_rank_cursor(float("nan"), 1))
+    with pytest.raises(ValueError):
+        decode_rank_cursor(encode_cursor(datetime(2024, 5, 1, tzinfo=timezone.utc), 1))
+
+
+def test_parse_timestamp_assumes_utc():
+    assert parse_timestamp("2024-05-01T12:00:00") == datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+
+
+def test_parse_limit_clamps_to_maximum():
+    assert parse_limit(None, 200, 500) == 200
+    assert parse_limit("1000", 200, 500) == 500
+    with pytest.raises(ValueError):
+        parse_limit("0", 200, 500)
+
+
+def test_parse_message_id_validates_input():
+    assert parse_message_id("") is None
+    assert parse_message_id("17") == 17
+    with pytest.raises(ValueError):
+        parse_message_id("abc")
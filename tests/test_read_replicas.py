@@ -0,0 +1,125 @@
+﻿"""Replica routing; the scope checks need ``VALEZAP_TEST_DATABASE_URL`` (used as primary and as "replica")."""
+import os
+
+import pytest
+from flask import Flask
+from sqlalchemy import text
+
+from app import database
+from app.database import PrimaryPins, is_replica_session, read_session_scope
+from app.events import LocalBroker
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+UNREACHABLE_URL = "postgresql+psycopg://postgres@127.0.0.1:1/valezap"
+
+
+def test_pins_expire_and_none_pins_everything(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(database.time, "monotonic", lambda: clock[0])
+    pins = PrimaryPins(window=5, max_entries=2)
+
+    pins.pin("a")
+    assert pins.is_pinned("a") and not pins.is_pinned("b")
+    clock[0] += 6
+    assert not pins.is_pinned("a")
+
+    pins.pin(None)
+    assert pins.is_pinned("b")
+
+
+def test_pins_are_bounded():
+    pins = PrimaryPins(window=60, max_entries=2)
+    for token in ("a", "b", "c"):
+        pins.pin(token)
+
+    assert not pins.is_pinned("a")
+    assert pins.is_pinned("b") and pins.is_pinned("c")
+
+
+@pytest.fixture
+def replicated_app(monkeypatch):
+    if not DATABASE_URL:
+        pytest.skip("VALEZAP_TEST_DATABASE_URL nao definido")
+    from app import events
+
+    broker = LocalBroker(None)
+    monkeypatch.setattr(events, "_broker", broker)
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    monkeypatch.setattr(database, "_replicas", [])
+    monkeypatch.setattr(database, "_pins", None)
+    app = Flask(__name__)
+    app.config.update(
+        DATABASE_URL=DATABASE_URL,
+        DATABASE_REPLICA_URLS=(UNREACHABLE_URL, DATABASE_URL),
+        REPLICA_PIN_SECONDS=60,
+        REPLICA_MAX_LAG_SECONDS=1,
+        REPLICA_LAG_CHECK_SECONDS=1,
+        REPLICA_RETRY_SECONDS=60,
+    )
+    database.init_engine(app)
+    database.init_read_replicas(app)
+    yield app, broker
+    for replica in database._replicas:
+        replica.engine.dispose()
+    database.get_engine().dispose()
+
+
+def test_reads_skip_unreachable_replica_and_keep_rls_context(replicated_app):
+    for _ in range(2):  # whichever replica comes first in the rotation
+        with read_session_scope(session_identifier="abc") as db:
+            assert is_replica_session(db)
+            assert db.execute(text("SELECT current_setting('app.current_session_id', true)")).scalar_one() == "abc"
+
+
+def test_written_session_reads_from_primary(replicated_app):
+    _, broker = replicated_app
+    broker.deliver("abc")  # a new message announced for the session
+
+    with read_session_scope(session_identifier="abc") as db:
+        assert not is_replica_session(db)
+    with read_session_scope(session_identifier="other") as db:
+        assert is_replica_session(db)
+
+
+def test_all_replicas_lagging_falls_back_to_primary(replicated_app):
+    for replica in database._replicas:
+        replica.lag = 10
+        replica._lag_checked_at = database.time.monotonic()
+
+    with read_session_scope(session_identifier="abc") as db:
+        assert not is_replica_session(db)
+
+
+def test_replica_behind_without_replay_timestamp_counts_as_lagging(replicated_app, monkeypatch):
+    monkeypatch.setattr(database, "_REPLICA_LAG", text("SELECT CASE WHEN CAST(:primary_lsn AS pg_lsn) IS NULL THEN 0 END"))
+
+    with read_session_scope(session_identifier="abc") as db:
+        assert not is_replica_session(db)
+    assert all(replica.lag == float("inf") for replica in database._replicas if replica._lag_checked_at > 0)
+
+
+def test_reads_stay_on_primary_while_the_broker_is_disconnected(replicated_app, monkeypatch):
+    _, broker = replicated_app
+    monkeypatch.setattr(broker, "is_listening", lambda: False)
+
+    with read_session_scope(session_identifier="abc") as db:
+        assert not is_replica_session(db)
+
+
+def test_session_missing_on_replica_is_read_from_primary_after_closing_it(replicated_app, monkeypatch):
+    from app import api
+
+    opened = []
+
+    def fake_state(db, session_token, use_cache=True):
+        opened.append(db)
+        return None if is_replica_session(db) else "estado"
+
+    monkeypatch.setattr(api, "load_session_state", fake_state)
+
+    with api._history_scope("abc") as (db, state):
+        assert state == "estado" and not is_replica_session(db)
+        replica_db = opened[0]
+        assert is_replica_session(replica_db) and not replica_db.in_transaction()
+    assert database._pins.is_pinned("abc")
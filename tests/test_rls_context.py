@@ -0,0 +1,135 @@
+﻿"""RLS context checks against a real Postgres.
+
+Set ``VALEZAP_TEST_DATABASE_URL`` to a database with the migrations applied,
+using a superuser (or BYPASSRLS) role so fixtures can be inserted. Probes run
+as ``VALEZAP_TEST_RLS_ROLE`` through ``SET LOCAL ROLE`` so the policies apply.
+"""
+import os
+from uuid import uuid4
+
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DBAPIError
+
+from app import database
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+RLS_ROLE = os.environ.get("VALEZAP_TEST_RLS_ROLE", "valezap_rls_probe")
+
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="VALEZAP_TEST_DATABASE_URL nao definido")
+
+
+@pytest.fixture(scope="module")
+def tokens():
+    engine = create_engine(DATABASE_URL, future=True)
+    first, second = uuid4().hex, uuid4().hex
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                f"""
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = '{RLS_ROLE}') THEN
+                        CREATE ROLE {RLS_ROLE} NOLOGIN;
+                    END IF;
+                END
+                $$;
+                GRANT SELECT, INSERT, UPDATE ON chat_sessions, messages TO {RLS_ROLE};
+                GRANT USAGE ON SEQUENCE chat_sessions_id_seq, messages_id_seq TO {RLS_ROLE};
+                """
+            )
+        )
+        for token in (first, second):
+            conn.execute(
+                text("INSERT INTO chat_sessions (session_token, player_id) VALUES (:token, '5511999999999')"),
+                {"token": token},
+            )
+            conn.execute(
+                text("INSERT INTO messages (session_token, sender, content) VALUES (:token, 'PLAYER', 'ola')"),
+                {"token": token},
+            )
+    yield first, second
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM chat_sessions WHERE session_token IN (:a, :b)"), {"a": first, "b": second})
+    engine.dispose()
+
+
+@pytest.fixture
+def flask_app(monkeypatch):
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    app = Flask(__name__)
+    app.config["DATABASE_URL"] = DATABASE_URL
+    database.init_engine(app)
+    yield app
+    database.get_engine().dispose()
+
+
+@pytest.fixture(params=["piggyback", "standalone"])
+def mode(request, monkeypatch):
+    if request.param == "standalone":
+        monkeypatch.setattr(database, "_can_piggyback", lambda driver_connection: False)
+    return request.param
+
+
+def probe(session_identifier, other_token):
+    with database.session_scope(session_identifier=session_identifier) as db:
+        db.execute(text(f"SET LOCAL ROLE {RLS_ROLE}"))
+        setting = db.execute(text("SELECT current_setting('app.current_session_id', true)")).scalar_one()
+        sessions = db.execute(text("SELECT count(*) FROM chat_sessions")).scalar_one()
+        messages = db.execute(text("SELECT count(*) FROM messages")).scalar_one()
+
+    try:
+        with database.session_scope(session_identifier=session_identifier) as db:
+            db.execute(text(f"SET LOCAL ROLE {RLS_ROLE}"))
+            db.execute(
+                text("INSERT INTO messages (session_token, sender, content) VALUES (:token, 'PLAYER', 'x')"),
+                {"token": other_token},
+            )
+            db.rollback()
+        foreign_insert = "allowed"
+    except DBAPIError:
+        foreign_insert = "denied"
+
+    return setting, sessions, messages, foreign_insert
+
+
+def test_session_scope_exposes_only_the_current_session(flask_app, tokens, mode):
+    first, second = tokens
+    with flask_app.app_context():
+        assert probe(first, second) == (first, 1, 1, "denied")
+
+
+def test_session_scope_without_identifier_sees_nothing(flask_app, tokens, mode):
+    first, _ = tokens
+    with flask_app.app_context():
+        # set_config(..., NULL, true) leaves an empty string, not NULL, in both modes.
+        assert probe(None, first) == ("", 0, 0, "denied")
+
+
+def test_setting_does_not_leak_into_the_next_transaction(flask_app, tokens, mode):
+    first, _ = tokens
+    with flask_app.app_context():
+        with database.session_scope(session_identifier=first):
+            pass
+        engine = database.get_engine()
+        with engine.connect() as conn:
+            leftover = conn.execute(text("SELECT current_setting('app.current_session_id', true)")).scalar_one()
+    assert leftover in (None, "")
+
+
+def test_piggyback_sends_no_standalone_set_config(flask_app, tokens):
+    first, _ = tokens
+    statements = []
+    with flask_app.app_context():
+        event.listen(
+            database.get_engine(),
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(statement),
+        )
+        with database.session_scope(session_identifier=first) as db:
+            setting = db.execute(text("SELECT current_setting('app.current_session_id', true)")).scalar_one()
+
+    assert setting == first
+    assert not any("set_config" in statement for statement in statements)
@@ -0,0 +1,109 @@
+﻿"""Full-text search; the database tests need ``VALEZAP_TEST_DATABASE_URL`` (superuser or BYPASSRLS) with migration 011."""
+import os
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import pytest
+from flask import Flask
+from sqlalchemy import func, select, text, update
+
+from app import database, events, export
+from app.admin import admin_bp
+from app.conversation import record_player_messages
+from app.events import LocalBroker
+from app.json_provider import init_json_provider
+from app.models import ChatSession, Message
+from app.search import backfill_batch, parse_query
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+T0 = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def test_parse_query_validates_input():
+    assert parse_query('  "bonus de deposito" -saque ') == '"bonus de deposito" -saque'
+    with pytest.raises(ValueError):
+        parse_query("   ")
+    with pytest.raises(ValueError):
+        parse_query("x" * 201)
+
+
+@pytest.fixture
+def db_app(monkeypatch):
+    if not DATABASE_URL:
+        pytest.skip("VALEZAP_TEST_DATABASE_URL nao definido")
+    monkeypatch.setattr(events, "_broker", LocalBroker(None))
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    monkeypatch.setattr(export, "_engine", None)
+    app = Flask(__name__)
+    app.config.update(
+        DATABASE_URL=DATABASE_URL,
+        EXPORT_DATABASE_URL=DATABASE_URL,
+        ADMIN_TOKEN="segredo",
+        ADMIN_PAGE_SIZE=100,
+        ADMIN_PAGE_MAX=100,
+    )
+    init_json_provider(app)
+    app.register_blueprint(admin_bp, url_prefix="/api/admin")
+    database.init_engine(app)
+    tokens = []
+    yield app, tokens
+    with database.session_scope() as db:
+        db.execute(text("DELETE FROM chat_sessions WHERE session_token = ANY(:t)"), {"t": tokens})
+    database.get_engine().dispose()
+    if export._engine is not None:
+        export._engine.dispose()
+
+
+def add_session(tokens, contents):
+    token = uuid4().hex
+    with database.session_scope() as db:
+        db.add(ChatSession(session_token=token, player_id="5511999999999"))
+    with database.session_scope(session_identifier=token) as db:
+        record_player_messages(
+            db, token, "5511999999999", [(content, T0 + timedelta(seconds=i)) for i, content in enumerate(contents)]
+        )
+    tokens.append(token)
+    return token
+
+
+def test_search_ranks_and_pages_hits(db_app):
+    app, tokens = db_app
+    word = f"termo{uuid4().hex[:8]}"
+    strong = add_session(tokens, [f"{word} {word} no saque", "outra coisa"])
+    weak = add_session(tokens, [f"meu {word} sumiu depois de uma conversa bem mais longa sobre depositos"])
+
+    client = app.test_client()
+    headers = {"Authorization": "Bearer segredo"}
+    first = client.get(f"/api/admin/search?q={word}&limit=1", headers=headers).get_json()
+    second = client.get(f"/api/admin/search?q={word}&limit=1&cursor={first['next_cursor']}", headers=headers).get_json()
+
+    assert [hit["session_token"] for hit in first["hits"] + second["hits"]] == [strong, weak]
+    assert first["hits"][0]["rank"] > second["hits"][0]["rank"]
+    assert f"**{word}**" in first["hits"][0]["snippet"]
+    assert first["hits"][0]["sender"] == "player"
+    assert second["next_cursor"] is None
+    assert client.get("/api/admin/search?q=", headers=headers).status_code == 400
+
+
+def test_backfill_fills_rows_inserted_before_the_trigger(db_app):
+    _, tokens = db_app
+    token = add_session(tokens, ["primeira mensagem", "segunda mensagem"])
+    with database.session_scope() as db:
+        first_id = db.execute(select(func.min(Message.id)).where(Message.session_token == token)).scalar_one()
+        db.execute(
+            update(Message)
+            .where(Message.session_token == token)
+            .values(content_tsv=None)
+            .execution_options(synchronize_session=False)
+        )
+
+    with database.session_scope() as db:
+        last_id, updated = backfill_batch(db, first_id - 1, 1)
+        assert (last_id, updated) == (first_id, 1)
+        while last_id is not None:
+            last_id, _ = backfill_batch(db, last_id, 1000)
+        missing = db.execute(
+            select(func.count()).where(Message.session_token == token, Message.content_tsv.is_(None))
+        ).scalar_one()
+    assert missing == 0
@@ -0,0 +1,130 @@
+﻿"""Session activity columns and the admin listing; need ``VALEZAP_TEST_DATABASE_URL`` (superuser or BYPASSRLS)."""
+import os
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import pytest
+from flask import Flask
+from sqlalchemy import select, text
+
+from app import database, events, export
+from app.activity import backfill_batch
+from app.admin import admin_bp
+from app.conversation import record_backend_reply, record_player_messages
+from app.events import LocalBroker
+from app.json_provider import init_json_provider
+from app.models import ChatSession, Sender
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+T0 = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def db_app(monkeypatch):
+    if not DATABASE_URL:
+        pytest.skip("VALEZAP_TEST_DATABASE_URL nao definido")
+    monkeypatch.setattr(events, "_broker", LocalBroker(None))
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    monkeypatch.setattr(export, "_engine", None)
+    app = Flask(__name__)
+    app.config.update(
+        DATABASE_URL=DATABASE_URL,
+        EXPORT_DATABASE_URL=DATABASE_URL,
+        ADMIN_TOKEN="segredo",
+        ADMIN_PAGE_SIZE=2,
+        ADMIN_PAGE_MAX=10,
+    )
+    init_json_provider(app)
+    app.register_blueprint(admin_bp, url_prefix="/api/admin")
+    database.init_engine(app)
+    tokens = []
+    yield app, tokens
+    with database.session_scope() as db:
+        db.execute(text("DELETE FROM chat_sessions WHERE session_token = ANY(:t)"), {"t": tokens})
+    database.get_engine().dispose()
+    if export._engine is not None:
+        export._engine.dispose()
+
+
+def open_session(tokens, player="5511999999999"):
+    token = uuid4().hex
+    with database.session_scope() as db:
+        db.add(ChatSession(session_token=token, player_id=player))
+    tokens.append(token)
+    return token
+
+
+def activity(token):
+    with database.session_scope(session_identifier=token) as db:
+        return db.execute(
+            select(ChatSession.message_count, ChatSession.last_message_at, ChatSession.last_sender, ChatSession.is_active)
+            .where(ChatSession.session_token == token)
+        ).one()
+
+
+def test_inserts_keep_session_activity(db_app):
+    _, tokens = db_app
+    token = open_session(tokens)
+    player = "5511999999999"
+    assert activity(token) == (0, None, None, True)
+
+    with database.session_scope(session_identifier=token) as db:
+        record_player_messages(db, token, player, [("oi", T0), ("tudo bem?", T0 + timedelta(seconds=1))])
+    assert activity(token) == (2, T0 + timedelta(seconds=1), Sender.PLAYER, True)
+
+    with database.session_scope(session_identifier=token) as db:
+        record_backend_reply(db, token, "ola", T0 + timedelta(seconds=2), player_id=player)
+        # A buffered write landing late counts, but does not rewind the last message.
+        record_player_messages(db, token, player, [("atrasada", T0 + timedelta(milliseconds=1500))])
+    assert activity(token) == (4, T0 + timedelta(seconds=2), Sender.VALEZAP, True)
+
+    with database.session_scope(session_identifier=token) as db:
+        record_backend_reply(db, token, "fim da interação", T0 + timedelta(seconds=3), player_id=player)
+    assert activity(token) == (5, T0 + timedelta(seconds=3), Sender.VALEZAP, False)
+
+
+def test_admin_lists_active_sessions_by_last_activity(db_app):
+    app, tokens = db_app
+    quiet, busy, newest = (open_session(tokens) for _ in range(3))
+    far_future = datetime(2100, 1, 1, tzinfo=timezone.utc)
+    for token, offset in ((quiet, 1), (busy, 2), (newest, 3)):
+        with database.session_scope(session_identifier=token) as db:
+            record_player_messages(db, token, "5511999999999", [("oi", far_future + timedelta(minutes=offset))])
+
+    client = app.test_client()
+    headers = {"Authorization": "Bearer segredo"}
+    first = client.get("/api/admin/sessions", headers=headers).get_json()
+    second = client.get(f"/api/admin/sessions?cursor={first['next_cursor']}", headers=headers).get_json()
+
+    assert [session["session_token"] for session in first["sessions"]] == [newest, busy]
+    assert second["sessions"][0]["session_token"] == quiet
+    assert first["sessions"][0]["message_count"] == 1
+    assert first["sessions"][0]["last_sender"] == "player"
+    assert client.get("/api/admin/sessions?cursor=xyz", headers=headers).status_code == 400
+
+
+def test_backfill_recounts_sessions_in_the_id_range(db_app):
+    _, tokens = db_app
+    spoke, silent = open_session(tokens), open_session(tokens)
+    with database.session_scope(session_identifier=spoke) as db:
+        record_player_messages(db, spoke, "5511999999999", [("oi", T0)])
+        record_backend_reply(db, spoke, "ola", T0 + timedelta(seconds=1), player_id="5511999999999")
+
+    with database.session_scope() as db:
+        # Rows created before migration 010 start with the column defaults.
+        db.execute(
+            text(
+                "UPDATE chat_sessions SET message_count = 0, last_message_at = NULL, last_sender = NULL "
+                "WHERE session_token = ANY(:t)"
+            ),
+            {"t": tokens},
+        )
+        ids = db.execute(select(ChatSession.id).where(ChatSession.session_token.in_(tokens))).scalars().all()
+    with database.session_scope() as db:
+        last_id, updated = backfill_batch(db, min(ids) - 1, 2)
+
+    assert last_id == max(ids)
+    assert updated == 1
+    assert activity(spoke) == (2, T0 + timedelta(seconds=1), Sender.VALEZAP, True)
+    assert activity(silent) == (0, None, None, True)
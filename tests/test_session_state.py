@@ -0,0 +1,94 @@
+﻿from datetime import datetime, timedelta, timezone
+
+from app import session_state
+from app.session_state import SessionState, SessionStateCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def state(token, active=True):
+    return SessionState(session_token=token, player_id="5511999999999", is_active=active)
+
+
+def test_cache_evicts_least_recently_used():
+    cache = SessionStateCache(maxsize=2, ttl=60)
+    cache.put(state("a"))
+    cache.put(state("b"))
+    assert cache.get("a") is not None
+    cache.put(state("c"))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_cache_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = SessionStateCache(maxsize=10, ttl=5, clock=clock)
+    cache.put(state("a"))
+
+    clock.now = 4.9
+    assert cache.get("a") is not None
+    clock.now = 5
+    assert cache.get("a") is None
+
+
+def test_invalidate_drops_entry_and_blocks_stale_put():
+    cache = SessionStateCache(maxsize=10, ttl=60)
+    cache.put(state("a"))
+    generation = cache.generation
+
+    cache.invalidate("a")
+    cache.put(state("a"), generation)  # read before the invalidation: must not be cached
+
+    assert cache.get("a") is None
+
+
+def test_invalidate_none_clears_everything():
+    cache = SessionStateCache(maxsize=10, ttl=60)
+    cache.put(state("a"))
+    cache.put(state("b"))
+
+    cache.invalidate(None)
+
+    assert len(cache) == 0
+
+
+def test_zero_size_disables_cache():
+    cache = SessionStateCache(maxsize=0, ttl=60)
+    cache.put(state("a"))
+    assert cache.get("a") is None
+
+
+def test_state_is_closed_once_expired_even_if_still_active():
+    now = datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+    expiring = SessionState("a", "5511999999999", True, expires_at=now)
+
+    assert expiring.is_open(now - timedelta(seconds=1))
+    assert expiring.is_expired(now)
+    assert not expiring.is_open(now)
+    assert state("b").is_open(now)
+    assert not state("c", active=False).is_open(now)
+
+
+def test_nothing_is_cached_while_the_broker_is_disconnected(monkeypatch):
+    class DisconnectedBroker:
+        def ensure_listening(self):
+            pass
+
+        def is_listening(self):
+            return False
+
+    cache = SessionStateCache(maxsize=2, ttl=60)
+    monkeypatch.setattr(session_state, "_cache", cache)
+    monkeypatch.setattr(session_state, "get_broker", DisconnectedBroker)
+
+    session_state.remember_session(state("a"))
+
+    assert cache.get("a") is None
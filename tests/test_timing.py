@@ -0,0 +1,87 @@
+﻿import logging
+
+from flask import Flask, jsonify
+from sqlalchemy import create_engine, text
+
+from app.json_provider import init_json_provider
+from app.timing import RequestTiming, init_timing, timed
+
+
+def make_app(**config) -> Flask:
+    app = Flask(__name__)
+    app.config.update({"SERVER_TIMING": True, "SERVER_TIMING_PUBLIC": True, "SLOW_REQUEST_MS": 0, **config})
+    init_json_provider(app)
+    init_timing(app)
+    engine = create_engine("sqlite://")
+
+    @app.get("/work")
+    def work():
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE IF NOT EXISTS t (x INTEGER)"))
+            connection.execute(text("SELECT 1"))
+        with timed("backend"):
+            pass
+        return jsonify({"ok": True})
+
+    return app
+
+
+def parse_header(value: str) -> dict[str, float]:
+    metrics = {}
+    for metric in value.split(", "):
+        name, duration = metric.split(";dur=")
+        metrics[name] = float(duration)
+    return metrics
+
+
+def test_request_timing_accumulates_phases():
+    timing = RequestTiming()
+    timing.add("db-query", 0.002)
+    timing.add("db-query", 0.001)
+    timing.add("backend", 0.5)
+    assert timing.header(0.6) == "db-query;dur=3.00, backend;dur=500.00, total;dur=600.00"
+    assert timing.summary()["db-query"] == {"duration_ms": 3.0, "count": 2}
+
+
+def test_server_timing_header_lists_phases():
+    response = make_app().test_client().get("/work")
+    metrics = parse_header(response.headers["Server-Timing"])
+    assert list(metrics) == ["db-query", "backend", "json", "total"]
+    assert metrics["total"] >= metrics["db-query"]
+
+
+def test_timed_is_a_no_op_outside_requests():
+    with timed("backend"):
+        pass
+
+
+def test_slow_requests_are_logged(caplog):
+    app = make_app(SLOW_REQUEST_MS=0.001)
+    with caplog.at_level(logging.WARNING, logger=app.logger.name):
+        app.test_client().get("/work")
+    record = next(r for r in caplog.records if getattr(r, "event", None) == "request.slow")
+    assert record.route == "/work"
+    assert record.phases["db-query"]["count"] == 2
+
+
+def test_disabled_emits_no_header():
+    response = make_app(SERVER_TIMING=False).test_client().get("/work")
+    assert "Server-Timing" not in response.headers
+
+
+def test_header_needs_admin_token_or_trusted_header():
+    client = make_app(
+        SERVER_TIMING_PUBLIC=False, ADMIN_TOKEN="segredo", SERVER_TIMING_TRUSTED_HEADER="X-Internal-Timing"
+    ).test_client()
+    assert "Server-Timing" not in client.get("/work").headers
+    assert "Server-Timing" not in client.get("/work", headers={"Authorization": "Bearer errado"}).headers
+    assert "Server-Timing" in client.get("/work", headers={"Authorization": "Bearer segredo"}).headers
+    assert "Server-Timing" in client.get("/work", headers={"X-Internal-Timing": "1"}).headers
+
+
+def test_slow_requests_are_logged_without_the_header(caplog):
+    app = make_app(SERVER_TIMING_PUBLIC=False, SLOW_REQUEST_MS=0.001)
+    with caplog.at_level(logging.WARNING, logger=app.logger.name):
+        response = app.test_client().get("/work")
+    assert "Server-Timing" not in response.headers
+    assert any(getattr(r, "event", None) == "request.slow" for r in caplog.records)
@@ -0,0 +1,231 @@
+﻿"""Webhook payload parsing; the endpoint tests need ``VALEZAP_TEST_DATABASE_URL`` (superuser or BYPASSRLS)."""
+import os
+import threading
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+from flask import Flask
+from sqlalchemy import select, text
+
+from app import database, events, session_state, webhook, write_buffer
+from app.conversation import record_backend_replies, spread_timestamps
+from app.events import LocalBroker
+from app.models import ChatSession, Message, Sender
+from app.session_state import SessionStateCache
+from app.webhook import _parse_item, webhook_bp
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+PLAYER = "5511999999999"
+T0 = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def test_parse_item_normalises_player_and_message():
+    item = {"sessao": "abc", "player": "+55 (12) 99197-4241", "mensagem": "  ola  "}
+    assert _parse_item(item) == ("abc", "5512991974241", "ola")
+
+
+@pytest.mark.parametrize(
+    "item, error",
+    [
+        ("texto", "item invalido"),
+        ({"player": "5511999999999", "mensagem": "oi"}, "sessao obrigatoria"),
+        ({"sessao": "abc", "player": "00123", "mensagem": "oi"}, "player invalido"),
+        ({"sessao": "abc", "player": "5511999999999", "mensagem": 1}, "mensagem invalida"),
+        ({"sessao": "abc", "player": "5511999999999", "mensagem": "   "}, "mensagem vazia"),
+    ],
+)
+def test_parse_item_rejects_invalid_payloads(item, error):
+    with pytest.raises(ValueError, match=error):
+        _parse_item(item)
+
+
+@pytest.fixture
+def db_app(monkeypatch):
+    if not DATABASE_URL:
+        pytest.skip("VALEZAP_TEST_DATABASE_URL nao definido")
+    monkeypatch.setattr(events, "_broker", LocalBroker(None))
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    monkeypatch.setattr(session_state, "_cache", SessionStateCache(maxsize=16, ttl=60))
+    monkeypatch.setattr(write_buffer, "_buffer", None)
+    app = Flask(__name__)
+    app.config.update(DATABASE_URL=DATABASE_URL, WEBHOOK_API_KEY="chave", WEBHOOK_BATCH_MAX=10)
+    app.register_blueprint(webhook_bp, url_prefix="/webhook")
+    database.init_engine(app)
+    tokens = []
+    yield app, tokens
+    with database.session_scope() as db:
+        db.execute(text("DELETE FROM chat_sessions WHERE session_token = ANY(:t)"), {"t": tokens})
+    database.get_engine().dispose()
+
+
+def open_session(tokens, player=PLAYER):
+    token = uuid4().hex
+    with database.session_scope() as db:
+        db.add(ChatSession(session_token=token, player_id=player))
+    tokens.append(token)
+    return token
+
+
+def history(token):
+    with database.session_scope(session_identifier=token) as db:
+        rows = db.execute(
+            select(Message.id, Message.sender, Message.content)
+            .where(Message.session_token == token)
+            .order_by(Message.created_at, Message.id)
+        ).all()
+    return [tuple(row) for row in rows]
+
+
+def is_active(token):
+    with database.session_scope(session_identifier=token) as db:
+        return db.execute(select(ChatSession.is_active).where(ChatSession.session_token == token)).scalar_one()
+
+
+def item(token, message, player=PLAYER):
+    return {"sessao": token, "player": player, "mensagem": message}
+
+
+def post_batch(app, items):
+    return app.test_client().post("/webhook/vale/batch", json=items, headers={"X-API-Key": "chave"})
+
+
+def test_batch_reports_failures_per_item_and_stores_the_rest(db_app):
+    app, tokens = db_app
+    first = open_session(tokens)
+    foreign = open_session(tokens, player="5521988888888")
+    ending = open_session(tokens)
+
+    response = post_batch(
+        app,
+        [
+            item(first, "ola"),
+            {"sessao": first, "player": PLAYER},
+            item(uuid4().hex, "ninguem"),
+            item(foreign, "nao e sua"),
+            item(ending, "Fim da interação"),
+            item(first, "tudo bem?"),
+        ],
+    )
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["stored"] == 3
+    assert body["ended_sessions"] == [ending]
+    assert [result["status"] for result in body["results"]] == [200, 400, 404, 403, 200, 200]
+    assert [result["index"] for result in body["results"]] == list(range(6))
+    assert body["results"][1]["error"] == "mensagem invalida"
+
+    assert [content for _, _, content in history(first)] == ["ola", "tudo bem?"]
+    assert history(foreign) == []
+    assert not is_active(ending) and is_active(first)
+
+
+def test_batch_keeps_the_order_of_each_session(db_app):
+    app, tokens = db_app
+    first = open_session(tokens)
+    second = open_session(tokens)
+    contents = ["um", "dois", "tres", "quatro", "cinco"]
+
+    response = post_batch(app, [item(first if n % 2 == 0 else second, content) for n, content in enumerate(contents)])
+
+    results = response.get_json()["results"]
+    assert [content for _, _, content in history(first)] == ["um", "tres", "cinco"]
+    assert [content for _, _, content in history(second)] == ["dois", "quatro"]
+    assert [message_id for message_id, _, _ in history(first)] == [results[n]["id"] for n in (0, 2, 4)]
+
+
+def test_concurrent_batches_listing_sessions_in_opposite_orders(db_app, monkeypatch):
+    app, tokens = db_app
+    sessions = [open_session(tokens) for _ in range(3)]
+    # Each batch waits after its first session so both transactions overlap.
+    arrived = threading.Barrier(2)
+
+    def meeting(db, token, entries, player_id=None):
+        try:
+            arrived.wait(timeout=0.5)
+        except threading.BrokenBarrierError:
+            pass
+        return record_backend_replies(db, token, entries, player_id=player_id)
+
+    monkeypatch.setattr(webhook, "record_backend_replies", meeting)
+    payloads = [[item(token, "um") for token in sessions], [item(token, "dois") for token in reversed(sessions)]]
+    responses = [None, None]
+
+    def send(position):
+        responses[position] = post_batch(app, payloads[position])
+
+    senders = [threading.Thread(target=send, args=(position,)) for position in (0, 1)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join(30)
+
+    assert [response.status_code for response in responses] == [200, 200]
+    # Results keep the payload order whatever order the sessions were written in.
+    assert [result["sessao"] for result in responses[1].get_json()["results"]] == list(reversed(sessions))
+    assert all(len(history(token)) == 2 for token in sessions)
+
+
+def test_batch_rejects_oversized_and_unauthenticated_requests(db_app):
+    app, tokens = db_app
+    token = open_session(tokens)
+
+    assert post_batch(app, [item(token, "oi")] * 11).status_code == 413
+    assert post_batch(app, []).status_code == 400
+    assert app.test_client().post("/webhook/vale/batch", json=[item(token, "oi")]).status_code == 401
+    assert history(token) == []
+
+
+def test_record_backend_replies_returns_ids_in_input_order(db_app):
+    _, tokens = db_app
+    token = open_session(tokens)
+
+    with database.session_scope(session_identifier=token) as db:
+        ids, ended = record_backend_replies(db, token, spread_timestamps(["a", "b", "c"], T0), player_id=PLAYER)
+
+    assert not ended and is_active(token)
+    assert history(token) == [(ids[0], Sender.VALEZAP, "a"), (ids[1], Sender.VALEZAP, "b"), (ids[2], Sender.VALEZAP, "c")]
+
+
+def test_record_backend_replies_ends_the_session_in_the_same_statement(db_app):
+    _, tokens = db_app
+    token = open_session(tokens)
+
+    with database.session_scope(session_identifier=token) as db:
+        ids, ended = record_backend_replies(
+            db, token, spread_timestamps(["tchau", "fim da interacao"], T0), player_id=PLAYER
+        )
+
+    assert ended and len(ids) == 2
+    assert not is_active(token)
+
+
+def test_record_backend_replies_ignores_foreign_sessions(db_app):
+    _, tokens = db_app
+    token = open_session(tokens)
+
+    with database.session_scope(session_identifier=token) as db:
+        assert record_backend_replies(db, token, [("oi", T0)], player_id="5521988888888") == (None, False)
+        assert record_backend_replies(db, uuid4().hex, [("oi", T0)]) == (None, False)
+
+    assert history(token) == []
+
+
+def test_buffered_message_is_committed_before_the_response(db_app, monkeypatch):
+    app, tokens = db_app
+    token = open_session(tokens)
+    buffer = write_buffer.MessageBuffer(app, max_rows=100, flush_interval=0.01, max_pending=1000)
+    monkeypatch.setattr(write_buffer, "_buffer", buffer)
+    client = app.test_client()
+
+    first = client.post("/webhook/vale", json=item(token, "ola"), headers={"X-API-Key": "chave"})
+    last = client.post("/webhook/vale", json=item(token, "fim da interacao"), headers={"X-API-Key": "chave"})
+    foreign = client.post("/webhook/vale", json=item(token, "oi", player="5521988888888"), headers={"X-API-Key": "chave"})
+    buffer.close()
+
+    assert first.status_code == 200 and last.get_json()["ended"]
+    assert foreign.status_code == 403
+    assert [content for _, _, content in history(token)] == ["ola", "fim da interacao"]
+    assert not is_active(token)
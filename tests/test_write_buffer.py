@@ -0,0 +1,251 @@
+﻿"""Write buffer batching; the concurrency test needs ``VALEZAP_TEST_DATABASE_URL`` (superuser or BYPASSRLS)."""
+import os
+import threading
+from contextlib import contextmanager
+from uuid import uuid4
+
+import pytest
+from flask import Flask
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import OperationalError
+
+from app import database, events, write_buffer
+from app.events import LocalBroker
+from app.models import ChatSession, Message, Sender
+from app.write_buffer import MessageBuffer, PendingMessage
+
+DATABASE_URL = os.environ.get("VALEZAP_TEST_DATABASE_URL")
+
+
+def pending(token, sender, content, player="5511999999999"):
+    return PendingMessage(token, player, sender, content)
+
+
+class FakeDB:
+    def __init__(self, recorded):
+        self.recorded = recorded
+
+    def execute(self, stmt):
+        self.recorded.append(("lock",))
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    recorded = []
+
+    @contextmanager
+    def fake_scope(session_identifier=None):
+        recorded.append(("begin", session_identifier))
+        yield FakeDB(recorded)
+        recorded.append(("commit",))
+
+    def fake_players(db, token, player, entries):
+        if any(content == "quebrada" for content, _ in entries):
+            raise ValueError("linha invalida")
+        recorded.append(("player", token, entries))
+        return list(range(len(entries))) if token != "ended" else None
+
+    def fake_replies(db, token, entries, player_id=None):
+        recorded.append(("valezap", token, entries))
+        return list(range(len(entries))), False
+
+    monkeypatch.setattr(write_buffer, "session_scope", fake_scope)
+    monkeypatch.setattr(write_buffer, "switch_session_identifier", lambda db, token: recorded.append(("switch", token)))
+    monkeypatch.setattr(write_buffer, "record_player_messages", fake_players)
+    monkeypatch.setattr(write_buffer, "record_backend_replies", fake_replies)
+    return recorded
+
+
+def make_buffer(**overrides):
+    options = {"max_rows": 100, "flush_interval": 60, "max_pending": 1000}
+    options.update(overrides)
+    return MessageBuffer(Flask(__name__), **options)
+
+
+def test_flush_groups_by_session_in_one_transaction(calls):
+    buffer = make_buffer()
+    tickets = [
+        buffer.append(pending("a", Sender.PLAYER, "oi")),
+        buffer.append(pending("b", Sender.VALEZAP, "ola")),
+        buffer.append(pending("a", Sender.VALEZAP, "eco: oi")),
+        buffer.append(pending("a", Sender.VALEZAP, "mais")),
+    ]
+
+    assert buffer.flush() == 4
+    assert [call[0] for call in calls] == ["begin", "lock", "player", "valezap", "switch", "lock", "valezap", "commit"]
+    assert calls[0] == ("begin", "a")
+    assert [content for content, _ in calls[3][2]] == ["eco: oi", "mais"]
+    assert len(buffer) == 0
+    assert [ticket.result()[0] for ticket in tickets] == [0, 0, 0, 1]
+    assert tickets[3].result()[1] == calls[3][2][1][1]
+
+
+def test_flush_keeps_per_session_order_with_equal_clocks(calls):
+    buffer = make_buffer()
+    buffer.append(pending("a", Sender.PLAYER, "1"))
+    buffer.append(pending("a", Sender.VALEZAP, "2"))
+    buffer.append(pending("a", Sender.PLAYER, "3"))
+    buffer.flush()
+
+    assert calls.index(("lock",)) < calls.index(next(call for call in calls if call[0] == "player"))
+    written = [entry for call in calls if call[0] in ("player", "valezap") for entry in call[2]]
+    assert [content for content, _ in written] == ["1", "2", "3"]
+    timestamps = [created_at for _, created_at in written]
+    assert timestamps == sorted(set(timestamps))
+
+
+def test_rows_for_unmatched_sessions_are_dropped(calls):
+    buffer = make_buffer()
+    dropped = buffer.append(pending("ended", Sender.PLAYER, "oi"))
+    buffer.append(pending("a", Sender.PLAYER, "oi"))
+
+    assert buffer.flush() == 1
+    assert buffer.rows_dropped == 1
+    assert dropped.result() is None
+
+
+def test_failing_row_only_fails_its_own_writer(calls):
+    buffer = make_buffer()
+    before = buffer.append(pending("a", Sender.PLAYER, "1"))
+    bad = buffer.append(pending("a", Sender.PLAYER, "quebrada"))
+    after = buffer.append(pending("a", Sender.PLAYER, "3"))
+    other = buffer.append(pending("b", Sender.PLAYER, "oi"))
+
+    assert buffer.flush() == 3
+    with pytest.raises(ValueError):
+        bad.result()
+    assert before.result() and after.result() and other.result()
+    assert buffer.rows_failed == 1
+    written = [call[2][0][0] for call in calls if call[0] == "player"]
+    assert written == ["1", "3", "oi"]
+    # Nothing is requeued: the next flush has nothing left to write.
+    assert buffer.flush() == 0
+
+
+def test_outage_fails_the_whole_batch_at_once(monkeypatch):
+    buffer = make_buffer()
+    tickets = [buffer.append(pending(token, Sender.PLAYER, "oi")) for token in ("a", "b")]
+    attempts = []
+
+    def down(batch):
+        attempts.append(len(batch))
+        raise OperationalError("SELECT 1", {}, Exception("connection refused"))
+
+    monkeypatch.setattr(buffer, "_write", down)
+
+    assert buffer.flush() == 0
+    assert attempts == [2]
+    assert all(isinstance(ticket.exception(), OperationalError) for ticket in tickets)
+
+
+def test_sessions_are_locked_in_token_order(calls):
+    buffer = make_buffer()
+    buffer.append(pending("b", Sender.PLAYER, "oi"))
+    buffer.append(pending("a", Sender.PLAYER, "ola"))
+
+    assert buffer.flush() == 2
+    assert calls[0] == ("begin", "a")
+    assert [call[1] for call in calls if call[0] in ("player", "switch")] == ["a", "b", "b"]
+
+
+class Deadlock(Exception):
+    sqlstate = "40P01"
+
+
+def test_deadlock_is_retried_once_before_failing_the_batch(monkeypatch):
+    buffer = make_buffer()
+    tickets = [buffer.append(pending(token, Sender.PLAYER, "oi")) for token in ("a", "b")]
+    attempts = []
+
+    def flaky(batch):
+        attempts.append(len(batch))
+        if len(attempts) == 1:
+            raise OperationalError("SELECT 1", {}, Deadlock("deadlock detected"))
+        return [(n, None) for n in range(len(batch))]
+
+    monkeypatch.setattr(buffer, "_write", flaky)
+
+    assert buffer.flush() == 2
+    assert attempts == [2, 2]
+    assert [ticket.result()[0] for ticket in tickets] == [0, 1]
+
+
+def test_write_returns_once_the_background_flush_commits(calls):
+    buffer = make_buffer(flush_interval=0.01)
+
+    message_id, created_at = buffer.write(pending("a", Sender.PLAYER, "oi"))
+
+    assert message_id == 0
+    assert calls[-1] == ("commit",)
+    buffer.close()
+
+
+def test_append_flushes_inline_when_queue_is_full(calls):
+    buffer = make_buffer(max_rows=1, max_pending=2)
+    buffer.append(pending("a", Sender.PLAYER, "1"))
+    buffer.append(pending("a", Sender.PLAYER, "2"))
+
+    assert len(buffer) == 0
+    assert buffer.rows_written == 2
+
+
+@pytest.fixture
+def db_app(monkeypatch):
+    if not DATABASE_URL:
+        pytest.skip("VALEZAP_TEST_DATABASE_URL nao definido")
+    monkeypatch.setattr(events, "_broker", LocalBroker(None))
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_SessionFactory", None)
+    app = Flask(__name__)
+    app.config.update(DATABASE_URL=DATABASE_URL)
+    database.init_engine(app)
+    tokens = []
+    yield app, tokens
+    with database.session_scope() as db:
+        db.execute(text("DELETE FROM chat_sessions WHERE session_token = ANY(:t)"), {"t": tokens})
+    database.get_engine().dispose()
+
+
+def test_overlapping_batches_flushed_at_once_do_not_deadlock(db_app, monkeypatch):
+    app, tokens = db_app
+    player = "5511999999999"
+    for _ in range(3):
+        token = uuid4().hex
+        with database.session_scope() as db:
+            db.add(ChatSession(session_token=token, player_id=player))
+        tokens.append(token)
+
+    # Two workers hold the same sessions in opposite queue orders; each waits
+    # after its first session so both are inside their transaction together.
+    arrived = threading.Barrier(2)
+    record_player_messages = write_buffer.record_player_messages
+
+    def meeting(db, token, player_id, entries):
+        try:
+            arrived.wait(timeout=0.5)
+        except threading.BrokenBarrierError:
+            pass
+        return record_player_messages(db, token, player_id, entries)
+
+    monkeypatch.setattr(write_buffer, "record_player_messages", meeting)
+    buffers = [make_buffer(), make_buffer()]
+    buffers[0].app = buffers[1].app = app
+    tickets = [buffers[0].append(pending(token, Sender.PLAYER, "um", player)) for token in tokens]
+    tickets += [buffers[1].append(pending(token, Sender.PLAYER, "dois", player)) for token in reversed(tokens)]
+
+    flushers = [threading.Thread(target=buffer.flush) for buffer in buffers]
+    for flusher in flushers:
+        flusher.start()
+    for flusher in flushers:
+        flusher.join(30)
+
+    assert all(ticket.exception(timeout=0) is None and ticket.result() for ticket in tickets)
+    with database.session_scope() as db:
+        stored = db.execute(
+            select(func.count()).select_from(Message).where(Message.session_token.in_(tokens))
+        ).scalar_one()
+        counts = db.execute(
+            select(ChatSession.message_count).where(ChatSession.session_token.in_(tokens))
+        ).scalars().all()
+    assert stored == 6
+    assert counts == [2, 2, 2]